@@ -0,0 +1,405 @@
+"""
+Offline benchmarks of the config builder, the config api and the generated collector configuration.
+Results are written as json so runs of different commits can be compared:
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest import mock
+
+# builder reads its settings from the environment when it is imported
+for _name, _value in {'SCRAPE_INTERVAL': '300', 'LOGZIO_REGION': 'us',
+                      'LOGZIO_TOKEN': 'benchmarkTOKENbenchmarkTOKENbenc',
+                      'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_NAMESPACES': '', 'CUSTOM_CONFIG_PATH': '',
+                      'P8S_LOGZIO_NAME': 'benchmark', 'CUSTOM_LISTENER': '', 'AWS_ROLE_ARN': '',
+                      'LOGZIO_LOG_LEVEL': 'WARNING'}.items():
+    os.environ.setdefault(_name, _value)
+
+import yaml  # noqa: E402
+from prometheus_client.parser import text_string_to_metric_families  # noqa: E402
+import builder  # noqa: E402
+import fakes  # noqa: E402
+from util import catalog, planner, telemetry  # noqa: E402
+
+SYNTHETIC_DIMENSIONS = ['InstanceId', 'FunctionName', 'QueueName', 'TableName', 'ClusterName', 'Operation']
+SYNTHETIC_STATISTICS = ['Average', 'Sum', 'Maximum', 'Minimum', 'SampleCount']
+API_PATHS = ['/config/otel', '/config/cloudwatch', '/config/cloudwatch.yaml', '/config/cloudwatch.json']
+# Seconds the config api server has to start and to stop
+API_START_SECONDS = 30
+# Relative increase of a lower-is-better result, or decrease of a higher-is-better result, reported as a regression
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+# Compared results, other results are informational
+LOWER_IS_BETTER = ('seconds', 'latency_seconds', 'peak_memory_bytes')
+HIGHER_IS_BETTER = ('requests_per_second', 'bytes_per_second')
+# Statistics too noisy to report as regressions
+NOISY_STATISTICS = ('min', 'max', 'p99')
+RESULTS_DIR = './benchmark_results'
+
+
+# Write a synthetic cw_namespaces directory with namespaces_count namespaces of metrics_per_namespace metrics each.
+# Returns the synthetic namespace names
+def write_synthetic_catalog(namespaces_dir, namespaces_count, metrics_per_namespace, seed=0):
+    rand = random.Random(seed)
+    os.makedirs(namespaces_dir, exist_ok=True)
+    namespaces = []
+    for i in range(namespaces_count):
+        name = f'Synthetic{i:04d}'
+        metrics = []
+        for j in range(metrics_per_namespace):
+            metrics.append({
+                'aws_namespace': f'AWS/{name}',
+                'aws_metric_name': f'Metric{j:04d}',
+                'aws_dimensions': rand.sample(SYNTHETIC_DIMENSIONS, rand.randint(0, 2)),
+                'aws_statistics': rand.sample(SYNTHETIC_STATISTICS, rand.randint(1, 3))
+            })
+        with open(os.path.join(namespaces_dir, f'{name}.yml'), 'w') as namespace_file:
+            yaml.dump(metrics, namespace_file)
+        namespaces.append(f'AWS/{name}')
+    return namespaces
+
+
+# min, mean, percentiles and max of a list of samples
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {'min': ordered[0], 'mean': sum(ordered) / len(ordered), 'p50': percentile(50), 'p90': percentile(90),
+            'p99': percentile(99), 'max': ordered[-1]}
+
+
+# Work directory with the builder's relative paths: raw configurations, an empty configuration volume and
+# a synthetic catalog
+@contextlib.contextmanager
+def _workdir(namespaces_count, metrics_per_namespace):
+    source_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        shutil.copytree(os.path.join(source_dir, 'configuration_raw'), os.path.join(work_dir, 'configuration_raw'))
+        os.makedirs(os.path.join(work_dir, 'configuration'))
+        namespaces = write_synthetic_catalog(os.path.join(work_dir, 'cw_namespaces'), namespaces_count,
+                                             metrics_per_namespace)
+        os.chdir(work_dir)
+        with mock.patch.object(builder, 'AWS_NAMESPACES', ','.join(namespaces)), \
+                mock.patch.object(builder, 'CUSTOM_CONFIG_PATH', ''), \
+                mock.patch.object(builder, 'SETTINGS_PATH', ''):
+            yield work_dir
+    finally:
+        os.chdir(source_dir)
+        catalog._catalogs.clear()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _clear_build(work_dir):
+    catalog._catalogs.clear()
+    catalog_path = os.path.join(work_dir, catalog.CATALOG_PATH)
+    if os.path.exists(catalog_path):
+        os.remove(catalog_path)
+    for config_name in os.listdir(os.path.join(work_dir, 'configuration')):
+        os.remove(os.path.join(work_dir, 'configuration', config_name))
+
+
+# Peak memory allocated by a single call, traced separately since tracing slows the call down
+def _peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Wall time and peak memory of a cold build, with the catalog compiled from scratch, and of a rebuild with
+# nothing changed
+def bench_build(work_dir, repeat):
+    results = {}
+    for name, cold in (('cold_build', True), ('rebuild', False)):
+        seconds = []
+        for _ in range(repeat):
+            if cold:
+                _clear_build(work_dir)
+            start = time.perf_counter()
+            builder._build_configuration()
+            seconds.append(time.perf_counter() - start)
+        if cold:
+            _clear_build(work_dir)
+        results[name] = {'seconds': summarize(seconds),
+                         'peak_memory_bytes': _peak_memory(builder._build_configuration)}
+    with open(builder.CW_CONFIG, 'rb') as cw_file:
+        results['cloudwatch_config_bytes'] = len(cw_file.read())
+    return results
+
+
+def _get(url, headers):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+    return time.perf_counter() - start
+
+
+# Long polls waiting for a new document version, read from the /metrics of the config api
+def _waiting_watchers(base_url):
+    with urllib.request.urlopen(f'{base_url}/metrics') as response:
+        families = text_string_to_metric_families(response.read().decode())
+    return sum(sample.value for family in families for sample in family.samples
+               if sample.name == f'{telemetry.PREFIX}_document_watchers' and sample.labels.get('mode') == 'long_poll')
+
+
+# Latency of waking watchers that wait for a new version of the otel document, from the change of the file
+def _bench_watch(base_url, otel_config, watchers):
+    url = f'{base_url}/documents/otel'
+    with urllib.request.urlopen(url) as response:
+        headers = {'If-None-Match': response.headers['ETag']}
+
+    def watch():
+        with urllib.request.urlopen(urllib.request.Request(f'{url}?wait=60', headers=headers)) as response:
+            response.read()
+        return time.perf_counter()
+
+    with ThreadPoolExecutor(watchers) as executor:
+        futures = [executor.submit(watch) for _ in range(watchers)]
+        deadline = time.monotonic() + 30
+        while _waiting_watchers(base_url) < watchers:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{watchers} watchers did not start waiting')
+            time.sleep(0.01)
+        with open(otel_config, 'a') as otel_file:
+            otel_file.write('\n')
+        changed_at = time.perf_counter()
+        latencies = [future.result() - changed_at for future in futures]
+    return {'watchers': watchers, 'latency_seconds': summarize(latencies)}
+
+
+# Serve the config api of work_dir with gunicorn and the settings of util.server, as the builder and the separate
+# config api do, on a free port. The api reads ../configuration, so it runs in a directory next to it
+@contextlib.contextmanager
+def _api_server(work_dir):
+    api_dir = os.path.join(work_dir, 'api')
+    os.makedirs(api_dir, exist_ok=True)
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    env = dict(os.environ, API_PORT=str(port), PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'python:util.server', 'util.api:app'],
+                               cwd=api_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + API_START_SECONDS
+        while True:
+            try:
+                urllib.request.urlopen(f'{base_url}/').close()
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f'The config api did not start on port {port}')
+                time.sleep(0.05)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait(API_START_SECONDS)
+
+
+# Requests per second and latency of the config api, for full responses and for conditional requests that are
+# answered with 304
+def bench_api(work_dir, requests, concurrency, watchers=0):
+    results = {}
+    with _api_server(work_dir) as base_url:
+        for name, conditional in (('full', False), ('conditional', True)):
+            urls = []
+            for i in range(requests):
+                url = base_url + API_PATHS[i % len(API_PATHS)]
+                headers = {}
+                if conditional:
+                    with urllib.request.urlopen(url) as response:
+                        headers['If-None-Match'] = response.headers['ETag']
+                urls.append((url, headers))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as executor:
+                latencies = list(executor.map(lambda request: _get(*request), urls))
+            elapsed = time.perf_counter() - start
+            results[name] = {'requests_per_second': requests / elapsed, 'latency_seconds': summarize(latencies)}
+        if watchers:
+            results['watch'] = _bench_watch(base_url, os.path.join(work_dir, builder.OTEL_CONFIG), watchers)
+    return results
+
+
+# Point a generated collector configuration at a fake target and a fake remote write receiver. The write-ahead log
+# of a file send queue is moved to queue_dir
+def _collector_config(otel_config, target, receiver, scrape_interval, queue_dir=None):
+    otel_yaml = builder._load_yaml(otel_config)
+    otel_yaml['exporters']['prometheusremotewrite']['endpoint'] = receiver.url
+    if queue_dir and otel_yaml['exporters']['prometheusremotewrite'].get('wal'):
+        otel_yaml['exporters']['prometheusremotewrite']['wal']['directory'] = queue_dir
+    otel_yaml['exporters'].pop('logging', None)
+    pipeline = otel_yaml['service']['pipelines']['metrics']
+    pipeline['exporters'] = [e for e in pipeline['exporters'] if e != 'logging']
+    otel_yaml['receivers']['prometheus']['config']['scrape_configs'] = [{
+        'job_name': 'benchmark',
+        'scrape_interval': f'{scrape_interval}s',
+        'static_configs': [{'targets': [target.address]}]
+    }]
+    return otel_yaml
+
+
+# Throughput of a collector binary running the generated configuration, between a fake /metrics target with the
+# estimated series and a fake remote write receiver. With stall_seconds, the receiver stalls like a listener outage
+# for that long first, and recovery_seconds is how long the collector took to deliver again after the outage
+def bench_collector(work_dir, collector_bin, series, duration, scrape_interval, stall_seconds=0):
+    with fakes.FakeMetricsTarget(series) as target, fakes.StallingRemoteWriteReceiver() as receiver:
+        config_path = os.path.join(work_dir, 'collector-benchmark.yml')
+        builder._write_yaml_atomically(
+            _collector_config(os.path.join(work_dir, builder.OTEL_CONFIG), target, receiver, scrape_interval,
+                              os.path.join(work_dir, 'otel-queue')),
+            config_path)
+        if stall_seconds:
+            receiver.stall()
+        process = subprocess.Popen([collector_bin, f'--config={config_path}'], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(stall_seconds)
+            receiver.resume()
+            resumed_at = time.monotonic()
+            time.sleep(duration)
+        finally:
+            process.terminate()
+            process.wait(10)
+        stats = receiver.stats()
+    results = {'series': series, 'duration_seconds': duration, 'scrapes': target.scrapes,
+               'requests': stats['requests'], 'bytes': stats['bytes'],
+               'requests_per_second': stats['requests'] / duration, 'bytes_per_second': stats['bytes'] / duration}
+    if stall_seconds:
+        results.update({'stall_seconds': stall_seconds, 'rejected_requests': stats['rejected'],
+                        'recovery_seconds': receiver.first_request_at - resumed_at
+                        if receiver.first_request_at else None})
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = {
+        'commit': _git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'parameters': vars(args).copy(),
+        'benchmarks': {}
+    }
+    with _workdir(args.namespaces, args.metrics_per_namespace) as work_dir:
+        results['benchmarks']['build'] = bench_build(work_dir, args.repeat)
+        results['benchmarks']['api'] = bench_api(work_dir, args.requests, args.concurrency, args.watchers)
+        if args.collector:
+            series = args.series or planner.plan_config(
+                os.path.join(work_dir, builder.CW_CONFIG), {})['series']
+            results['benchmarks']['collector'] = bench_collector(work_dir, args.collector, series, args.duration,
+                                                                 args.collector_scrape_interval, args.stall)
+    return results
+
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+# Relative change of every numeric result of current against baseline, and the results that regressed by more
+# than threshold
+def compare(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    base = _flatten(baseline['benchmarks'])
+    changes, regressions = {}, []
+    for key, value in _flatten(current['benchmarks']).items():
+        if not base.get(key):
+            continue
+        parts = key.split('.')
+        if not any(part in LOWER_IS_BETTER + HIGHER_IS_BETTER for part in parts):
+            continue
+        change = (value - base[key]) / base[key]
+        changes[key] = change
+        if parts[-1] in NOISY_STATISTICS:
+            continue
+        if (-change if any(part in HIGHER_IS_BETTER for part in parts) else change) > threshold:
+            regressions.append(key)
+    return changes, regressions
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the config builder, the config api and the generated '
+                                                 'collector configuration offline')
+    parser.add_argument('--namespaces', type=int, default=300, help='Synthetic namespaces')
+    parser.add_argument('--metrics-per-namespace', type=int, default=20, help='Synthetic metrics per namespace')
+    parser.add_argument('--repeat', type=int, default=5, help='Builds per build benchmark')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per api benchmark')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent api clients')
+    parser.add_argument('--watchers', type=int, default=200,
+                        help='Clients waiting for a new version of a configuration document')
+    parser.add_argument('--collector', help='Path to an opentelemetry collector binary, enables the collector '
+                                            'benchmark')
+    parser.add_argument('--series', type=int, help='Series served by the fake target, default is the estimated '
+                                                   'series of the generated configuration')
+    parser.add_argument('--duration', type=float, default=30, help='Collector benchmark duration, in seconds')
+    parser.add_argument('--collector-scrape-interval', type=int, default=5,
+                        help='Scrape interval of the collector benchmark, in seconds')
+    parser.add_argument('--stall', type=float, default=0,
+                        help='Stall the fake listener for this many seconds before the collector benchmark, to '
+                             'measure how the send queue recovers from a listener outage')
+    parser.add_argument('--output', help=f'Write the results to this json file, default is '
+                                         f'{RESULTS_DIR}/<commit>.json')
+    parser.add_argument('--compare', help='Baseline results json file to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='Relative change reported as a regression')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = _parse_args(args)
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    output_path = args.output or os.path.join(RESULTS_DIR, f'{results["commit"] or "uncommitted"}.json')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        output_file.write(output)
+    print(output)
+    print(f'Results written to {output_path}')
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            changes, regressions = compare(json.load(baseline_file), results, args.threshold)
+        for key, change in sorted(changes.items()):
+            print(f'{key}: {change:+.1%}{" REGRESSION" if key in regressions else ""}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,94 @@
-from util import input_validator, scrape_jobs_config, api
+from util import input_validator, scrape_jobs_config, catalog, sharding, planner, metric_merge, tiers, \
+    otel_tuning, watch, resource_select, telemetry, config_lint, relabel, profiles, files
 import os
+import argparse
+import copy
+import json
 import logging
+import math
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 # Environment variables
 SCRAPE_INTERVAL = int(os.environ["SCRAPE_INTERVAL"])
 LOGZIO_LISTENER_ADDRESS = "https://listener.logz.io:8053"
 REGION = os.environ['LOGZIO_REGION']
 LOGZIO_TOKEN = os.environ['LOGZIO_TOKEN']
 AWS_REGION = os.environ['AWS_DEFAULT_REGION']
-AWS_NAMESPACES = os.environ['AWS_NAMESPACES']
 CUSTOM_CONFIG_PATH = os.environ['CUSTOM_CONFIG_PATH']
 P8S_LOGZIO_NAME = os.environ['P8S_LOGZIO_NAME']
 CUSTOM_LISTENER = os.environ['CUSTOM_LISTENER']
 AWS_ROLE_ARN = os.environ['AWS_ROLE_ARN']
+INVENTORY_PATH = os.environ.get('INVENTORY_PATH', '')
+OTEL_QUEUE_DIRECTORY = os.environ.get('OTEL_QUEUE_DIRECTORY') or otel_tuning.DEFAULT_QUEUE_DIRECTORY
+# Version of the opentelemetry collector image, defaults to the version pinned in docker-compose.yml
+OTEL_COLLECTOR_VERSION = os.environ.get('OTEL_COLLECTOR_VERSION') or '0.18.0'
+WATCH_CONFIGURATION = os.environ.get('WATCH_CONFIGURATION', '').lower() == 'true'
+WATCH_INTERVAL = int(os.environ.get('WATCH_INTERVAL') or 10)
+SETTINGS_PATH = os.environ.get('SETTINGS_PATH', '')
+COLLECTOR_RELOAD_URL = os.environ.get('COLLECTOR_RELOAD_URL', '')
+# Defaults to false with --build-only, see _apply_build_only
+SCRAPE_BUILDER_METRICS = os.environ.get('SCRAPE_BUILDER_METRICS', 'true').lower() == 'true'
+# Version of the prom/cloudwatch-exporter image, defaults to the version pinned in docker-compose.yml
+CLOUDWATCH_EXPORTER_VERSION = os.environ.get('CLOUDWATCH_EXPORTER_VERSION') or '0.9.0'
+
+
+def _split_list(value):
+    return [item for item in value.replace(' ', '').split(',') if item]
+
+
+def _is_true(value):
+    return value.lower() == 'true'
+
+
+# Settings the settings file can override, by environment variable name: (global name, parser). The globals are set
+# from the environment variables when the module is loaded, see _apply_settings
+RELOADABLE_SETTINGS = {
+    'AWS_NAMESPACES': ('AWS_NAMESPACES', str),
+    'AWS_REGIONS': ('AWS_REGIONS', lambda value: _split_list(value) or [AWS_REGION]),
+    'AWS_ROLE_ARNS': ('AWS_ROLE_ARNS', lambda value: _split_list(value) or [AWS_ROLE_ARN]),
+    'EXPORTER_REPLICAS': ('EXPORTER_REPLICAS', lambda value: int(value or 1)),
+    'STRICT_SCRAPE_PLAN': ('STRICT_SCRAPE_PLAN', _is_true),
+    'MERGE_CUSTOM_CONFIG': ('MERGE_CUSTOM_CONFIG', _is_true),
+    'REWRITE_CUSTOM_CONFIG': ('REWRITE_CUSTOM_CONFIG', _is_true),
+    'ENABLE_SCRAPE_TIERS': ('ENABLE_SCRAPE_TIERS', _is_true),
+    'AWS_NAMESPACE_TIERS': ('NAMESPACE_TIERS', tiers.parse_namespace_tiers),
+    'OTEL_TUNING_PRESET': ('OTEL_TUNING_PRESET', str.lower),
+    'OTEL_DROP_LOGGING_EXPORTER': ('OTEL_DROP_LOGGING_EXPORTER', _is_true),
+    'OTEL_SEND_QUEUE': ('OTEL_SEND_QUEUE', str.lower),
+    'OTEL_QUEUE_OUTAGE_SECONDS': ('OTEL_QUEUE_OUTAGE_SECONDS',
+                                  lambda value: int(value or otel_tuning.DEFAULT_OUTAGE_SECONDS)),
+    'OTEL_QUEUE_MEMORY_MIB': ('OTEL_QUEUE_MEMORY_MIB',
+                              lambda value: int(value or otel_tuning.DEFAULT_QUEUE_MEMORY_MIB)),
+    'ENABLE_METRIC_ALLOWLISTS': ('ENABLE_METRIC_ALLOWLISTS', _is_true),
+    'STATISTICS_PROFILE': ('STATISTICS_PROFILE', lambda value: value.lower() or profiles.DEFAULT_PROFILE),
+    'AWS_NAMESPACE_PROFILES': ('NAMESPACE_PROFILES', profiles.parse_namespace_profiles),
+    'USE_GET_METRIC_DATA': ('USE_GET_METRIC_DATA', _is_true)
+}
+
+
+# Set the reloadable settings from the settings file, falling back to the environment variables
+def _apply_settings(settings):
+    for env_name, (name, parse) in RELOADABLE_SETTINGS.items():
+        value = settings.get(env_name, os.environ.get(env_name, ''))
+        if isinstance(value, dict):
+            value = ','.join(f'{key}:{item}' for key, item in value.items())
+        elif isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        globals()[name] = parse(str(value))
+
+
+_apply_settings({})
 
 # configuration files path
 CW_CONFIG = './configuration/cloudwatch.yml'
@@ -21,6 +96,13 @@ CW_RAW_CONFIG = './configuration_raw/cloudwatch_raw.yml'
 CUSTOM_CW_PATH = './configuration/custom/cloudwatch.yml'
 OTEL_CONFIG = './configuration/otel.yml'
 OTEL_RAW_CONFIG = './configuration_raw/otel_raw.yml'
+EXPORTER_RELOAD_PATH = '/-/reload'
+# Written after every successful build, and removed when the builder starts
+READY_PATH = './configuration/.ready'
+BUILD_METRICS_PATH = './configuration/.builder_metrics.prom'
+
+# Metric entry fields that are part of the metric key, other fields are compared as settings
+METRIC_KEY_FIELDS = ('aws_namespace', 'aws_metric_name', 'aws_dimensions', 'aws_statistics')
 
 # Logging config
 DEFAULT_LOG_LEVEL = "INFO"
@@ -42,20 +124,75 @@ def _create_logger():
 logger = _create_logger()
 
 
-# Validate inputs
-def validate_input():
+# Validate inputs, linting a custom configuration with the inventory of the build
+def validate_input(inventory=None):
     input_validator.is_valid_logzio_token(LOGZIO_TOKEN)
-    input_validator.is_valid_aws_region(AWS_REGION)
+    for aws_region in AWS_REGIONS:
+        input_validator.is_valid_aws_region(aws_region)
+    input_validator.is_valid_exporter_replicas(EXPORTER_REPLICAS)
     input_validator.is_valid_p8s_logzio_name(P8S_LOGZIO_NAME)
     if CUSTOM_LISTENER:
         input_validator.is_valid_custom_listener(CUSTOM_LISTENER)
     input_validator.is_valid_logzio_region_code(REGION)
     input_validator.is_valid_scrape_interval(SCRAPE_INTERVAL)
-    if CUSTOM_CONFIG_PATH:
-        return [], []
-    else:
+    if OTEL_TUNING_PRESET:
+        input_validator.is_valid_otel_tuning_preset(OTEL_TUNING_PRESET)
+    if OTEL_SEND_QUEUE:
+        input_validator.is_valid_otel_send_queue(OTEL_SEND_QUEUE)
+        if OTEL_SEND_QUEUE == 'file':
+            input_validator.is_valid_file_queue_collector_version(OTEL_COLLECTOR_VERSION)
+    input_validator.is_valid_statistics_profile(STATISTICS_PROFILE)
+    namespaces, removed_namespaces = [], []
+    if not CUSTOM_CONFIG_PATH or (MERGE_CUSTOM_CONFIG and AWS_NAMESPACES):
         namespaces, removed_namespaces = input_validator.is_valid_aws_namespaces(AWS_NAMESPACES)
-        return namespaces, removed_namespaces
+    use_get_metric_data = USE_GET_METRIC_DATA
+    if CUSTOM_CONFIG_PATH:
+        custom_config_yaml = _lint_custom_config(_load_yaml(CUSTOM_CW_PATH), SCRAPE_INTERVAL, inventory)
+        use_get_metric_data = use_get_metric_data or custom_config_yaml.get('use_get_metric_data', False) or any(
+            metric.get('use_get_metric_data') for metric in custom_config_yaml.get('metrics') or [])
+    if use_get_metric_data:
+        input_validator.is_valid_get_metric_data_exporter_version(CLOUDWATCH_EXPORTER_VERSION)
+    return namespaces, removed_namespaces
+
+
+# Statistics profile of a namespace: the profile assigned to the namespace, then the global profile
+def _namespace_profile(namespace):
+    return NAMESPACE_PROFILES.get(f'AWS/{namespace.strip().split("AWS/")[-1]}', STATISTICS_PROFILE)
+
+
+# Log the metrics, series and api calls per scrape of the namespaces of each statistics profile
+def _log_profiles(namespaces, inventory):
+    profile_namespaces = {}
+    for namespace in namespaces:
+        profile_namespaces.setdefault(_namespace_profile(namespace), []).append(namespace)
+    for profile in profiles.PROFILES:
+        if profile not in profile_namespaces:
+            continue
+        plan = planner.plan_namespaces(profile_namespaces[profile], inventory, profile=profile,
+                                       use_get_metric_data=USE_GET_METRIC_DATA)
+        message = f'{profile.capitalize()} statistics profile: {len(profile_namespaces[profile])} namespaces, ' \
+                  f'{plan["metrics"]} metrics, {plan["series"]} series and {plan["api_calls"]} api calls per scrape'
+        if profile != profiles.DEFAULT_PROFILE:
+            standard = planner.plan_namespaces(profile_namespaces[profile], inventory,
+                                               use_get_metric_data=USE_GET_METRIC_DATA)
+            message += f' ({standard["metrics"]} metrics, {standard["series"]} series and ' \
+                       f'{standard["api_calls"]} api calls with the {profiles.DEFAULT_PROFILE} profile)'
+        logger.info(message)
+
+
+# Warn, or fail when strict, if an exporter cannot finish a scrape within the scrape interval. Takes the plans, or
+# the exporters, of a build
+def _check_scrape_plans(plans, strict):
+    for plan in plans:
+        where = f' of {plan["target"]}' if plan.get('target') else ''
+        logger.info(f'Estimated scrape{where}: {plan["api_calls"]} api calls, {plan["series"]} series, '
+                    f'{plan["scrape_duration_seconds"]}s')
+        if not plan['fits_scrape_interval']:
+            message = f'Estimated scrape duration{where} {plan["scrape_duration_seconds"]}s exceeds the scrape ' \
+                      f'interval {plan["scrape_interval"]}s, consider fewer namespaces or more exporter replicas'
+            if strict:
+                raise ValueError(message)
+            logger.warning(message)
 
 
 def _get_listener_url(region):
@@ -78,95 +215,478 @@ def _get_region_code(region):
 def _dump_and_close_file(module_yaml, module_file):
     yaml.preserve_quotes = True
     module_file.seek(0)
-    yaml.dump(module_yaml, module_file)
+    yaml.dump(module_yaml, module_file, Dumper=SafeDumper)
     module_file.truncate()
     module_file.close()
 
 
-# Updating opentelemrty configuration with remotewrite endpoint, token and scrape jobs
-def _update_otel_config(token, region, p8s_name, otel_config):
-    logger.info('Adding opentelemtry collector configuration')
-    with open(otel_config, 'r+') as module_file:
-        module_yaml = yaml.safe_load(module_file)
-        module_yaml['exporters']['prometheusremotewrite']['endpoint'] = _get_listener_url(region)
-        module_yaml['exporters']['prometheusremotewrite']['headers'][
-            'Authorization'] = f'Bearer {token}'
-        module_yaml['receivers']['prometheus']['config']['global']['external_labels'][
-            'p8s_logzio_name'] = p8s_name
-        if scrape_jobs_config.aws not in module_yaml['receivers']['prometheus']['config']['scrape_configs']:
-            module_yaml['receivers']['prometheus']['config']['scrape_configs'].append(scrape_jobs_config.aws)
-        _dump_and_close_file(module_yaml, module_file)
-        logger.info('Opentelemtry collector configuration ready')
+# Load a yaml file into memory
+def _load_yaml(path):
+    with open(path, 'r') as module_file:
+        return yaml.load(module_file, Loader=SafeLoader)
 
 
-# Ading region and scrape interval to cloudwatch exporter configuration
-def _add_aws_global_settings(cw_config, aws_region, scrape_interval, aws_role):
-    with open(cw_config, 'r+') as module_file:
-        module_yaml = yaml.safe_load(module_file)
-        module_yaml['region'] = aws_region
-        module_yaml['period_seconds'] = int(scrape_interval)
-        if aws_role:
-            module_yaml['role_arn'] = aws_role
+# Write yaml to a temporary file next to the target and rename it over the target,
+# so readers never see a half written configuration
+def _write_yaml_atomically(module_yaml, path):
+    with files.atomic_write(path) as module_file:
         _dump_and_close_file(module_yaml, module_file)
 
 
-# Add metrics to scrape based on AWS_NAMESPACES environment variable
-def _add_cloudwatch_namespace(namespace, cw_config):
-    namespace = namespace.split('AWS/')[-1]
-    with open(cw_config, 'r+') as cloudwatch_file:
-        cloudwatch_yaml = yaml.safe_load(cloudwatch_file)
-        with open('./cw_namespaces/{}.yml'.format(namespace), 'r+') as namespace_file:
-            namespace_yaml = yaml.safe_load(namespace_file)
-            if namespace_yaml not in cloudwatch_yaml['metrics']:
-                cloudwatch_yaml['metrics'].extend(namespace_yaml)
-        _dump_and_close_file(cloudwatch_yaml, cloudwatch_file)
-        logger.info(f'AWS/{namespace} was added to cloudwatch exporter configuration')
+# Log and record how long a build phase took
+@contextmanager
+def _timed_phase(phase):
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    telemetry.observe_phase(phase, elapsed)
+    logger.info(f'{phase} took {elapsed * 1000:.1f}ms')
 
 
-def _add_cloudwatch_config(namespaces, cw_config, aws_region, scrape_interval, aws_role):
-    logger.info('Adding cloudwatch exporter configuration')
-    _add_aws_global_settings(cw_config, aws_region, scrape_interval, aws_role)
+# Updating opentelemrty configuration with remotewrite endpoint, token, scrape jobs and optional collector tuning and
+# send queue
+def _update_otel_config(token, region, p8s_name, otel_config, scrape_jobs=None, tuning=None, drop_logging=False,
+                        send_queue=None):
+    logger.info('Adding opentelemtry collector configuration')
+    module_yaml = _load_yaml(otel_config)
+    module_yaml['exporters']['prometheusremotewrite']['endpoint'] = _get_listener_url(region)
+    module_yaml['exporters']['prometheusremotewrite']['headers'][
+        'Authorization'] = f'Bearer {token}'
+    module_yaml['receivers']['prometheus']['config']['global']['external_labels'][
+        'p8s_logzio_name'] = p8s_name
+    scrape_configs = module_yaml['receivers']['prometheus']['config']['scrape_configs']
+    for scrape_job in scrape_jobs or [scrape_jobs_config.aws]:
+        if scrape_job not in scrape_configs:
+            scrape_configs.append(scrape_job)
+    collector_version = input_validator.parse_version(OTEL_COLLECTOR_VERSION)
+    if tuning:
+        otel_tuning.apply_tuning(module_yaml, tuning, collector_version)
+    if send_queue:
+        otel_tuning.apply_send_queue(module_yaml, send_queue, collector_version)
+    if drop_logging:
+        otel_tuning.drop_logging_exporter(module_yaml)
+    _write_yaml_atomically(module_yaml, otel_config)
+    logger.info('Opentelemtry collector configuration ready')
+
+
+# Collector tuning of OTEL_TUNING_PRESET for the estimated series of the exporters. Without an inventory the planner
+# assumes a single resource per dimension, which is no estimate to size the collector for, so the preset's static
+# values are used
+def _get_tuning(exporters):
+    if not INVENTORY_PATH:
+        logger.warning(f'Tuning opentelemtry collector with the static values of the {OTEL_TUNING_PRESET} preset, '
+                       f'set INVENTORY_PATH to size it for the estimated series')
+        return otel_tuning.get_tuning(OTEL_TUNING_PRESET)
+    series = sum(exporter['series'] for exporter in exporters)
+    logger.info(f'Tuning opentelemtry collector with the {OTEL_TUNING_PRESET} preset for an estimated {series} '
+                f'series per scrape')
+    return otel_tuning.get_tuning(OTEL_TUNING_PRESET, series)
+
+
+# Send queue of the collector for the estimated series of the exporters, in series per SCRAPE_INTERVAL. With collector
+# settings, it is sized for requests of the tuned batch size, keeps the tuned consumers and queues no more requests
+# in memory than the memory limiter leaves room for
+def _get_send_queue(exporters, tuning=None):
+    series = sum(math.ceil(exporter['series'] * SCRAPE_INTERVAL / exporter['scrape_interval'])
+                 for exporter in exporters)
+    batch_size, memory_mib, num_consumers = otel_tuning.DEFAULT_BATCH_SIZE, OTEL_QUEUE_MEMORY_MIB, None
+    if tuning:
+        batch_size = tuning['batch']['send_batch_size']
+        memory_mib = min(memory_mib, otel_tuning.get_queue_headroom_mib(tuning))
+        num_consumers = tuning['sending_queue']['num_consumers']
+    send_queue = otel_tuning.get_send_queue(OTEL_SEND_QUEUE, series, SCRAPE_INTERVAL, batch_size,
+                                            OTEL_QUEUE_OUTAGE_SECONDS, memory_mib, OTEL_QUEUE_DIRECTORY,
+                                            num_consumers)
+    logger.info(f'Remote write {OTEL_SEND_QUEUE} send queue of {send_queue["queue"]["queue_size"]} requests with up '
+                f'to {send_queue["memory_mib"]} MiB of queued requests in memory' +
+                (f' and the rest in {OTEL_QUEUE_DIRECTORY}' if send_queue['wal'] else ''))
+    # The outage the queue absorbs depends on the series per scrape, which are only estimated with an inventory
+    if not INVENTORY_PATH:
+        logger.info('Set INVENTORY_PATH to estimate how long a listener outage the send queue absorbs')
+        return send_queue
+    logger.info(f'The send queue absorbs a listener outage of {send_queue["absorbed_seconds"]}s for an estimated '
+                f'{series} series per scrape')
+    if send_queue['absorbed_seconds'] < OTEL_QUEUE_OUTAGE_SECONDS:
+        bound = 'OTEL_QUEUE_MEMORY_MIB' if memory_mib == OTEL_QUEUE_MEMORY_MIB else "the tuning preset's memory limit"
+        logger.warning(f'The memory send queue fills up after {send_queue["absorbed_seconds"]}s of a listener '
+                       f'outage, raise {bound} or use the file send queue to absorb {OTEL_QUEUE_OUTAGE_SECONDS}s')
+    return send_queue
+
+
+# Ading region and scrape interval to cloudwatch exporter configuration, optionally collecting with GetMetricData
+def _add_aws_global_settings(cloudwatch_yaml, aws_region, scrape_interval, aws_role, use_get_metric_data=False):
+    cloudwatch_yaml['region'] = aws_region
+    cloudwatch_yaml['period_seconds'] = int(scrape_interval)
+    if aws_role:
+        cloudwatch_yaml['role_arn'] = aws_role
+    if use_get_metric_data:
+        cloudwatch_yaml['use_get_metric_data'] = True
+
+
+# Hashable key identifying a metric entry, used to skip entries that are already in the configuration
+def _metric_key(metric):
+    settings = {k: v for k, v in metric.items() if k not in METRIC_KEY_FIELDS}
+    return (metric.get('aws_namespace', '').strip(),
+            metric.get('aws_metric_name'),
+            tuple(metric.get('aws_dimensions') or ()),
+            tuple(metric.get('aws_statistics') or ()),
+            json.dumps(settings, sort_keys=True))
+
+
+# Add metrics of a namespace to an in memory cloudwatch exporter configuration
+def _add_cloudwatch_namespace(namespace, cloudwatch_yaml, metric_keys):
+    namespace = namespace.split('AWS/')[-1]
+    profile = _namespace_profile(namespace)
+    added = 0
+    for metric in profiles.get_namespace_metrics(namespace, profile):
+        key = _metric_key(metric)
+        if key not in metric_keys:
+            metric_keys.add(key)
+            cloudwatch_yaml['metrics'].append(metric)
+            added += 1
+    logger.info(f'AWS/{namespace} was added to cloudwatch exporter configuration ({added} metrics, {profile} profile)')
+
+
+# Add global settings and namespace metrics to an in memory cloudwatch exporter configuration
+def _build_cloudwatch_yaml(cloudwatch_yaml, namespaces, aws_region, scrape_interval, aws_role, inventory):
+    _add_aws_global_settings(cloudwatch_yaml, aws_region, scrape_interval, aws_role, USE_GET_METRIC_DATA)
+    metric_keys = {_metric_key(metric) for metric in cloudwatch_yaml['metrics']}
     for namespace in namespaces:
-        _add_cloudwatch_namespace(namespace, cw_config)
+        _add_cloudwatch_namespace(namespace, cloudwatch_yaml, metric_keys)
+    _select_cloudwatch_resources(cloudwatch_yaml, inventory)
+    _merge_cloudwatch_metrics(cloudwatch_yaml, inventory)
+    return cloudwatch_yaml
+
+
+# Add the resource filters of the inventory to the metric entries of an in memory cloudwatch exporter configuration
+def _select_cloudwatch_resources(cloudwatch_yaml, inventory):
+    metrics = cloudwatch_yaml.get('metrics') or []
+    resource_select.select_metrics(metrics, inventory)
+    selected = len([metric for metric in metrics if any(setting in metric for setting in
+                                                       resource_select.SELECT_SETTINGS.values())])
+    if selected:
+        logger.info(f'{selected} metrics are collected for selected resources only')
+
+
+# Merge metric entries that can share cloudwatch requests and log how many requests it saved
+def _merge_cloudwatch_metrics(cloudwatch_yaml, inventory):
+    cloudwatch_yaml['metrics'], report = metric_merge.merge_metrics(cloudwatch_yaml.get('metrics') or [], inventory,
+                                                                    cloudwatch_yaml.get('use_get_metric_data', False))
+    if report['entries_before'] != report['entries_after']:
+        logger.info(f'Merged {report["entries_before"]} metric entries into {report["entries_after"]} '
+                    f'({report["exact_duplicates"]} duplicates, {report["subsumed"]} subsumed, '
+                    f'{report["merged"]} merged), saving {report["api_calls_saved"]} of '
+                    f'{report["api_calls_before"]} estimated api calls per scrape')
+    return report
+
+
+# Write a cloudwatch exporter configuration per scrape tier of an in memory configuration.
+# Returns the written exporters, with their configuration path, scrape target, scrape interval and estimated cost
+def _write_tiered_cloudwatch_config(cloudwatch_yaml, cw_config, shard, scrape_interval, inventory):
+    shard_id = shard['id'] if shard else ''
+    exporters = []
+    tier_metrics = tiers.split_by_tier(cloudwatch_yaml.get('metrics') or [], NAMESPACE_TIERS, ENABLE_SCRAPE_TIERS)
+    for tier, metrics in tier_metrics.items():
+        tier_settings = tiers.get_tier_settings(tier, scrape_interval)
+        tier_yaml = dict(cloudwatch_yaml, **tier_settings['exporter'])
+        if 'metrics' in cloudwatch_yaml:
+            tier_yaml['metrics'] = metrics
+        config_path = sharding.get_config_path(cw_config, shard_id, tiers.get_suffix(tier))
+        _write_yaml_atomically(tier_yaml, config_path)
+        plan = planner.plan_metrics(metrics, inventory, tier_settings['scrape_interval'],
+                                    use_get_metric_data=cloudwatch_yaml.get('use_get_metric_data', False))
+        if cloudwatch_yaml.get('use_get_metric_data'):
+            _log_get_metric_data_savings(config_path, metrics, inventory, plan)
+        exporters.append({'shard': shard, 'tier': tier, 'config': config_path,
+                          'target': sharding.get_target(shard_id, tiers.get_suffix(tier)),
+                          'scrape_interval': tier_settings['scrape_interval'],
+                          'api_calls': plan['api_calls'], 'series': plan['series'],
+                          'scrape_duration_seconds': plan['scrape_duration_seconds'],
+                          'fits_scrape_interval': plan['fits_scrape_interval'],
+                          'namespaces': telemetry.count_namespaces(metrics)})
+        if tiers.get_suffix(tier):
+            logger.info(f'{len(metrics)} metrics are scraped every {tier_settings["scrape_interval"]}s '
+                        f'in the {tier} tier')
+    return exporters
+
+
+# Log the api calls GetMetricData saves compared to GetMetricStatistics for an exporter configuration
+def _log_get_metric_data_savings(config_path, metrics, inventory, plan):
+    statistics_plan = planner.plan_metrics(metrics, inventory)
+    saved = statistics_plan['api_calls'] - plan['api_calls']
+    logger.info(f'{os.path.basename(config_path)} uses GetMetricData: {plan["api_calls"]} estimated api calls per '
+                f'scrape instead of {statistics_plan["api_calls"]} with GetMetricStatistics'
+                + (f' ({saved / statistics_plan["api_calls"]:.0%} fewer)' if statistics_plan['api_calls'] else ''))
+
+
+# Build the whole cloudwatch exporter configuration in memory and write it once
+def _add_cloudwatch_config(namespaces, cw_config, aws_region, scrape_interval, aws_role, inventory=None):
+    logger.info('Adding cloudwatch exporter configuration')
+    inventory = inventory or {}
+    cloudwatch_yaml = _build_cloudwatch_yaml(_load_yaml(cw_config), namespaces, aws_region, scrape_interval,
+                                             aws_role, inventory)
+    exporters = _write_tiered_cloudwatch_config(cloudwatch_yaml, cw_config, None, scrape_interval, inventory)
     logger.info('Cloudwatch exporter configuration ready')
-
-
-# Add custom cloudwatch exporter configuration
-def _load_aws_custom_config(cw_config, cw_custom_path):
-    with open(cw_custom_path, 'r+') as custom_config_file:
-        custom_config_yaml = yaml.safe_load(custom_config_file)
-        with open(cw_config, 'w') as cloudwatch_file:
-            _dump_and_close_file(custom_config_yaml, cloudwatch_file)
-            logger.info('Custom configuration was assigned to cloudwatch exporter')
+    return exporters
+
+
+# Estimated number of cloudwatch api calls of a namespace, used to balance namespaces between shards
+def _namespace_cost(namespace, inventory):
+    return planner.plan_namespaces([namespace], inventory, profile=_namespace_profile(namespace),
+                                   use_get_metric_data=USE_GET_METRIC_DATA)['api_calls']
+
+
+# Write the cloudwatch exporter configurations of every shard next to cw_config
+def _add_sharded_cloudwatch_config(shards, cw_config, scrape_interval, inventory=None):
+    logger.info(f'Adding cloudwatch exporter configuration for {len(shards)} shard(s)')
+    inventory = inventory or {}
+    template = _load_yaml(cw_config)
+    exporters = []
+    for shard in shards:
+        cloudwatch_yaml = _build_cloudwatch_yaml(copy.deepcopy(template), shard['namespaces'], shard['region'],
+                                                 scrape_interval, shard['role_arn'], inventory)
+        exporters.extend(_write_tiered_cloudwatch_config(cloudwatch_yaml, cw_config, shard, scrape_interval,
+                                                         inventory))
+        if shard['id']:
+            logger.info(f'Shard {shard["id"]} ({shard["region"]}, account {shard["account"]}): '
+                        f'{len(shard["namespaces"])} namespaces, estimated cost {shard["cost"]}')
+    logger.info('Cloudwatch exporter configuration ready')
+    return exporters
+
+
+# Remove exporter configurations of shards and tiers that are no longer written, including cw_config itself when
+# no unsharded standard exporter is written
+def _remove_stale_cloudwatch_configs(cw_config, exporters):
+    config_dir = os.path.dirname(cw_config)
+    base, extension = os.path.splitext(os.path.basename(cw_config))
+    written = {os.path.basename(exporter['config']) for exporter in exporters}
+    for config_name in os.listdir(config_dir or '.'):
+        exporter_config = config_name == os.path.basename(cw_config) or (
+            config_name.startswith(f'{base}-') and config_name.endswith(extension))
+        if exporter_config and config_name not in written:
+            os.remove(os.path.join(config_dir, config_name))
+            logger.info(f'Removed stale exporter configuration {config_name}')
+
+
+# Fail on schema errors of a custom configuration, and rewrite its expensive patterns when enabled.
+# Expensive patterns, rewrites and the estimated requests are logged unless log is false
+def _lint_custom_config(custom_config_yaml, scrape_interval, inventory, log=True):
+    custom_config_yaml, report = config_lint.lint_config(custom_config_yaml, scrape_interval, inventory,
+                                                         REWRITE_CUSTOM_CONFIG)
+    if report['errors']:
+        raise ValueError(f'Invalid custom configuration: {"; ".join(report["errors"])}')
+    if log:
+        for finding in report['findings']:
+            where = f'metrics[{finding["index"]}] {finding["metric"]}' if finding['metric'] else 'configuration'
+            logger.warning(f'Custom configuration {where}: {finding["message"]}')
+        for rewrite in report['rewrites']:
+            logger.info(f'Rewrote custom configuration ({rewrite["rule"]}): {rewrite["change"]}')
+        logger.info(f'Custom configuration estimate: {report["before"]["api_calls"]} api calls and '
+                    f'{report["before"]["series"]} series per scrape' +
+                    (f', {report["after"]["api_calls"]} api calls and {report["after"]["series"]} series after '
+                     f'rewriting' if REWRITE_CUSTOM_CONFIG else ''))
+    return custom_config_yaml
+
+
+# Add custom cloudwatch exporter configuration, optionally together with built-in namespaces
+def _load_aws_custom_config(cw_config, cw_custom_path, namespaces=None, scrape_interval=None, inventory=None):
+    scrape_interval = scrape_interval or SCRAPE_INTERVAL
+    inventory = inventory or {}
+    custom_config_yaml = _lint_custom_config(_load_yaml(cw_custom_path), scrape_interval, inventory, log=False)
+    if USE_GET_METRIC_DATA:
+        custom_config_yaml.setdefault('use_get_metric_data', True)
+    if 'metrics' in custom_config_yaml:
+        metric_keys = {_metric_key(metric) for metric in custom_config_yaml['metrics']}
+        for namespace in namespaces or []:
+            _add_cloudwatch_namespace(namespace, custom_config_yaml, metric_keys)
+        _select_cloudwatch_resources(custom_config_yaml, inventory)
+        _merge_cloudwatch_metrics(custom_config_yaml, inventory)
+    exporters = _write_tiered_cloudwatch_config(custom_config_yaml, cw_config, None, scrape_interval, inventory)
+    logger.info('Custom configuration was assigned to cloudwatch exporter')
+    return exporters
 
 
 # Clean volume existing configuration
 def _init_configuration(cw_config, cw_raw_config, otel_config, otel_raw_config):
-    with open(cw_config, 'r+') as cloudwatch_file:
-        with open(cw_raw_config, 'r+') as raw_file:
-            raw_yaml = yaml.safe_load(raw_file)
-        _dump_and_close_file(raw_yaml, cloudwatch_file)
-    with open(otel_config, 'r+') as otel_file:
-        with open(otel_raw_config, 'r+') as raw_file:
-            raw_yaml = yaml.safe_load(raw_file)
-        _dump_and_close_file(raw_yaml, otel_file)
+    for config in (cw_config, otel_config):
+        if not os.path.isfile(config):
+            raise FileNotFoundError(f'Configuration file {config} does not exist')
+    _write_yaml_atomically(_load_yaml(cw_raw_config), cw_config)
+    _write_yaml_atomically(_load_yaml(otel_raw_config), otel_config)
+
+
+# Load the settings file, a mapping of environment variable names to values. A missing file has no settings
+def _load_settings(path):
+    if not os.path.isfile(path):
+        return {}
+    settings = _load_yaml(path) or {}
+    if not isinstance(settings, dict):
+        raise ValueError(f'Settings file {path} should be a mapping of environment variable names to values')
+    unknown = set(settings) - set(RELOADABLE_SETTINGS)
+    if unknown:
+        raise ValueError(f'Settings {", ".join(sorted(unknown))} in {path} cannot be reloaded, reloadable settings '
+                         f'are {", ".join(RELOADABLE_SETTINGS)}')
+    return settings
+
+
+# Allowlists of the namespaces of the exporters, None when allowlists are disabled
+def _load_metric_allowlists(exporters):
+    if not ENABLE_METRIC_ALLOWLISTS:
+        return None
+    namespaces = {namespace for exporter in exporters for namespace in exporter.get('namespaces') or {}}
+    allowlists = relabel.load_allowlists(namespaces)
+    allowed = sum(len(relabel.allowed_series(namespace, allowlist)) for namespace, allowlist in allowlists.items())
+    logger.info(f'Keeping {allowed} allowed series names of {len(allowlists)} namespaces with an allowlist, '
+                f'{len(namespaces) - len(allowlists)} namespaces without an allowlist are kept whole')
+    return allowlists
+
+
+# Build every configuration in a staging directory next to the live configuration and publish only the files whose
+# content changed, so a failed build leaves the last good configuration in place. The namespace definitions are
+# checked and the inventory is read once per build. Returns the exporters and the changed configuration paths
+@catalog.snapshot()
+def _build_configuration():
+    inventory = planner.load_inventory(INVENTORY_PATH)
+    namespaces, removed_namespaces = validate_input(inventory)
+    if removed_namespaces:
+        logger.warning(f'{removed_namespaces} namespaces are unsupported')
+    if namespaces:
+        _log_profiles(namespaces, inventory)
+    config_dir = os.path.dirname(CW_CONFIG)
+    staging_dir = tempfile.mkdtemp(dir=config_dir or '.', prefix='.staging-')
+    try:
+        cw_config = os.path.join(staging_dir, os.path.basename(CW_CONFIG))
+        otel_config = os.path.join(staging_dir, os.path.basename(OTEL_CONFIG))
+        with _timed_phase('Configuration init'):
+            for config in (cw_config, otel_config):
+                open(config, 'w').close()
+            _init_configuration(cw_config, CW_RAW_CONFIG, otel_config, OTEL_RAW_CONFIG)
+        with _timed_phase('Cloudwatch configuration'):
+            if CUSTOM_CONFIG_PATH:
+                if len(AWS_REGIONS) > 1 or len(AWS_ROLE_ARNS) > 1 or EXPORTER_REPLICAS > 1:
+                    logger.warning('Sharding is not supported with a custom configuration, using a single exporter')
+                exporters = _load_aws_custom_config(cw_config, CUSTOM_CW_PATH, namespaces, inventory=inventory)
+            else:
+                shards = sharding.plan_shards(AWS_REGIONS, AWS_ROLE_ARNS, namespaces, EXPORTER_REPLICAS,
+                                              lambda namespace: _namespace_cost(namespace, inventory))
+                exporters = _add_sharded_cloudwatch_config(shards, cw_config, SCRAPE_INTERVAL, inventory)
+            # Sharded builds, and tiered builds without a standard tier, do not write cw_config. It still holds the
+            # raw template, which is not a configuration to publish
+            if cw_config not in {exporter['config'] for exporter in exporters}:
+                os.remove(cw_config)
+            _check_scrape_plans(exporters, STRICT_SCRAPE_PLAN)
+        with _timed_phase('Opentelemtry configuration'):
+            otel_tuning_settings = None
+            if OTEL_TUNING_PRESET:
+                otel_tuning_settings = _get_tuning(exporters)
+            send_queue = _get_send_queue(exporters, otel_tuning_settings) if OTEL_SEND_QUEUE else None
+            scrape_jobs = scrape_jobs_config.aws_jobs(exporters, _load_metric_allowlists(exporters))
+            if SCRAPE_BUILDER_METRICS:
+                scrape_jobs.append(scrape_jobs_config.builder)
+            _update_otel_config(LOGZIO_TOKEN, REGION, P8S_LOGZIO_NAME, otel_config, scrape_jobs,
+                                otel_tuning_settings, OTEL_DROP_LOGGING_EXPORTER, send_queue)
+        changed = watch.publish_changed(staging_dir, config_dir or '.')
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    for exporter in exporters:
+        exporter['config'] = os.path.join(config_dir, os.path.basename(exporter['config']))
+    _remove_stale_cloudwatch_configs(CW_CONFIG, exporters)
+    telemetry.record_build(exporters, [exporter['config'] for exporter in exporters] + [OTEL_CONFIG])
+    telemetry.write_build_metrics(BUILD_METRICS_PATH)
+    logger.info(f'{len(changed)} configuration file(s) changed')
+    return exporters, changed
+
+
+# Ask the exporters and the collector whose configuration changed to reload it
+def _reload_services(exporters, changed):
+    for exporter in exporters:
+        if exporter['config'] in changed:
+            watch.post_reload(f'http://{exporter["target"]}{EXPORTER_RELOAD_PATH}')
+    if OTEL_CONFIG in changed:
+        if COLLECTOR_RELOAD_URL:
+            watch.post_reload(COLLECTOR_RELOAD_URL)
+        else:
+            logger.warning('Opentelemtry collector configuration changed, restart the collector or set '
+                           'COLLECTOR_RELOAD_URL to apply it')
+
+
+# Apply the settings file, rebuild the configuration and reload the services whose configuration changed.
+# If anything fails the previous settings are restored and the configuration files stay as they were.
+# Returns the changed configuration paths
+def _reload_configuration():
+    previous = {name: globals()[name] for name, _ in RELOADABLE_SETTINGS.values()}
+    try:
+        if SETTINGS_PATH:
+            _apply_settings(_load_settings(SETTINGS_PATH))
+        exporters, changed = _build_configuration()
+    except Exception:
+        globals().update(previous)
+        logger.exception('Regenerating the configuration failed, keeping the last good configuration')
+        return []
+    _mark_ready(exporters)
+    _reload_services(exporters, changed)
+    return changed
+
+
+# Write the readiness marker, with the time of the build and the configuration files it wrote
+def _mark_ready(exporters):
+    ready = {'generated_at': datetime.now(timezone.utc).isoformat(),
+             'configs': [exporter['config'] for exporter in exporters] + [OTEL_CONFIG]}
+    with files.atomic_write(READY_PATH) as ready_file:
+        json.dump(ready, ready_file)
+    logger.info(f'Configuration is ready, wrote {READY_PATH}')
+
+
+# Remove the readiness marker of a previous run, so containers waiting for it do not start on a stale configuration
+def _clear_ready():
+    if os.path.isfile(READY_PATH):
+        os.remove(READY_PATH)
+
+
+# Regenerate the configuration in the background whenever the custom configuration, the settings file or the
+# inventory changes
+def _start_watching():
+    paths = [path for path in (CUSTOM_CW_PATH if CUSTOM_CONFIG_PATH else '', SETTINGS_PATH, INVENTORY_PATH) if path]
+    logger.info(f'Watching {", ".join(paths)} every {WATCH_INTERVAL}s')
+    thread = threading.Thread(target=watch.watch, args=(paths, WATCH_INTERVAL, _reload_configuration), daemon=True)
+    thread.start()
+    return thread
+
+
+# Expose api endpoints with gunicorn threaded workers. Flask and gunicorn are only imported here, so a build only
+# run does not load them
+def _expose_configuration():
+    from util import api, server
+    server.run(api.app)
 
 
-# Expose api endpoints using flask
-def _expose_configuration():
-    os.environ['WERKZEUG_RUN_MAIN'] = 'true'
-    api.app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-    api.app.run(host='0.0.0.0', port=5001)
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Build the cloudwatch exporter and opentelemetry collector '
+                                                 'configuration and serve the config api')
+    parser.add_argument('--build-only', action='store_true',
+                        help='Write the configuration and the readiness marker without serving the config api. '
+                             'Exits after the build unless WATCH_CONFIGURATION is true')
+    return parser.parse_args(args)
+
+
+# A build only run does not serve the config api, so the collector only scrapes the builder metrics when
+# SCRAPE_BUILDER_METRICS is set explicitly, for a config api running separately
+def _apply_build_only(build_only):
+    global SCRAPE_BUILDER_METRICS
+    if build_only and 'SCRAPE_BUILDER_METRICS' not in os.environ:
+        SCRAPE_BUILDER_METRICS = False
 
 
 if __name__ == '__main__':
-    AWS_NAMESPACES, removed_namespaces = validate_input()
-    if removed_namespaces:
-        logger.warning(f'{removed_namespaces} namespaces are unsupported')
-    _init_configuration(CW_CONFIG, CW_RAW_CONFIG, OTEL_CONFIG, OTEL_RAW_CONFIG)
-    _update_otel_config(LOGZIO_TOKEN, REGION, P8S_LOGZIO_NAME, OTEL_CONFIG)
-    if CUSTOM_CONFIG_PATH:
-        _load_aws_custom_config(CW_CONFIG, "configuration/custom/cloudwatch.yml")
-    else:
-        _add_cloudwatch_config(AWS_NAMESPACES, CW_CONFIG, AWS_REGION, SCRAPE_INTERVAL, AWS_ROLE_ARN)
-    _expose_configuration()
+    args = _parse_args()
+    _apply_build_only(args.build_only)
+    _clear_ready()
+    if SETTINGS_PATH:
+        _apply_settings(_load_settings(SETTINGS_PATH))
+    exporters, _ = _build_configuration()
+    _mark_ready(exporters)
+    watcher = _start_watching() if WATCH_CONFIGURATION else None
+    if not args.build_only:
+        _expose_configuration()
+    elif watcher:
+        watcher.join()
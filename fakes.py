@@ -0,0 +1,146 @@
+"""
+This module runs local stand-ins for the services the generated configuration talks to, so it can be exercised
+offline: a prometheus remote write receiver in place of the Logz.io listener, one that stalls like a listener outage,
+and a /metrics target in place of the cloudwatch exporter. It is used by benchmark.py and tests.py only, and is not
+part of the builder image
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# A local http server running in a background thread, usable as a context manager
+class _FakeServer:
+    handler = _QuietHandler
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.httpd.server_address[:2])
+
+    @property
+    def url(self):
+        return f'http://{self.address}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _RemoteWriteHandler(_QuietHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(self.server.fake.respond(body, self.headers))
+        self.end_headers()
+
+
+# Accepts prometheus remote write requests and counts them. Bodies are snappy compressed protobuf, which is not
+# decoded, so throughput is measured in requests and bytes
+class FakeRemoteWriteReceiver(_FakeServer):
+    handler = _RemoteWriteHandler
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.requests = 0
+        self.bytes = 0
+        self.authorization = None
+        self.first_request_at = None
+
+    def record(self, body, headers):
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(body)
+            self.authorization = headers.get('Authorization')
+            if self.first_request_at is None:
+                self.first_request_at = time.monotonic()
+
+    # Status code of a remote write request
+    def respond(self, body, headers):
+        self.record(body, headers)
+        return 204
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'bytes': self.bytes}
+
+
+# A remote write receiver that stalls like a slow or unreachable listener: while stalled, each request is held for
+# hold_seconds and then rejected with a 503, which the collector retries. Requests are accepted again after resume
+class StallingRemoteWriteReceiver(FakeRemoteWriteReceiver):
+    def __init__(self, hold_seconds=1.0, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.hold_seconds = hold_seconds
+        self.rejected = 0
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def stall(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def respond(self, body, headers):
+        if not self.resumed.wait(self.hold_seconds):
+            with self.lock:
+                self.rejected += 1
+            return 503
+        return super().respond(body, headers)
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats['rejected'] = self.rejected
+        return stats
+
+
+class _MetricsHandler(_QuietHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.fake.scrape()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Serves a /metrics page with a fixed number of series, shaped like the cloudwatch exporter output
+class FakeMetricsTarget(_FakeServer):
+    handler = _MetricsHandler
+
+    def __init__(self, series, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.series = series
+        self.scrapes = 0
+
+    def scrape(self):
+        with self.lock:
+            self.scrapes += 1
+            scrape = self.scrapes
+        return ''.join(f'aws_synthetic_metric{i % 100}_average{{instance_id="i-{i:08d}"}} {scrape + i}\n'
+                       for i in range(self.series)).encode()
@@ -1,8 +1,25 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
 import yaml
+import benchmark
 import builder
+import fakes
 import util.input_validator as iv
-from util.data import aws_namespaces as ns_list
+from util import api, catalog, config_lint, data, documents, files, metric_merge, otel_tuning, planner, profiles, \
+    relabel, resource_select, scrape_jobs_config, sharding, telemetry, tiers, watch
+
+ns_list = catalog.get_namespaces()
 
 
 class TestBuilder(unittest.TestCase):
@@ -39,6 +56,79 @@ class TestBuilder(unittest.TestCase):
         except Exception as e:
             self.fail(f'Unexpected error {e}')
 
+    def test_update_otel_config_tuning(self):
+        tmp_dir = tempfile.mkdtemp()
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        shutil.copy(builder.OTEL_RAW_CONFIG, otel_config)
+        builder._update_otel_config(builder.LOGZIO_TOKEN, builder.REGION, builder.P8S_LOGZIO_NAME, otel_config,
+                                    tuning=otel_tuning.get_tuning('low-memory', 5000), drop_logging=True)
+        with open(otel_config, 'r') as otel_file:
+            otel_yaml = yaml.safe_load(otel_file)
+        # Equal
+        self.assertEqual(otel_yaml['service']['pipelines']['metrics']['processors'], ['memory_limiter', 'batch'])
+        self.assertEqual(otel_yaml['service']['pipelines']['metrics']['exporters'], ['prometheusremotewrite'])
+        self.assertNotIn('logging', otel_yaml['exporters'])
+        self.assertEqual(otel_yaml['processors']['batch']['send_batch_size'], 500)
+        self.assertTrue(otel_yaml['exporters']['prometheusremotewrite']['sending_queue']['enabled'])
+        # Equal - newer collectors take the queue as remote_write_queue
+        shutil.copy(builder.OTEL_RAW_CONFIG, otel_config)
+        with mock.patch.object(builder, 'OTEL_COLLECTOR_VERSION', '0.88.0'):
+            builder._update_otel_config(builder.LOGZIO_TOKEN, builder.REGION, builder.P8S_LOGZIO_NAME, otel_config,
+                                        tuning=otel_tuning.get_tuning('low-memory', 5000))
+        with open(otel_config, 'r') as otel_file:
+            exporter = yaml.safe_load(otel_file)['exporters']['prometheusremotewrite']
+        self.assertNotIn('sending_queue', exporter)
+        self.assertTrue(exporter['remote_write_queue']['enabled'])
+        shutil.rmtree(tmp_dir)
+
+    def test_get_tuning(self):
+        exporters = [{'series': 70, 'scrape_interval': builder.SCRAPE_INTERVAL}]
+        with mock.patch.object(builder, 'OTEL_TUNING_PRESET', 'low-latency'):
+            # Equal - without an inventory the series are not estimated
+            with mock.patch.object(builder, 'INVENTORY_PATH', ''):
+                self.assertEqual(builder._get_tuning(exporters), otel_tuning.get_tuning('low-latency'))
+            with mock.patch.object(builder, 'INVENTORY_PATH', './tests_resources/inventory.yaml'):
+                self.assertEqual(builder._get_tuning(exporters), otel_tuning.get_tuning('low-latency', 70))
+
+    def test_update_otel_config_send_queue(self):
+        tmp_dir = tempfile.mkdtemp()
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        shutil.copy(builder.OTEL_RAW_CONFIG, otel_config)
+        exporters = [{'series': 100000, 'scrape_interval': builder.SCRAPE_INTERVAL},
+                     {'series': 100, 'scrape_interval': 3600}]
+        with mock.patch.object(builder, 'OTEL_SEND_QUEUE', 'file'), \
+                mock.patch.object(builder, 'OTEL_COLLECTOR_VERSION', '0.88.0'):
+            send_queue = builder._get_send_queue(exporters)
+            builder._update_otel_config(builder.LOGZIO_TOKEN, builder.REGION, builder.P8S_LOGZIO_NAME, otel_config,
+                                        send_queue=send_queue)
+        with open(otel_config, 'r') as otel_file:
+            exporter = yaml.safe_load(otel_file)['exporters']['prometheusremotewrite']
+        # Equal
+        self.assertEqual(exporter['wal']['directory'], builder.OTEL_QUEUE_DIRECTORY)
+        self.assertEqual(exporter['remote_write_queue'], send_queue['queue'])
+        self.assertNotIn('sending_queue', exporter)
+        self.assertEqual(exporter['retry_on_failure']['max_elapsed_time'], f'{builder.OTEL_QUEUE_OUTAGE_SECONDS}s')
+        shutil.rmtree(tmp_dir)
+
+    def test_get_send_queue(self):
+        exporters = [{'series': 50000, 'scrape_interval': builder.SCRAPE_INTERVAL}]
+        tuning = otel_tuning.get_tuning('low-memory', 50000)
+        with mock.patch.object(builder, 'OTEL_SEND_QUEUE', 'memory'), \
+                mock.patch.object(builder, 'INVENTORY_PATH', ''), mock.patch.object(builder, 'logger') as logger:
+            send_queue = builder._get_send_queue(exporters, tuning)
+        # Equal - the queue keeps the tuned consumers and fits in the memory limiter headroom
+        self.assertEqual(send_queue['queue']['num_consumers'], tuning['sending_queue']['num_consumers'])
+        self.assertLessEqual(send_queue['memory_mib'], otel_tuning.get_queue_headroom_mib(tuning))
+        # Equal - without an inventory the absorbed outage is not estimated
+        self.assertFalse(any('absorbs a listener outage of' in call.args[0] for call in logger.info.call_args_list))
+        logger.warning.assert_not_called()
+        with mock.patch.object(builder, 'OTEL_SEND_QUEUE', 'memory'), \
+                mock.patch.object(builder, 'INVENTORY_PATH', './tests_resources/inventory.yaml'), \
+                mock.patch.object(builder, 'logger') as logger:
+            builder._get_send_queue(exporters, tuning)
+        self.assertTrue(any('absorbs a listener outage of' in call.args[0] for call in logger.info.call_args_list))
+        logger.warning.assert_called_once()
+
     def test_load_aws_custom_config(self):
         # Fail FileNotFoundError
         self.assertRaises(FileNotFoundError,
@@ -64,15 +154,333 @@ class TestBuilder(unittest.TestCase):
         test_file.close()
 
     def test_add_cloudwatch_namespace(self):
-        # Fail FileNotFoundError
-        self.assertRaises(FileNotFoundError,
-                          builder._add_cloudwatch_namespace, 'AWS/EC2', './wrong/path')
+        # Fail ValueError
+        self.assertRaises(ValueError,
+                          builder._add_cloudwatch_namespace, 'AWS/nosuch', {'metrics': []}, set())
         # Success
+        cloudwatch_yaml = {'metrics': []}
+        metric_keys = set()
         try:
             for ns in ns_list:
-                builder._add_cloudwatch_namespace(ns, builder.CW_CONFIG)
+                builder._add_cloudwatch_namespace(ns, cloudwatch_yaml, metric_keys)
         except Exception as e:
             self.fail(f'Unexpected error {e}')
+        # Equal - namespaces that were already added are skipped
+        metrics_count = len(cloudwatch_yaml['metrics'])
+        builder._add_cloudwatch_namespace('AWS/EC2', cloudwatch_yaml, metric_keys)
+        self.assertEqual(len(cloudwatch_yaml['metrics']), metrics_count)
+        self.assertEqual(len(metric_keys), metrics_count)
+
+    def test_namespace_profile(self):
+        with mock.patch.object(builder, 'STATISTICS_PROFILE', 'minimal'), \
+                mock.patch.object(builder, 'NAMESPACE_PROFILES', {'AWS/Lambda': 'full'}):
+            # Equal - a namespace profile overrides the global profile
+            self.assertEqual(builder._namespace_profile('EC2'), 'minimal')
+            self.assertEqual(builder._namespace_profile('AWS/Lambda'), 'full')
+            cloudwatch_yaml = {'metrics': []}
+            for namespace in ('AWS/EC2', 'AWS/Lambda'):
+                builder._add_cloudwatch_namespace(namespace, cloudwatch_yaml, set())
+        namespace_metrics = {}
+        for metric in cloudwatch_yaml['metrics']:
+            namespace_metrics.setdefault(metric['aws_namespace'].strip(), []).append(metric)
+        self.assertEqual(namespace_metrics['AWS/EC2'], profiles.get_namespace_metrics('AWS/EC2', 'minimal'))
+        self.assertTrue(all(m['aws_statistics'] == list(data.cloudwatch_statistics)
+                            for m in namespace_metrics['AWS/Lambda']))
+
+    def test_add_cloudwatch_config(self):
+        # Fail FileNotFoundError
+        self.assertRaises(FileNotFoundError,
+                          builder._add_cloudwatch_config, ['AWS/EC2'], './wrong/path', 'us-east-1', 300, '')
+        # Success
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        shutil.copy(builder.CW_RAW_CONFIG, cw_config)
+        with mock.patch.object(builder, 'ENABLE_SCRAPE_TIERS', True):
+            exporters = builder._add_cloudwatch_config(['AWS/EC2', 'AWS/S3'], cw_config, 'us-east-1', 300,
+                                                       'arn:role')
+        with open(cw_config, 'r') as cw_file:
+            cw_yaml = yaml.safe_load(cw_file)
+        self.assertEqual(cw_yaml['region'], 'us-east-1')
+        self.assertEqual(cw_yaml['period_seconds'], 300)
+        self.assertEqual(cw_yaml['role_arn'], 'arn:role')
+        self.assertEqual({m['aws_namespace'] for m in cw_yaml['metrics']}, {'AWS/EC2', 'AWS/S3'})
+        # Equal - duplicate entries are written once
+        self.assertEqual(len({builder._metric_key(m) for m in cw_yaml['metrics']}), len(cw_yaml['metrics']))
+        # Equal - daily metrics are written to their own tier configuration
+        self.assertEqual([(e['tier'], e['target']) for e in exporters],
+                         [('standard', 'cloudwatch-exporter:9106'), ('daily', 'cloudwatch-exporter-daily:9106')])
+        with open(os.path.join(tmp_dir, 'cloudwatch-daily.yml'), 'r') as cw_file:
+            daily_yaml = yaml.safe_load(cw_file)
+        self.assertEqual({m['aws_metric_name'] for m in daily_yaml['metrics']}, {'BucketSizeBytes', 'NumberOfObjects'})
+        self.assertEqual(daily_yaml['period_seconds'], 86400)
+        self.assertNotIn('tier', daily_yaml['metrics'][0])
+        shutil.rmtree(tmp_dir)
+
+    def test_get_metric_data(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        shutil.copy(builder.CW_RAW_CONFIG, cw_config)
+        with mock.patch.object(builder, 'USE_GET_METRIC_DATA', True), \
+                mock.patch.object(builder, 'INVENTORY_PATH', './tests_resources/inventory.yaml'):
+            # Fail ValueError - the pinned exporter does not support GetMetricData
+            with mock.patch.object(builder, 'CLOUDWATCH_EXPORTER_VERSION', '0.9.0'):
+                self.assertRaises(ValueError, builder.validate_input)
+            with mock.patch.object(builder, 'CLOUDWATCH_EXPORTER_VERSION', 'v0.11.0'):
+                builder.validate_input()
+            exporters = builder._add_cloudwatch_config(['AWS/EC2'], cw_config, 'us-east-1', 300, '',
+                                                       planner.load_inventory(builder.INVENTORY_PATH))
+        with open(cw_config, 'r') as cw_file:
+            cw_yaml = yaml.safe_load(cw_file)
+        # Equal - the statistics of the 120 instances of each metric are batched into a single request
+        self.assertTrue(cw_yaml['use_get_metric_data'])
+        self.assertEqual(exporters[0]['api_calls'], len(cw_yaml['metrics']) * 2)
+        shutil.rmtree(tmp_dir)
+
+    def test_add_sharded_cloudwatch_config(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        shutil.copy(builder.CW_RAW_CONFIG, cw_config)
+        open(os.path.join(tmp_dir, 'cloudwatch-stale-shard.yml'), 'w').close()
+        shards = sharding.plan_shards(['us-east-1', 'eu-west-1'],
+                                      ['arn:aws:iam::123456789012:role/a', 'arn:aws:iam::210987654321:role/b'],
+                                      ['AWS/EC2', 'AWS/Lambda', 'AWS/ELB'], 2,
+                                      lambda namespace: builder._namespace_cost(namespace, {}))
+        exporters = builder._add_sharded_cloudwatch_config(shards, cw_config, 300)
+        builder._remove_stale_cloudwatch_configs(cw_config, exporters)
+        # Equal
+        config_names = sorted(n for n in os.listdir(tmp_dir) if n.startswith('cloudwatch-'))
+        self.assertEqual(config_names, sorted(os.path.basename(e['config']) for e in exporters))
+        self.assertEqual(len(config_names), 8)
+        with open(os.path.join(tmp_dir, 'cloudwatch-eu-west-1-210987654321-0.yml'), 'r') as shard_file:
+            shard_yaml = yaml.safe_load(shard_file)
+        self.assertEqual(shard_yaml['region'], 'eu-west-1')
+        self.assertEqual(shard_yaml['role_arn'], 'arn:aws:iam::210987654321:role/b')
+        self.assertEqual({m['aws_namespace'] for m in shard_yaml['metrics']}, {'AWS/ELB'})
+        shutil.rmtree(tmp_dir)
+
+    def test_load_aws_custom_config_with_namespaces(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        custom_path = os.path.join(tmp_dir, 'custom.yml')
+        with open(custom_path, 'w') as custom_file:
+            yaml.dump({'region': 'us-east-1', 'metrics': [
+                {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+                 'aws_statistics': ['Maximum']}]}, custom_file)
+        builder._load_aws_custom_config(cw_config, custom_path, ['AWS/EC2'])
+        with open(cw_config, 'r') as cw_file:
+            cw_yaml = yaml.safe_load(cw_file)
+        # Equal - the custom entry and the built-in entry are merged
+        cpu = [m for m in cw_yaml['metrics'] if m['aws_metric_name'] == 'CPUUtilization']
+        self.assertEqual(len(cpu), 1)
+        self.assertEqual(cpu[0]['aws_statistics'], ['Maximum', 'Average'])
+        self.assertEqual(len([m for m in cw_yaml['metrics'] if m['aws_metric_name'] == 'CPUCreditUsage']), 1)
+        shutil.rmtree(tmp_dir)
+
+    def test_build_tiered_configuration(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        with mock.patch.object(builder, 'CW_CONFIG', cw_config), \
+                mock.patch.object(builder, 'OTEL_CONFIG', otel_config), \
+                mock.patch.object(builder, 'AWS_NAMESPACES', 'AWS/S3'), \
+                mock.patch.object(builder, 'ENABLE_SCRAPE_TIERS', True), \
+                mock.patch.object(builder, 'NAMESPACE_TIERS', {'AWS/S3': 'daily'}):
+            exporters, _ = builder._build_configuration()
+        # Equal - without a standard tier only the daily exporter configuration is written
+        self.assertEqual([e['tier'] for e in exporters], ['daily'])
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ['cloudwatch-daily.yml', 'otel.yml'])
+        with open(otel_config, 'r') as otel_file:
+            scrape_configs = yaml.safe_load(otel_file)['receivers']['prometheus']['config']['scrape_configs']
+        targets = [target for job in scrape_configs for config in job['static_configs'] for target in config['targets']]
+        self.assertNotIn('cloudwatch-exporter:9106', targets)
+        self.assertIn('cloudwatch-exporter-daily:9106', targets)
+        shutil.rmtree(tmp_dir)
+
+    def test_build_strict_scrape_plan(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        with mock.patch.object(builder, 'CW_CONFIG', cw_config), \
+                mock.patch.object(builder, 'OTEL_CONFIG', otel_config), \
+                mock.patch.object(builder, 'INVENTORY_PATH', './tests_resources/inventory.yaml'), \
+                mock.patch.object(builder, 'AWS_NAMESPACES', 'AWS/EC2'), \
+                mock.patch.object(builder, 'ENABLE_SCRAPE_TIERS', True), \
+                mock.patch.object(builder, 'NAMESPACE_TIERS', {'AWS/EC2': 'fast'}):
+            # Success - the standard scrape interval fits
+            with mock.patch.object(builder, 'NAMESPACE_TIERS', {}):
+                builder._build_configuration()
+            # Fail ValueError - the exporter of the fast tier cannot finish a scrape in 60s
+            with mock.patch.object(builder, 'STRICT_SCRAPE_PLAN', True):
+                self.assertRaises(ValueError, builder._build_configuration)
+            # Equal - a failed build publishes nothing
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['cloudwatch.yml', 'otel.yml'])
+            exporters, _ = builder._build_configuration()
+        self.assertEqual([e['tier'] for e in exporters], ['fast'])
+        self.assertFalse(exporters[0]['fits_scrape_interval'])
+        shutil.rmtree(tmp_dir)
+
+    def test_check_scrape_plans(self):
+        fits = planner.plan_namespaces(['AWS/EC2'], {}, 300)
+        exceeds = planner.plan_namespaces(['AWS/EC2'], planner.load_inventory('./tests_resources/inventory.yaml'), 60)
+        # Fail ValueError
+        self.assertRaises(ValueError, builder._check_scrape_plans, [fits, exceeds], True)
+        # Success
+        try:
+            builder._check_scrape_plans([fits, exceeds], False)
+        except ValueError as e:
+            self.fail(f'Unexpected error {e}')
+
+    def test_build_configuration(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        with mock.patch.object(builder, 'CW_CONFIG', cw_config), mock.patch.object(builder, 'OTEL_CONFIG', otel_config):
+            exporters, changed = builder._build_configuration()
+            # Equal - the first build publishes both files, an identical rebuild publishes nothing
+            self.assertEqual(sorted(changed), [cw_config, otel_config])
+            self.assertEqual([e['config'] for e in exporters], [cw_config])
+            with open(otel_config, 'r') as otel_file:
+                scrape_configs = yaml.safe_load(otel_file)['receivers']['prometheus']['config']['scrape_configs']
+            self.assertIn(scrape_jobs_config.builder, scrape_configs)
+            self.assertNotIn('metric_relabel_configs', scrape_configs[0])
+            mtime = os.stat(cw_config).st_mtime_ns
+            _, changed = builder._build_configuration()
+            self.assertEqual(changed, [])
+            self.assertEqual(os.stat(cw_config).st_mtime_ns, mtime)
+            with mock.patch.object(builder, 'OTEL_TUNING_PRESET', 'low-memory'):
+                _, changed = builder._build_configuration()
+            self.assertEqual(changed, [otel_config])
+            with mock.patch.object(builder, 'ENABLE_METRIC_ALLOWLISTS', True):
+                _, changed = builder._build_configuration()
+            # Equal - allowlists only change the collector configuration
+            self.assertEqual(changed, [otel_config])
+            with open(otel_config, 'r') as otel_file:
+                scrape_configs = yaml.safe_load(otel_file)['receivers']['prometheus']['config']['scrape_configs']
+            self.assertEqual(scrape_configs[0]['metric_relabel_configs'][0]['action'], 'keep')
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ['cloudwatch.yml', 'otel.yml'])
+        shutil.rmtree(tmp_dir)
+
+    def test_build_sharded_configuration(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        with mock.patch.object(builder, 'CW_CONFIG', cw_config), mock.patch.object(builder, 'OTEL_CONFIG', otel_config):
+            builder._build_configuration()
+            with mock.patch.object(builder, 'AWS_REGIONS', ['us-east-1', 'eu-west-1']), \
+                    mock.patch.object(builder, 'INVENTORY_PATH', './tests_resources/inventory.yaml'), \
+                    mock.patch.object(planner, 'load_inventory', wraps=planner.load_inventory) as load_inventory:
+                exporters, _ = builder._build_configuration()
+        # Equal - the inventory is read once per build
+        load_inventory.assert_called_once_with('./tests_resources/inventory.yaml')
+        # Equal - the unsharded configuration of the previous build is removed, the raw template is not published
+        self.assertEqual(sorted(os.listdir(tmp_dir)),
+                         sorted([os.path.basename(e['config']) for e in exporters] + ['otel.yml']))
+        self.assertEqual(len(exporters), 2)
+        self.assertNotIn('cloudwatch.yml', os.listdir(tmp_dir))
+        shutil.rmtree(tmp_dir)
+
+    def test_reload_configuration(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        otel_config = os.path.join(tmp_dir, 'otel.yml')
+        settings_path = os.path.join(tmp_dir, 'settings.yml')
+        with mock.patch.object(builder, 'CW_CONFIG', cw_config), \
+                mock.patch.object(builder, 'OTEL_CONFIG', otel_config), \
+                mock.patch.object(builder, 'READY_PATH', os.path.join(tmp_dir, '.ready')), \
+                mock.patch.object(builder, 'SETTINGS_PATH', settings_path), \
+                mock.patch.object(builder, 'AWS_NAMESPACES', builder.AWS_NAMESPACES), \
+                mock.patch.object(watch, 'post_reload') as post_reload:
+            builder._build_configuration()
+            with open(settings_path, 'w') as settings_file:
+                yaml.dump({'AWS_NAMESPACES': ['AWS/EC2']}, settings_file)
+            # Equal - only the exporter configuration changed, so only the exporter is reloaded
+            self.assertEqual(builder._reload_configuration(), [cw_config])
+            post_reload.assert_called_once_with('http://cloudwatch-exporter:9106/-/reload')
+            with open(cw_config, 'r') as cw_file:
+                good_config = cw_file.read()
+            with open(settings_path, 'w') as settings_file:
+                yaml.dump({'AWS_NAMESPACES': 'AWS/nosuch'}, settings_file)
+            # Equal - a failed regeneration keeps the last good settings and configuration
+            self.assertEqual(builder._reload_configuration(), [])
+            self.assertEqual(builder.AWS_NAMESPACES, 'AWS/EC2')
+            with open(cw_config, 'r') as cw_file:
+                self.assertEqual(cw_file.read(), good_config)
+            with open(settings_path, 'w') as settings_file:
+                yaml.dump({'SCRAPE_INTERVAL': 60}, settings_file)
+            # Fail ValueError
+            self.assertRaises(ValueError, builder._load_settings, settings_path)
+        shutil.rmtree(tmp_dir)
+
+    def test_apply_settings(self):
+        previous = {name: getattr(builder, name) for name, _ in builder.RELOADABLE_SETTINGS.values()}
+        environ = {'AWS_REGIONS': 'us-east-1, eu-west-1', 'ENABLE_SCRAPE_TIERS': 'TRUE', 'EXPORTER_REPLICAS': '2'}
+        try:
+            with mock.patch.dict(os.environ, environ):
+                builder._apply_settings({'EXPORTER_REPLICAS': 3, 'AWS_NAMESPACE_TIERS': {'AWS/S3': 'daily'}})
+            # Equal - the settings file overrides the environment variables
+            self.assertEqual(builder.AWS_REGIONS, ['us-east-1', 'eu-west-1'])
+            self.assertTrue(builder.ENABLE_SCRAPE_TIERS)
+            self.assertEqual(builder.EXPORTER_REPLICAS, 3)
+            self.assertEqual(builder.NAMESPACE_TIERS, {'AWS/S3': 'daily'})
+            self.assertEqual(builder.AWS_ROLE_ARNS, [builder.AWS_ROLE_ARN])
+        finally:
+            for name, value in previous.items():
+                setattr(builder, name, value)
+
+    def test_mark_ready(self):
+        tmp_dir = tempfile.mkdtemp()
+        ready_path = os.path.join(tmp_dir, '.ready')
+        with mock.patch.object(builder, 'READY_PATH', ready_path):
+            builder._mark_ready([{'config': builder.CW_CONFIG}])
+            with open(ready_path, 'r') as ready_file:
+                ready = json.load(ready_file)
+            # Equal
+            self.assertEqual(ready['configs'], [builder.CW_CONFIG, builder.OTEL_CONFIG])
+            builder._clear_ready()
+            self.assertFalse(os.path.exists(ready_path))
+            builder._clear_ready()
+        # Equal
+        self.assertTrue(builder._parse_args(['--build-only']).build_only)
+        self.assertFalse(builder._parse_args([]).build_only)
+        shutil.rmtree(tmp_dir)
+
+    def test_apply_build_only(self):
+        environ = {k: v for k, v in os.environ.items() if k != 'SCRAPE_BUILDER_METRICS'}
+        with mock.patch.object(builder, 'SCRAPE_BUILDER_METRICS', True), \
+                mock.patch.dict(os.environ, environ, clear=True):
+            builder._apply_build_only(False)
+            # Equal
+            self.assertTrue(builder.SCRAPE_BUILDER_METRICS)
+            builder._apply_build_only(True)
+            self.assertFalse(builder.SCRAPE_BUILDER_METRICS)
+        with mock.patch.object(builder, 'SCRAPE_BUILDER_METRICS', True), \
+                mock.patch.dict(os.environ, {'SCRAPE_BUILDER_METRICS': 'true'}):
+            builder._apply_build_only(True)
+            # Equal - set explicitly for a separate config api
+            self.assertTrue(builder.SCRAPE_BUILDER_METRICS)
+
+    def test_build_only_imports(self):
+        tmp_dir = tempfile.mkdtemp()
+        shutil.copytree('configuration_raw', os.path.join(tmp_dir, 'configuration_raw'))
+        shutil.copytree(catalog.NAMESPACES_DIR, os.path.join(tmp_dir, 'cw_namespaces'),
+                        ignore=shutil.ignore_patterns('*.json'))
+        os.makedirs(os.path.join(tmp_dir, 'configuration'))
+        env = {'PATH': os.environ.get('PATH', ''), 'PYTHONPATH': os.getcwd(), 'SCRAPE_INTERVAL': '300',
+               'LOGZIO_REGION': 'us', 'LOGZIO_TOKEN': 'TOKENtokenTOKENtokenTOKENtokenTO',
+               'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_NAMESPACES': 'AWS/EC2', 'CUSTOM_CONFIG_PATH': '',
+               'P8S_LOGZIO_NAME': 'test', 'CUSTOM_LISTENER': '', 'AWS_ROLE_ARN': '', 'LOGZIO_LOG_LEVEL': 'WARNING'}
+        script = ('import runpy, sys\n'
+                  'sys.argv = ["builder.py", "--build-only"]\n'
+                  f'runpy.run_path({os.path.abspath("builder.py")!r}, run_name="__main__")\n'
+                  'print(",".join(sorted({m.split(".")[0] for m in sys.modules} & {"flask", "gunicorn"})))\n')
+        process = subprocess.run([sys.executable, '-c', script], cwd=tmp_dir, env=env, capture_output=True,
+                                 timeout=120)
+        # Success
+        self.assertEqual(process.returncode, 0, process.stderr.decode())
+        self.assertTrue(os.path.isfile(os.path.join(tmp_dir, builder.READY_PATH)))
+        # Equal - flask and gunicorn are only loaded to serve the config api
+        self.assertEqual(process.stdout.decode().strip(), '')
+        shutil.rmtree(tmp_dir)
 
     def test_get_listener_url(self):
         if not builder.CUSTOM_LISTENER:
@@ -88,6 +496,964 @@ class TestBuilder(unittest.TestCase):
             self.assertEqual(builder._get_listener_url('usa'), builder.CUSTOM_LISTENER)
 
 
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.namespaces_dir = os.path.join(self.tmp_dir, 'cw_namespaces')
+        shutil.copytree(catalog.NAMESPACES_DIR, self.namespaces_dir, ignore=shutil.ignore_patterns('*.json'))
+        self.catalog_path = os.path.join(self.namespaces_dir, 'catalog.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compile_catalog(self):
+        compiled = catalog.compile_catalog(self.namespaces_dir)
+        # Equal
+        self.assertEqual(len(compiled['namespaces']),
+                         len([name for name in os.listdir(self.namespaces_dir) if name.endswith('.yml')]))
+        self.assertIn('AWS/EC2', compiled['index']['metric']['CPUUtilization'])
+        self.assertIn(['AWS/EC2', 'CPUUtilization'], compiled['index']['dimension']['InstanceId'])
+        self.assertIn(['AWS/EC2', 'StatusCheckFailed'], compiled['index']['statistic']['Sum'])
+
+    def test_load_catalog(self):
+        # Fail FileNotFoundError
+        self.assertRaises(FileNotFoundError, catalog.build_catalog, self.namespaces_dir, '/wrong/path/catalog.json')
+        # Success - the compiled catalog is written and reused
+        loaded = catalog.load_catalog(self.namespaces_dir, self.catalog_path)
+        self.assertTrue(os.path.isfile(self.catalog_path))
+        self.assertEqual(loaded['source_hash'], catalog.source_hash(self.namespaces_dir))
+        # Equal - changing a namespace definition invalidates the catalog
+        with open(os.path.join(self.namespaces_dir, 'Custom.yml'), 'w') as custom_file:
+            yaml.dump([{'aws_namespace': 'AWS/Custom', 'aws_metric_name': 'Requests',
+                        'aws_dimensions': ['Name'], 'aws_statistics': ['Sum']}], custom_file)
+        reloaded = catalog.load_catalog(self.namespaces_dir, self.catalog_path)
+        self.assertIn('AWS/Custom', reloaded['namespaces'])
+        self.assertNotEqual(reloaded['source_hash'], loaded['source_hash'])
+
+    def test_snapshot(self):
+        catalog.load_catalog(self.namespaces_dir, self.catalog_path)
+        custom_path = os.path.join(self.namespaces_dir, 'Custom.yml')
+        with catalog.snapshot(self.namespaces_dir, self.catalog_path):
+            with open(custom_path, 'w') as custom_file:
+                yaml.dump([{'aws_namespace': 'AWS/Custom', 'aws_metric_name': 'Requests'}], custom_file)
+            # Equal - definitions are not checked again during a snapshot
+            self.assertNotIn('AWS/Custom', catalog.load_catalog(self.namespaces_dir, self.catalog_path)['namespaces'])
+        self.assertIn('AWS/Custom', catalog.load_catalog(self.namespaces_dir, self.catalog_path)['namespaces'])
+
+    def test_catalog_lookups(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, catalog.get_namespace_metrics, 'AWS/nosuch')
+        # Equal
+        self.assertEqual(catalog.get_namespace_metrics('EC2'), catalog.get_namespace_metrics('AWS/EC2'))
+        self.assertIn('AWS/EC2', catalog.namespaces_with_metric('CPUUtilization'))
+        self.assertIn(('AWS/EBS', 'VolumeReadBytes'), catalog.metrics_with_dimension('VolumeId'))
+        self.assertIn(('AWS/EC2', 'CPUUtilization'), catalog.metrics_with_statistic('Average'))
+
+
+class TestSharding(unittest.TestCase):
+    def test_get_account(self):
+        # Equal
+        self.assertEqual(sharding.get_account(''), sharding.DEFAULT_ACCOUNT)
+        self.assertEqual(sharding.get_account('arn:aws:iam::123456789012:role/metrics'), '123456789012')
+        self.assertEqual(sharding.get_account('arn:aws-us-gov:iam::123456789012:role/metrics'), '123456789012')
+        self.assertEqual(sharding.get_account('Some Role'), 'some-role')
+        self.assertEqual(sharding.get_role_name('arn:aws:iam::123456789012:role/team/Metrics_Reader'),
+                         'metrics-reader')
+
+    def test_split_namespaces(self):
+        costs = {'a': 10, 'b': 7, 'c': 5, 'd': 3, 'e': 1}
+        buckets = sharding.split_namespaces(list(costs), 2, costs.get)
+        # Equal
+        self.assertEqual(sorted(b['cost'] for b in buckets), [13, 13])
+        self.assertEqual(sorted(ns for b in buckets for ns in b['namespaces']), sorted(costs))
+        self.assertEqual(len(sharding.split_namespaces(['a'], 3, costs.get)), 1)
+
+    def test_plan_shards(self):
+        # Equal - a single shard keeps the unsharded configuration and target
+        shards = sharding.plan_shards(['us-east-1'], [''], ['AWS/EC2', 'AWS/S3'], 1, lambda ns: 1)
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(shards[0]['id'], '')
+        self.assertEqual(sharding.get_config_path('./configuration/cloudwatch.yml', shards[0]['id'], ''),
+                         './configuration/cloudwatch.yml')
+        self.assertEqual(sharding.get_target(shards[0]['id']), 'cloudwatch-exporter:9106')
+        # Equal
+        shards = sharding.plan_shards(['us-east-1', 'eu-west-1'], ['arn:aws:iam::123456789012:role/a'],
+                                      ['AWS/EC2', 'AWS/S3'], 2, lambda ns: 1)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards[0]['id'], 'us-east-1-123456789012-0')
+        self.assertEqual(sharding.get_config_path('./configuration/cloudwatch.yml', shards[0]['id'], 'fast'),
+                         './configuration/cloudwatch-us-east-1-123456789012-0-fast.yml')
+        self.assertEqual(sharding.get_target(shards[0]['id'], 'fast'),
+                         'cloudwatch-exporter-us-east-1-123456789012-0-fast:9106')
+        # Equal - roles of the same account get a shard each, named after the role
+        shards = sharding.plan_shards(['us-east-1'], ['arn:aws:iam::123456789012:role/a',
+                                                      'arn:aws:iam::123456789012:role/b',
+                                                      'arn:aws:iam::123456789012:role/a'], ['AWS/EC2'], 1, lambda ns: 1)
+        self.assertEqual([shard['id'] for shard in shards],
+                         ['us-east-1-123456789012-a-0', 'us-east-1-123456789012-b-0'])
+        self.assertEqual({shard['account'] for shard in shards}, {'123456789012'})
+
+
+class TestFiles(unittest.TestCase):
+    def test_atomic_write(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'config.yml')
+        with files.atomic_write(path) as config_file:
+            config_file.write('a: 1\n')
+        # Fail - the target keeps its content and the temporary file is removed
+        with self.assertRaises(ValueError):
+            with files.atomic_write(path) as config_file:
+                config_file.write('a: 2\n')
+                raise ValueError()
+        # Equal
+        with open(path, 'r') as config_file:
+            self.assertEqual(config_file.read(), 'a: 1\n')
+        self.assertEqual(os.listdir(tmp_dir), ['config.yml'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        shutil.rmtree(tmp_dir)
+
+
+class TestWatch(unittest.TestCase):
+    def test_publish_changed(self):
+        staging_dir, target_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        for directory, content in ((staging_dir, 'same'), (target_dir, 'same')):
+            with open(os.path.join(directory, 'same.yml'), 'w') as same_file:
+                same_file.write(content)
+        with open(os.path.join(staging_dir, 'new.yml'), 'w') as new_file:
+            new_file.write('new')
+        # Equal
+        self.assertEqual(watch.publish_changed(staging_dir, target_dir), [os.path.join(target_dir, 'new.yml')])
+        self.assertEqual(sorted(os.listdir(target_dir)), ['new.yml', 'same.yml'])
+        self.assertEqual(watch.file_hash(os.path.join(staging_dir, 'new.yml')), None)
+        shutil.rmtree(staging_dir)
+        shutil.rmtree(target_dir)
+
+    def test_watch(self):
+        tmp_dir = tempfile.mkdtemp()
+        watched = os.path.join(tmp_dir, 'settings.yml')
+        stop_event = threading.Event()
+
+        def on_change():
+            stop_event.set()
+            raise ValueError('errors are logged')
+
+        thread = threading.Thread(target=watch.watch, args=([watched], 0.01, on_change, stop_event), daemon=True)
+        thread.start()
+        for size in range(100):
+            with open(watched, 'w') as watched_file:
+                watched_file.write('x' * size)
+            if stop_event.wait(0.05):
+                break
+        thread.join(5)
+        # Equal
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(stop_event.is_set())
+        shutil.rmtree(tmp_dir)
+
+
+class TestDocuments(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = {'otel': os.path.join(self.tmp_dir, 'otel.yml')}
+        self._write(b'exporters: {}\n')
+        self.store = documents.DocumentStore(lambda: dict(self.paths), poll_interval=0.01, history_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, raw):
+        tmp_path = f'{self.paths["otel"]}.tmp'
+        with open(tmp_path, 'wb') as document_file:
+            document_file.write(raw)
+        os.replace(tmp_path, self.paths['otel'])
+
+    def test_refresh(self):
+        # Equal
+        self.assertTrue(self.store.refresh())
+        self.assertFalse(self.store.refresh())
+        first = self.store.versions()['otel']
+        self.assertEqual(first, documents.content_version(b'exporters: {}\n'))
+        for raw in (b'exporters: {a: 1}\n', b'exporters: {a: 2}\n'):
+            self._write(raw)
+            self.assertTrue(self.store.refresh())
+        self.assertEqual(self.store.get('otel')[1], b'exporters: {a: 2}\n')
+        self.assertIsNone(self.store.get('otel', first))
+        self.assertIsNone(self.store.get('nosuch'))
+        # Equal - rewriting the same content keeps the version
+        self._write(b'exporters: {a: 2}\n')
+        self.assertFalse(self.store.refresh())
+        os.remove(self.paths['otel'])
+        self.assertTrue(self.store.refresh())
+        self.assertEqual(self.store.versions(), {})
+
+    def test_wait(self):
+        self.store.refresh()
+        version = self.store.versions()['otel']
+        # Equal - no new version before the timeout
+        self.assertEqual(self.store.wait('otel', {version}, 0.05), version)
+        self.assertIsNone(self.store.wait('nosuch', {version}, 5))
+        self.assertEqual(self.store.wait('otel', {version}, float('nan')), version)
+        # Equal - the poller wakes the waiting request
+        timer = threading.Timer(0.05, self._write, (b'exporters: {a: 1}\n',))
+        timer.start()
+        self.assertEqual(self.store.wait('otel', {version}, 5), documents.content_version(b'exporters: {a: 1}\n'))
+        timer.join()
+
+    def test_watch(self):
+        self.store.refresh()
+        changes = self.store.watch(0.05)
+        # Equal
+        self.assertEqual(next(changes), self.store.versions())
+        self.assertEqual(next(changes), {})
+        self.paths['cloudwatch'] = os.path.join(self.tmp_dir, 'cloudwatch.yml')
+        shutil.copy(builder.CW_RAW_CONFIG, self.paths['cloudwatch'])
+        self.store.refresh()
+        self.assertEqual(next(changes), {'cloudwatch': self.store.versions()['cloudwatch']})
+        os.remove(self.paths['otel'])
+        self.store.refresh()
+        self.assertEqual(next(changes), {'otel': None})
+
+
+class TestScrapeJobs(unittest.TestCase):
+    def test_aws_jobs(self):
+        shard = {'id': 'eu-west-1-123456789012-0', 'region': 'eu-west-1', 'account': '123456789012'}
+        # Equal - a single standard exporter keeps the default scrape job
+        self.assertEqual(scrape_jobs_config.aws_jobs([{'shard': None, 'tier': 'standard', 'scrape_interval': 300,
+                                                       'target': 'cloudwatch-exporter:9106'}]),
+                         [scrape_jobs_config.aws])
+        # Equal
+        jobs = scrape_jobs_config.aws_jobs([
+            {'shard': shard, 'tier': 'standard', 'scrape_interval': 300, 'target': 'exporter-a:9106'},
+            {'shard': shard, 'tier': 'fast', 'scrape_interval': 60, 'target': 'exporter-a-fast:9106'},
+            {'shard': dict(shard, id='eu-west-1-123456789012-1'), 'tier': 'standard', 'scrape_interval': 300,
+             'target': 'exporter-b:9106'}])
+        self.assertEqual([job['job_name'] for job in jobs],
+                         ['logzio-cloudwatch-metrics', 'logzio-cloudwatch-metrics-fast'])
+        self.assertEqual([c['targets'] for c in jobs[0]['static_configs']], [['exporter-a:9106'], ['exporter-b:9106']])
+        self.assertEqual(jobs[1]['scrape_interval'], '60s')
+        self.assertEqual(jobs[1]['scrape_timeout'], '60s')
+        self.assertEqual(jobs[0]['static_configs'][1]['labels']['exporter_shard'], 'eu-west-1-123456789012-1')
+        self.assertEqual(jobs[0]['static_configs'][1]['labels']['aws_account'], '123456789012')
+
+
+class TestRelabel(unittest.TestCase):
+    def test_series_name(self):
+        # Equal - names follow the cloudwatch exporter naming
+        self.assertEqual(relabel.series_name('AWS/EC2', 'CPUUtilization', 'Average'), 'aws_ec2_cpuutilization_average')
+        self.assertEqual(relabel.series_name('AWS/ApplicationELB', 'HTTPCode_ELB_5XX_Count', 'SampleCount'),
+                         'aws_applicationelb_httpcode_elb_5_xx_count_sample_count')
+        self.assertEqual(relabel.series_name('AWS/Lambda', 'Duration', 'p99.9'), 'aws_lambda_duration_p99_9')
+
+    def test_load_allowlists(self):
+        allowlists = relabel.load_allowlists(ns_list)
+        # Equal - every shipped allowlist only allows statistics the namespace definitions request
+        self.assertIn('AWS/EC2', allowlists)
+        for namespace, allowlist in allowlists.items():
+            catalog_series = {relabel.series_name(namespace, m['aws_metric_name'], s)
+                              for m in catalog.get_namespace_metrics(namespace) for s in m.get('aws_statistics') or []}
+            self.assertEqual(set(relabel.allowed_series(namespace, allowlist)) - catalog_series, set())
+        # Equal - custom namespaces have no allowlist
+        self.assertIsNone(relabel.load_allowlist('MyApp/EC2'))
+        tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(tmp_dir, 'EC2.yml'), 'w') as allowlist_file:
+            yaml.dump({'metrics': {'CPUUtilization': ['Median']}}, allowlist_file)
+        # Fail ValueError
+        self.assertRaises(ValueError, relabel.load_allowlist, 'AWS/EC2', tmp_dir)
+        # Fail ValueError - dimension labels identify series and cannot be dropped
+        with open(os.path.join(tmp_dir, 'EC2.yml'), 'w') as allowlist_file:
+            yaml.dump({'metrics': {'CPUUtilization': ['Average']}, 'drop_labels': ['InstanceId']}, allowlist_file)
+        self.assertRaises(ValueError, relabel.load_allowlist, 'AWS/EC2', tmp_dir)
+        shutil.rmtree(tmp_dir)
+
+    def test_metric_relabel_configs(self):
+        allowlists = {'AWS/EC2': {'metrics': {'CPUUtilization': ['Average']}}}
+        rules = relabel.metric_relabel_configs(['AWS/EC2', 'AWS/Lambda'], allowlists)
+        keep = re.compile(rules[0]['regex'])
+        # Equal - allowed series, exporter series and namespaces without an allowlist are kept
+        for name in ('aws_ec2_cpuutilization_average', 'cloudwatch_requests_total', 'aws_lambda_errors_sum'):
+            self.assertTrue(keep.fullmatch(name), name)
+        # Equal - other statistics, metrics and exporter internals are dropped
+        for name in ('aws_ec2_cpuutilization_maximum', 'aws_ec2_network_in_average', 'jvm_memory_bytes_used',
+                     'aws_rds_cpuutilization_average'):
+            self.assertFalse(keep.fullmatch(name), name)
+        self.assertEqual(len(rules), 1)
+
+    def test_aws_jobs(self):
+        exporters = [{'shard': None, 'tier': 'standard', 'scrape_interval': 300, 'target': 'cloudwatch-exporter:9106',
+                      'namespaces': {'AWS/EC2': {'metrics': 13, 'statistics': 13}}}]
+        # Equal - without allowlists the scrape job is unchanged
+        self.assertNotIn('metric_relabel_configs', scrape_jobs_config.aws_jobs(exporters)[0])
+        # Equal
+        job = scrape_jobs_config.aws_jobs(exporters, relabel.load_allowlists(['AWS/EC2']))[0]
+        self.assertEqual(job['metric_relabel_configs'][0]['action'], 'keep')
+        self.assertIn('aws_ec2_cpuutilization_average', job['metric_relabel_configs'][0]['regex'].split('|'))
+        self.assertNotIn('metric_relabel_configs', scrape_jobs_config.aws)
+
+
+class TestProfiles(unittest.TestCase):
+    def test_parse_namespace_profiles(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, profiles.parse_namespace_profiles, 'AWS/EC2:cheap')
+        self.assertRaises(ValueError, profiles.parse_namespace_profiles, 'minimal')
+        # Equal
+        self.assertEqual(profiles.parse_namespace_profiles('AWS/EC2:Minimal, AWS/S3:full'),
+                         {'AWS/EC2': 'minimal', 'AWS/S3': 'full'})
+        self.assertEqual(profiles.parse_namespace_profiles(''), {})
+
+    def test_get_namespace_metrics(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, profiles.get_namespace_metrics, 'AWS/EC2', 'cheap')
+        # Equal - standard is the namespace definition
+        self.assertEqual(profiles.get_namespace_metrics('AWS/EC2'), catalog.get_namespace_metrics('AWS/EC2'))
+        # Equal - minimal keeps the allowlist of the namespace
+        minimal = profiles.get_namespace_metrics('AWS/EC2', 'minimal')
+        allowlist = relabel.load_allowlist('AWS/EC2')
+        self.assertEqual({m['aws_metric_name'] for m in minimal}, set(allowlist['metrics']))
+        # Equal - without an allowlist, minimal keeps the first statistic of each metric and dimension set
+        for namespace in ('AWS/ApiGateway', 'AWS/WAFV2', 'AWS/DDoSProtection'):
+            minimal = profiles.get_namespace_metrics(namespace, 'minimal')
+            keys = [(m['aws_metric_name'], tuple(sorted(m.get('aws_dimensions') or []))) for m in minimal]
+            standard = {(m['aws_metric_name'], tuple(sorted(m.get('aws_dimensions') or [])))
+                        for m in profiles.get_namespace_metrics(namespace)}
+            self.assertEqual(len(keys), len(set(keys)))
+            self.assertEqual(set(keys), standard)
+            self.assertTrue(all(len(m['aws_statistics']) == 1 for m in minimal))
+        # Equal - full requests every statistic
+        full = profiles.get_namespace_metrics('AWS/EC2', 'full')
+        self.assertTrue(all(m['aws_statistics'] == list(data.cloudwatch_statistics) for m in full))
+
+    def test_plan_namespaces(self):
+        plans = {profile: planner.plan_namespaces(['AWS/EC2', 'AWS/Lambda'], {}, profile=profile)
+                 for profile in profiles.PROFILES}
+        # Equal
+        self.assertLess(plans['minimal']['metrics'], plans['standard']['metrics'])
+        self.assertLess(plans['minimal']['api_calls'], plans['standard']['api_calls'])
+        self.assertGreater(plans['full']['series'], plans['standard']['series'])
+        self.assertEqual(planner.main(['--namespaces', 'AWS/EC2', '--profile', 'minimal']), 0)
+
+
+class TestTiers(unittest.TestCase):
+    def test_parse_namespace_tiers(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, tiers.parse_namespace_tiers, 'AWS/ELB:hourly')
+        self.assertRaises(ValueError, tiers.parse_namespace_tiers, 'AWS/ELB')
+        # Equal
+        self.assertEqual(tiers.parse_namespace_tiers(''), {})
+        self.assertEqual(tiers.parse_namespace_tiers('AWS/ELB:fast, AWS/S3:daily'),
+                         {'AWS/ELB': 'fast', 'AWS/S3': 'daily'})
+
+    def test_split_by_tier(self):
+        metrics = [{'aws_namespace': 'AWS/S3', 'aws_metric_name': 'BucketSizeBytes', 'period_seconds': 86400},
+                   {'aws_namespace': 'AWS/ELB', 'aws_metric_name': 'RequestCount'},
+                   {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization'},
+                   {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'StatusCheckFailed', 'tier': 'fast'}]
+        # Fail ValueError
+        self.assertRaises(ValueError, tiers.split_by_tier, [{'aws_metric_name': 'a', 'tier': 'hourly'}], {})
+        # Equal
+        split = tiers.split_by_tier(metrics, {'AWS/ELB': 'fast'})
+        self.assertEqual(list(split), ['fast', 'standard', 'daily'])
+        self.assertEqual([m['aws_metric_name'] for m in split['fast']], ['RequestCount', 'StatusCheckFailed'])
+        self.assertNotIn('tier', split['fast'][1])
+        self.assertEqual(tiers.split_by_tier([], {}), {'standard': []})
+        self.assertEqual(list(tiers.split_by_tier(metrics, {'AWS/ELB': 'fast'}, enabled=False)), ['standard'])
+
+    def test_get_tier_settings(self):
+        # Equal
+        self.assertEqual(tiers.get_tier_settings('standard', 300), {'scrape_interval': 300, 'exporter': {}})
+        fast = tiers.get_tier_settings('fast', 300)
+        self.assertEqual(fast['scrape_interval'], 60)
+        self.assertEqual(fast['exporter']['period_seconds'], 60)
+
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        self.inventory = planner.load_inventory('./tests_resources/inventory.yaml')
+
+    def test_load_inventory(self):
+        # Fail FileNotFoundError
+        self.assertRaises(FileNotFoundError, planner.load_inventory, './wrong/path')
+        # Fail ValueError
+        self.assertRaises(ValueError, planner.load_inventory, './cw_namespaces/EC2.yml')
+        # Equal
+        self.assertEqual(planner.load_inventory(''), {})
+        self.assertEqual(self.inventory['AWS/EC2']['dimensions']['InstanceId'], 120)
+
+    def test_count_resources(self):
+        # Equal
+        self.assertEqual(planner.count_resources({'aws_namespace': 'AWS/EC2', 'aws_dimensions': ['InstanceId']},
+                                                 self.inventory), 120)
+        self.assertEqual(planner.count_resources({'aws_namespace': 'AWS/S3',
+                                                  'aws_dimensions': ['BucketName', 'FilterId']}, self.inventory), 80)
+        self.assertEqual(planner.count_resources({'aws_namespace': 'AWS/S3',
+                                                  'aws_dimensions': ['BucketName', 'StorageType']}, self.inventory), 50)
+        self.assertEqual(planner.count_resources({'aws_namespace': 'AWS/SQS', 'aws_dimensions': ['QueueName']},
+                                                 self.inventory), planner.DEFAULT_RESOURCES)
+        self.assertEqual(planner.count_resources({'aws_namespace': 'AWS/EC2'}, self.inventory), 1)
+
+    def test_plan_metrics(self):
+        metrics = [{'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+                    'aws_statistics': ['Average', 'Maximum']},
+                   {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'NetworkIn', 'aws_dimensions': ['InstanceId'],
+                    'aws_statistics': ['Sum'], 'aws_extended_statistics': ['p99']}]
+        plan = planner.plan_metrics(metrics, self.inventory, 60, call_latency=0.1)
+        # Equal
+        self.assertEqual(plan['list_metrics_calls'], 2)
+        self.assertEqual(plan['get_metric_statistics_calls'], 240)
+        self.assertEqual(plan['api_calls'], 242)
+        self.assertEqual(plan['series'], 480)
+        self.assertEqual(plan['scrape_duration_seconds'], 24.2)
+        self.assertTrue(plan['fits_scrape_interval'])
+        self.assertEqual(plan['namespaces']['AWS/EC2']['metrics'], 2)
+        self.assertFalse(planner.plan_metrics(metrics, self.inventory, 60, call_latency=1)['fits_scrape_interval'])
+
+    def test_plan_get_metric_data(self):
+        metric = {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+                  'aws_statistics': ['Average', 'Maximum']}
+        # Equal - 240 queries fit in a single GetMetricData call
+        plan = planner.plan_metric(metric, self.inventory, use_get_metric_data=True)
+        self.assertEqual((plan['get_metric_statistics_calls'], plan['get_metric_data_calls']), (0, 1))
+        self.assertEqual(planner.plan_metric(dict(metric, aws_statistics=[]), self.inventory, True)[
+                             'get_metric_data_calls'], 2)
+        # Equal - the entry setting overrides the configuration setting
+        plan = planner.plan_metric(dict(metric, use_get_metric_data=False), self.inventory, use_get_metric_data=True)
+        self.assertEqual((plan['get_metric_statistics_calls'], plan['get_metric_data_calls']), (120, 0))
+        plan = planner.plan_metrics([metric], self.inventory, use_get_metric_data=True)
+        self.assertEqual(plan['api_calls'], 2)
+
+    def test_plan_config(self):
+        # Fail FileNotFoundError
+        self.assertRaises(FileNotFoundError, planner.plan_config, './wrong/path', {})
+        # Equal
+        plan = planner.plan_config('./tests_resources/valid.yaml', {})
+        self.assertEqual(plan['api_calls'], 2)
+        self.assertEqual(plan['scrape_interval'], 60)
+
+    def test_main(self):
+        # Equal
+        self.assertEqual(planner.main(['--namespaces', 'AWS/EC2', '--scrape-interval', '300']), 0)
+        self.assertEqual(planner.main(['--namespaces', 'AWS/EC2', '--inventory', './tests_resources/inventory.yaml',
+                                       '--scrape-interval', '60', '--strict']), 1)
+        self.assertEqual(planner.main(['--config', './tests_resources/valid.yaml']), 0)
+
+
+class TestResourceSelect(unittest.TestCase):
+    def setUp(self):
+        self.inventory = planner.load_inventory('./tests_resources/inventory_select.yaml')
+
+    def test_get_selection(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, resource_select.get_selection,
+                          {'AWS/EC2': {'dimension_select': {'InstanceId': 'i-1'}}}, 'AWS/EC2')
+        self.assertRaises(ValueError, resource_select.get_selection,
+                          {'AWS/EC2': {'dimension_select_regex': {'InstanceId': ['(']}}}, 'AWS/EC2')
+        self.assertRaises(ValueError, resource_select.get_selection,
+                          {'AWS/EC2': {'tag_select': {'tag_selections': {'Environment': ['production']}}}}, 'AWS/EC2')
+        # Equal
+        self.assertEqual(resource_select.get_selection(self.inventory, 'AWS/S3'), {})
+        self.assertEqual(set(resource_select.get_selection(self.inventory, 'AWS/Lambda')),
+                         {'dimension_select_regex', 'tag_select'})
+
+    def test_select_metrics(self):
+        metrics = resource_select.select_metrics(catalog.get_namespace_metrics('AWS/Lambda'), self.inventory)
+        by_dimensions = {tuple(m['aws_dimensions']): m for m in metrics}
+        # Equal - filters are added only to metrics with the filtered dimensions
+        self.assertEqual(by_dimensions[('FunctionName', 'Resource')]['aws_dimension_select_regex'],
+                         {'FunctionName': ['^prod-.*']})
+        self.assertEqual(by_dimensions[('FunctionName', 'Resource')]['aws_tag_select']['resource_id_dimension'],
+                         'FunctionName')
+        self.assertEqual(len([m for m in metrics if 'aws_tag_select' in m]),
+                         len([m for m in metrics if 'FunctionName' in (m.get('aws_dimensions') or [])]))
+        self.assertEqual(resource_select.select_metric({'aws_dimensions': ['InstanceId']},
+                                                       {'dimension_select': {'FunctionName': ['prod']}}),
+                         {'aws_dimensions': ['InstanceId']})
+        # Equal - settings of the metric entry are kept
+        metric = {'aws_namespace': 'AWS/EC2', 'aws_dimensions': ['InstanceId'],
+                  'aws_dimension_select': {'InstanceId': ['i-custom']}}
+        resource_select.select_metrics([metric], self.inventory)
+        self.assertEqual(metric['aws_dimension_select'], {'InstanceId': ['i-custom']})
+
+    def test_plan_selected(self):
+        ec2 = planner.plan_namespaces(['AWS/EC2'], self.inventory)
+        lambda_plan = planner.plan_namespaces(['AWS/Lambda'], self.inventory)
+        # Equal - fully selected dimensions skip ListMetrics and count only the selected resources
+        self.assertEqual(ec2['list_metrics_calls'], 0)
+        self.assertEqual(ec2['get_metric_statistics_calls'], 2 * ec2['metrics'])
+        self.assertGreater(lambda_plan['list_metrics_calls'], 0)
+        self.assertEqual(lambda_plan['get_resources_calls'], 3 * len(
+            [m for m in catalog.get_namespace_metrics('AWS/Lambda') if 'FunctionName' in m['aws_dimensions']]))
+
+    def test_add_cloudwatch_config(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        shutil.copy(builder.CW_RAW_CONFIG, cw_config)
+        builder._add_cloudwatch_config(['AWS/EC2'], cw_config, 'us-east-1', 300, '', self.inventory)
+        with open(cw_config, 'r') as cw_file:
+            cw_yaml = yaml.safe_load(cw_file)
+        # Equal
+        self.assertTrue(all(m['aws_dimension_select'] == {'InstanceId': ['i-0123456789abcdef0', 'i-0fedcba9876543210']}
+                            for m in cw_yaml['metrics']))
+        shutil.rmtree(tmp_dir)
+
+
+class TestConfigLint(unittest.TestCase):
+    def setUp(self):
+        with open('./tests_resources/expensive.yaml', 'r') as config_file:
+            self.config_yaml = yaml.safe_load(config_file)
+        self.inventory = planner.load_inventory('./tests_resources/inventory_select.yaml')
+
+    def test_check_schema(self):
+        invalid = {'region': 'us-east-1', 'period_seconds': True, 'metric': [], 'metrics': [
+            {'aws_namespace': 'AWS/EC2', 'aws_statistics': ['Avg'], 'aws_extended_statistics': ['99']}, 'CPU']}
+        # Equal
+        self.assertEqual(config_lint.check_schema(invalid), [
+            'configuration: period_seconds should be int', 'configuration: unknown field metric',
+            'metrics[0]: aws_metric_name is required', 'metrics[0]: invalid statistic Avg',
+            'metrics[0]: invalid extended statistic 99', 'metrics[1]: should be a mapping'])
+        self.assertEqual(config_lint.check_schema(self.config_yaml), [])
+        self.assertEqual(config_lint.check_schema([]), ['configuration should be a mapping'])
+
+    def test_find_expensive_patterns(self):
+        findings = config_lint.find_expensive_patterns(self.config_yaml, 300)
+        # Equal
+        self.assertEqual([(f['rule'], f['index']) for f in findings], [
+            ('short_period', None), ('no_dimension_selection', 0), ('all_statistics', 0),
+            ('no_dimension_selection', 1), ('duplicate', 1), ('no_dimension_selection', 2),
+            ('extended_percentiles', 2)])
+
+    def test_lint_config(self):
+        config_yaml, report = config_lint.lint_config(self.config_yaml, 300, self.inventory, rewrite=True)
+        # Equal
+        self.assertEqual(config_yaml['period_seconds'], 300)
+        self.assertEqual(len(config_yaml['metrics']), 2)
+        self.assertEqual(config_yaml['metrics'][1]['aws_statistics'], ['Sum'])
+        self.assertEqual(config_yaml['metrics'][1]['aws_extended_statistics'], ['p99', 'p50'])
+        self.assertNotIn('extended_percentiles', [rewrite['rule'] for rewrite in report['rewrites']])
+        # Equal - an entry without statistics is only reported, it keeps all five statistics
+        self.assertIn('all_statistics', [finding['rule'] for finding in report['findings']])
+        self.assertNotIn('all_statistics', [rewrite['rule'] for rewrite in report['rewrites']])
+        self.assertEqual(sorted(config_yaml['metrics'][0].get('aws_statistics') or data.cloudwatch_statistics),
+                         sorted(data.cloudwatch_statistics))
+        self.assertTrue(all('aws_dimension_select' in m for m in config_yaml['metrics']))
+        self.assertLess(report['after']['api_calls'], report['before']['api_calls'])
+        self.assertLess(report['after']['series'], report['before']['series'])
+        self.assertEqual(self.config_yaml['period_seconds'], 60)
+        # Equal - without rewrite the configuration is kept
+        config_yaml, report = config_lint.lint_config(self.config_yaml, 300, self.inventory)
+        self.assertEqual(config_yaml, self.config_yaml)
+        self.assertEqual(report['before'], report['after'])
+        self.assertEqual(report['rewrites'], [])
+
+    def test_load_aws_custom_config(self):
+        tmp_dir = tempfile.mkdtemp()
+        cw_config = os.path.join(tmp_dir, 'cloudwatch.yml')
+        invalid_path = os.path.join(tmp_dir, 'invalid.yml')
+        with open(invalid_path, 'w') as invalid_file:
+            yaml.dump({'metrics': [{'aws_namespace': 'AWS/EC2'}]}, invalid_file)
+        # Fail ValueError
+        self.assertRaises(ValueError, builder._load_aws_custom_config, cw_config, invalid_path)
+        # Equal
+        with mock.patch.object(builder, 'REWRITE_CUSTOM_CONFIG', True):
+            builder._load_aws_custom_config(cw_config, './tests_resources/expensive.yaml')
+        with open(cw_config, 'r') as cw_file:
+            self.assertEqual(yaml.safe_load(cw_file)['period_seconds'], builder.SCRAPE_INTERVAL)
+        shutil.rmtree(tmp_dir)
+
+    def test_main(self):
+        tmp_dir = tempfile.mkdtemp()
+        rewrite_path = os.path.join(tmp_dir, 'rewritten.yml')
+        # Equal
+        self.assertEqual(config_lint.main(['./tests_resources/expensive.yaml', '--rewrite', rewrite_path]), 0)
+        self.assertTrue(os.path.isfile(rewrite_path))
+        self.assertEqual(config_lint.main(['./cw_namespaces/EC2.yml']), 1)
+        shutil.rmtree(tmp_dir)
+
+
+class TestMetricMerge(unittest.TestCase):
+    def test_merge_metrics(self):
+        cpu = {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+               'aws_statistics': ['Average']}
+        metrics = [cpu, dict(cpu), dict(cpu, aws_statistics=['Maximum', 'Average']),
+                   dict(cpu, aws_statistics=['Maximum']),
+                   dict(cpu, aws_statistics=['Average'], period_seconds=60),
+                   dict(cpu, aws_metric_name='NetworkIn'),
+                   dict(cpu, aws_namespace='AWS/EC2 ', aws_statistics=['Sum'])]
+        merged, report = metric_merge.merge_metrics(metrics, {'AWS/EC2': {'dimensions': {'InstanceId': 10}}})
+        # Equal
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(merged[0]['aws_statistics'], ['Average', 'Maximum', 'Sum'])
+        self.assertEqual(merged[1]['period_seconds'], 60)
+        self.assertEqual(cpu['aws_statistics'], ['Average'])
+        self.assertEqual((report['exact_duplicates'], report['subsumed'], report['merged']), (1, 1, 2))
+        self.assertEqual(report['api_calls_before'], 7 * 11)
+        self.assertEqual(report['api_calls_after'], 3 * 11)
+        self.assertEqual(report['api_calls_saved'], 4 * 11)
+
+    def test_merge_all_statistics(self):
+        base = {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId']}
+        average = dict(base, aws_statistics=['Average'])
+        # Equal - an entry without statistics requests all five, which an entry with statistics does not subsume
+        merged, report = metric_merge.merge_metrics([average, base])
+        self.assertEqual(set(merged[0]['aws_statistics']), set(data.cloudwatch_statistics))
+        self.assertEqual(report['merged'], 1)
+        merged, report = metric_merge.merge_metrics([base, average])
+        self.assertEqual(merged, [base])
+        self.assertEqual(report['subsumed'], 1)
+
+    def test_merge_key(self):
+        metric = {'aws_namespace': 'AWS/S3', 'aws_metric_name': 'BucketSizeBytes',
+                  'aws_dimensions': ['BucketName', 'StorageType'], 'aws_statistics': ['Average']}
+        # Equal
+        self.assertEqual(metric_merge.merge_key(metric),
+                         metric_merge.merge_key(dict(metric, aws_dimensions=['StorageType', 'BucketName'],
+                                                     aws_statistics=['Sum'])))
+        self.assertNotEqual(metric_merge.merge_key(metric), metric_merge.merge_key(dict(metric, range_seconds=600)))
+
+
+class TestOtelTuning(unittest.TestCase):
+    def test_get_tuning(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, otel_tuning.get_tuning, 'fastest', 1000)
+        # Equal
+        low_latency = otel_tuning.get_tuning('low-latency', 100000)
+        high_throughput = otel_tuning.get_tuning('high-throughput', 100000)
+        low_memory = otel_tuning.get_tuning('low-memory', 100000)
+        self.assertEqual(low_latency['batch'], {'send_batch_size': 2048, 'timeout': '1s'})
+        self.assertEqual(high_throughput['batch'], {'send_batch_size': 16384, 'timeout': '10s'})
+        self.assertEqual(high_throughput['sending_queue']['queue_size'], 7 * 5)
+        self.assertLess(low_memory['memory_limiter']['limit_mib'], high_throughput['memory_limiter']['limit_mib'])
+        self.assertEqual(otel_tuning.get_tuning('low-memory', 0)['batch']['send_batch_size'], 256)
+        # Equal - more series need more memory
+        self.assertLess(otel_tuning.get_tuning('low-memory', 1000)['memory_limiter']['limit_mib'],
+                        low_memory['memory_limiter']['limit_mib'])
+        # Equal - a small estimate does not size the collector below the preset's static values
+        self.assertEqual(otel_tuning.get_tuning('low-memory', 70)['memory_limiter']['limit_mib'], 256)
+        self.assertEqual(otel_tuning.get_tuning('low-memory', 70)['sending_queue']['queue_size'], 10)
+        # Equal - without an estimate the preset's static values are used
+        static = otel_tuning.get_tuning('high-throughput')
+        self.assertEqual(static['batch']['send_batch_size'], otel_tuning.DEFAULT_BATCH_SIZE)
+        self.assertEqual(static['memory_limiter']['limit_mib'], 1024)
+        self.assertEqual(static['sending_queue'], {'enabled': True, 'num_consumers': 20, 'queue_size': 20})
+
+    def test_get_send_queue(self):
+        # Fail ValueError
+        self.assertRaises(ValueError, otel_tuning.get_send_queue, 'disk', 1000, 300)
+        # Equal - the memory queue is bounded by its memory
+        memory = otel_tuning.get_send_queue('memory', 100000, 300)
+        self.assertEqual(memory['queue'], {'enabled': True, 'num_consumers': 13, 'queue_size': 16})
+        self.assertEqual(memory['absorbed_seconds'], 300)
+        self.assertEqual(memory['memory_mib'], otel_tuning.DEFAULT_QUEUE_MEMORY_MIB)
+        self.assertIsNone(memory['wal'])
+        self.assertEqual(memory['retry_on_failure'], {'enabled': True, 'initial_interval': '5s',
+                                                      'max_interval': '30s', 'max_elapsed_time': '900s'})
+        # Equal - the file queue keeps the outage in its write-ahead log
+        file = otel_tuning.get_send_queue('file', 100000, 300, directory='/tmp/queue')
+        self.assertEqual(file['queue']['queue_size'], 26)
+        self.assertEqual(file['absorbed_seconds'], 900)
+        self.assertEqual(file['wal'], {'directory': '/tmp/queue', 'buffer_size': 26, 'truncate_frequency': '300s'})
+        # Equal - few series fit the whole outage in memory
+        small = otel_tuning.get_send_queue('memory', 1000, 60)
+        self.assertEqual(small['queue']['queue_size'], 15)
+        self.assertEqual(small['absorbed_seconds'], 900)
+        self.assertEqual(small['retry_on_failure']['max_interval'], '15s')
+        # Equal - given consumers are kept
+        consumers = otel_tuning.get_send_queue('memory', 100000, 300, num_consumers=2)['queue']['num_consumers']
+        self.assertEqual(consumers, 2)
+
+    def test_get_queue_headroom_mib(self):
+        # Equal - the soft limit of the memory limiter less the base memory
+        self.assertEqual(otel_tuning.get_queue_headroom_mib(otel_tuning.get_tuning('low-memory')), 256 - 52 - 64)
+        tuning = otel_tuning.get_tuning('high-throughput', 500000)
+        self.assertEqual(otel_tuning.get_queue_headroom_mib(tuning),
+                         tuning['memory_limiter']['limit_mib'] - tuning['memory_limiter']['spike_limit_mib'] - 64)
+
+    def test_apply_send_queue(self):
+        send_queue = otel_tuning.get_send_queue('memory', 1000, 60)
+        legacy = otel_tuning.apply_send_queue(builder._load_yaml(builder.OTEL_RAW_CONFIG), send_queue, (0, 18, 0))
+        current = otel_tuning.apply_send_queue(builder._load_yaml(builder.OTEL_RAW_CONFIG), send_queue, (0, 60, 0))
+        # Equal
+        self.assertEqual(legacy['exporters']['prometheusremotewrite']['sending_queue'], send_queue['queue'])
+        self.assertNotIn('remote_write_queue', legacy['exporters']['prometheusremotewrite'])
+        self.assertEqual(current['exporters']['prometheusremotewrite']['remote_write_queue'], send_queue['queue'])
+        self.assertNotIn('wal', current['exporters']['prometheusremotewrite'])
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config_files = dict(api.CONFIG_FILES)
+        for name, raw_config in (('otel', builder.OTEL_RAW_CONFIG), ('cloudwatch', builder.CW_RAW_CONFIG)):
+            api.CONFIG_FILES[name] = os.path.join(self.tmp_dir, f'{name}.yml')
+            shutil.copy(raw_config, api.CONFIG_FILES[name])
+        self.client = api.app.test_client()
+
+    def tearDown(self):
+        api.CONFIG_FILES.update(self.config_files)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_config(self):
+        # Fail 404
+        self.assertEqual(self.client.get('/config/nosuch.yaml').status_code, 404)
+        self.assertEqual(self.client.get('/config/otel.xml').status_code, 404)
+        # Equal
+        response = self.client.get('/config/otel')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'prometheusremotewrite', response.data)
+        response = self.client.get('/config/cloudwatch.yaml')
+        self.assertEqual(response.mimetype, 'application/yaml')
+        with open(api.CONFIG_FILES['cloudwatch'], 'rb') as cw_file:
+            self.assertEqual(response.data, cw_file.read())
+        response = self.client.get('/config/otel.json')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertIn('exporters', response.get_json())
+        self.assertIn(b'config/cloudwatch', self.client.get('/').data)
+        # Fail 404 - sharded builds do not write the cloudwatch configuration
+        os.remove(api.CONFIG_FILES['cloudwatch'])
+        self.assertNotIn(b'config/cloudwatch', self.client.get('/').data)
+        self.assertEqual(self.client.get('/config/cloudwatch').status_code, 404)
+        self.assertEqual(self.client.get('/plan').status_code, 404)
+
+    def test_conditional_get(self):
+        response = self.client.get('/config/cloudwatch.yaml')
+        etag = response.headers['ETag']
+        # Equal - unchanged file answers with 304
+        self.assertEqual(self.client.get('/config/cloudwatch.yaml', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.get('/config/cloudwatch.yaml', headers={
+            'If-Modified-Since': response.headers['Last-Modified']}).status_code, 304)
+        # Equal - a changed file is served again
+        with open(api.CONFIG_FILES['cloudwatch'], 'a') as cw_file:
+            cw_file.write('role_arn: arn:role\n')
+        response = self.client.get('/config/cloudwatch.yaml', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'arn:role', response.data)
+
+    def test_get_plan(self):
+        # Fail 400
+        self.assertEqual(self.client.get('/plan?namespaces=AWS/nosuch').status_code, 400)
+        # Equal
+        response = self.client.get('/plan?namespaces=AWS/EC2,AWS/S3&scrape_interval=300')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.get_json()['namespaces']), {'AWS/EC2', 'AWS/S3'})
+        plan = self.client.get('/plan?namespaces=AWS/EC2&get_metric_data=true').get_json()
+        self.assertEqual(plan['get_metric_statistics_calls'], 0)
+        self.assertGreater(plan['get_metric_data_calls'], 0)
+        builder._add_cloudwatch_config(['AWS/Lambda'], api.CONFIG_FILES['cloudwatch'], 'us-east-1', 300, '')
+        plan = self.client.get('/plan').get_json()
+        self.assertEqual(set(plan['namespaces']), {'AWS/Lambda'})
+        self.assertTrue(plan['fits_scrape_interval'])
+
+    def test_gzip(self):
+        builder._add_cloudwatch_config(['AWS/EC2'], api.CONFIG_FILES['cloudwatch'], 'us-east-1', 300, '')
+        response = self.client.get('/config/cloudwatch.yaml', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        with open(api.CONFIG_FILES['cloudwatch'], 'rb') as cw_file:
+            self.assertEqual(gzip.decompress(response.data), cw_file.read())
+        self.assertNotIn('Content-Encoding', self.client.get('/config/cloudwatch.yaml').headers)
+        # Equal - small files are not compressed
+        response = self.client.get('/config/otel.yaml', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+    def test_get_documents(self):
+        shard_config = os.path.join(self.tmp_dir, 'cloudwatch-us-east-1.yml')
+        shutil.copy(builder.CW_RAW_CONFIG, shard_config)
+        versions = self.client.get('/documents').get_json()['documents']
+        # Equal
+        self.assertEqual(set(versions), {'otel', 'cloudwatch', 'cloudwatch-us-east-1'})
+        response = self.client.get('/documents/cloudwatch-us-east-1')
+        self.assertEqual(response.headers['X-Config-Version'], versions['cloudwatch-us-east-1'])
+        with open(shard_config, 'rb') as shard_file:
+            self.assertEqual(response.data, shard_file.read())
+        self.assertEqual(self.client.get('/documents/otel', headers={
+            'If-None-Match': f'"{versions["otel"]}"'}).status_code, 304)
+        response = self.client.get(f'/documents/otel/{versions["otel"]}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        # Fail 404
+        self.assertEqual(self.client.get('/documents/nosuch').status_code, 404)
+        self.assertEqual(self.client.get('/documents/otel/nosuch').status_code, 404)
+        os.remove(shard_config)
+        self.assertEqual(self.client.get('/documents/cloudwatch-us-east-1').status_code, 404)
+
+    def test_wait_for_document(self):
+        version = self.client.get('/documents/cloudwatch').headers['X-Config-Version']
+        headers = {'If-None-Match': f'"{version}"'}
+        # Equal - no new version before the wait ends
+        self.assertEqual(self.client.get('/documents/cloudwatch?wait=0.05', headers=headers).status_code, 304)
+        # Fail 400
+        for wait in ('nan', 'inf', '-inf'):
+            self.assertEqual(self.client.get(f'/documents/cloudwatch?wait={wait}', headers=headers).status_code, 400)
+        # Equal - a new version answers the waiting request
+        timer = threading.Timer(0.1, builder._add_cloudwatch_config,
+                                (['AWS/EC2'], api.CONFIG_FILES['cloudwatch'], 'us-east-1', 300, ''))
+        timer.start()
+        response = self.client.get('/documents/cloudwatch?wait=10', headers=headers)
+        timer.join()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['X-Config-Version'], version)
+        self.assertIn(b'AWS/EC2', response.data)
+
+    def test_document_events(self):
+        response = self.client.get('/documents/events')
+        events = iter(response.response)
+        # Equal
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        first = [json.loads(next(events).decode().split('data: ')[1]) for _ in range(2)]
+        self.assertEqual({event['name'] for event in first}, {'otel', 'cloudwatch'})
+        with open(api.CONFIG_FILES['otel'], 'a') as otel_file:
+            otel_file.write('extensions: {}\n')
+        api._documents.refresh()
+        self.assertEqual(json.loads(next(events).decode().split('data: ')[1])['name'], 'otel')
+        self.assertIn('logzio_config_builder_document_watchers{mode="events"} 1.0',
+                      self.client.get('/metrics').get_data(as_text=True))
+        response.close()
+
+    def test_get_metrics(self):
+        self.client.get('/config/otel')
+        self.client.get('/config/nosuch.yaml')
+        response = self.client.get('/metrics')
+        body = response.get_data(as_text=True)
+        # Equal
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('logzio_config_builder_request_duration_seconds_count{code="200",endpoint="/config/otel",'
+                      'method="GET"}', body)
+        self.assertIn('endpoint="/config/<name>.<fmt>",method="GET"}', body)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_write_synthetic_catalog(self):
+        tmp_dir = tempfile.mkdtemp()
+        namespaces = benchmark.write_synthetic_catalog(tmp_dir, 3, 4)
+        compiled = catalog.compile_catalog(tmp_dir)
+        # Equal
+        self.assertEqual(sorted(compiled['namespaces']), namespaces)
+        self.assertEqual(sum(len(metrics) for metrics in compiled['namespaces'].values()), 12)
+        self.assertEqual(namespaces, benchmark.write_synthetic_catalog(tmp_dir, 3, 4))
+        shutil.rmtree(tmp_dir)
+
+    def test_bench_build(self):
+        with benchmark._workdir(3, 4) as work_dir:
+            results = benchmark.bench_build(work_dir, 1)
+        # Equal
+        self.assertEqual(set(results), {'cold_build', 'rebuild', 'cloudwatch_config_bytes'})
+        self.assertGreater(results['cold_build']['peak_memory_bytes'], 0)
+        self.assertEqual(os.getcwd(), os.path.dirname(os.path.abspath(benchmark.__file__)))
+
+    def test_main_clean_environment(self):
+        tmp_dir = tempfile.mkdtemp()
+        output = os.path.join(tmp_dir, 'results.json')
+        benchmark_dir = os.path.dirname(os.path.abspath(benchmark.__file__))
+        # Success - the benchmark defaults are valid builder settings
+        process = subprocess.run([sys.executable, 'benchmark.py', '--namespaces', '2', '--metrics-per-namespace',
+                                  '2', '--repeat', '1', '--requests', '4', '--watchers', '2', '--output', output],
+                                 cwd=benchmark_dir, env={'PATH': os.environ.get('PATH', '')}, capture_output=True,
+                                 timeout=120)
+        self.assertEqual(process.returncode, 0, process.stderr.decode())
+        with open(output, 'r') as output_file:
+            self.assertIn('build', json.load(output_file)['benchmarks'])
+        shutil.rmtree(tmp_dir)
+
+    def test_bench_api(self):
+        with benchmark._workdir(3, 4) as work_dir:
+            benchmark.bench_build(work_dir, 1)
+            results = benchmark.bench_api(work_dir, 4, 2, 5)
+            with benchmark._api_server(work_dir) as base_url:
+                with urllib.request.urlopen(f'{base_url}/config/otel') as response:
+                    server = response.headers['Server']
+        # Equal
+        self.assertEqual(set(results), {'full', 'conditional', 'watch'})
+        self.assertEqual(results['watch']['watchers'], 5)
+        self.assertLess(results['watch']['latency_seconds']['max'], 10)
+        # Equal - the api is served by gunicorn, as in the image
+        self.assertTrue(server.startswith('gunicorn'), server)
+
+    def test_fakes(self):
+        with fakes.FakeRemoteWriteReceiver() as receiver, fakes.FakeMetricsTarget(5) as target:
+            urllib.request.urlopen(urllib.request.Request(receiver.url, data=b'12345', method='POST',
+                                                          headers={'Authorization': 'Bearer token'}))
+            with urllib.request.urlopen(f'{target.url}/metrics') as response:
+                lines = response.read().decode().splitlines()
+            # Equal
+            self.assertEqual(receiver.stats(), {'requests': 1, 'bytes': 5})
+            self.assertEqual(receiver.authorization, 'Bearer token')
+            self.assertEqual(len(lines), 5)
+            self.assertEqual(target.scrapes, 1)
+            otel_yaml = benchmark._collector_config(builder.OTEL_RAW_CONFIG, target, receiver, 5)
+            self.assertEqual(otel_yaml['exporters']['prometheusremotewrite']['endpoint'], receiver.url)
+            self.assertEqual(otel_yaml['receivers']['prometheus']['config']['scrape_configs'][0]['static_configs'],
+                             [{'targets': [target.address]}])
+
+    def test_stalling_receiver(self):
+        with fakes.StallingRemoteWriteReceiver(hold_seconds=0.1) as receiver:
+            receiver.stall()
+            # Fail HTTPError - held, then rejected as unavailable
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(urllib.request.Request(receiver.url, data=b'123', method='POST'))
+            self.assertEqual(context.exception.code, 503)
+            receiver.resume()
+            # Success
+            with urllib.request.urlopen(urllib.request.Request(receiver.url, data=b'123', method='POST')) as response:
+                self.assertEqual(response.status, 204)
+            # Equal
+            self.assertEqual(receiver.stats(), {'requests': 1, 'bytes': 3, 'rejected': 1})
+            self.assertIsNotNone(receiver.first_request_at)
+
+    def test_compare(self):
+        baseline = {'benchmarks': {'build': {'seconds': {'p50': 1.0, 'max': 1.0}, 'cloudwatch_config_bytes': 10},
+                                   'api': {'requests_per_second': 100}}}
+        current = {'benchmarks': {'build': {'seconds': {'p50': 1.5, 'max': 3.0}, 'cloudwatch_config_bytes': 20},
+                                  'api': {'requests_per_second': 50}}}
+        changes, regressions = benchmark.compare(baseline, current)
+        # Equal
+        self.assertEqual(changes, {'build.seconds.p50': 0.5, 'build.seconds.max': 2.0, 'api.requests_per_second': -0.5})
+        self.assertEqual(regressions, ['build.seconds.p50', 'api.requests_per_second'])
+        self.assertEqual(benchmark.compare(current, baseline)[1], [])
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_count_namespaces(self):
+        metrics = [{'aws_namespace': 'AWS/EC2', 'aws_statistics': ['Average', 'Maximum']},
+                   {'aws_namespace': 'AWS/EC2', 'aws_statistics': ['Sum'], 'aws_extended_statistics': ['p99']},
+                   {'aws_namespace': 'AWS/S3'}]
+        # Equal
+        self.assertEqual(telemetry.count_namespaces(metrics), {'AWS/EC2': {'metrics': 2, 'statistics': 4},
+                                                               'AWS/S3': {'metrics': 1, 'statistics': 0}})
+
+    def test_record_build(self):
+        exporters = [{'target': 'cloudwatch-exporter:9106', 'tier': 'standard', 'api_calls': 48, 'series': 26,
+                      'namespaces': {'AWS/EC2': {'metrics': 12, 'statistics': 14}}}]
+        telemetry.record_build(exporters, [builder.OTEL_RAW_CONFIG])
+        telemetry.record_build(exporters[:0], [builder.CW_RAW_CONFIG])
+        telemetry.observe_phase('Cloudwatch configuration', 0.2)
+        body = telemetry.exposition()[0].decode()
+        # Equal - a build replaces the metrics of the previous build
+        self.assertNotIn('logzio_config_builder_namespace_metrics{namespace="AWS/EC2"}', body)
+        self.assertNotIn('otel_raw.yml', body)
+        self.assertIn(f'logzio_config_builder_config_size_bytes{{config="cloudwatch_raw.yml"}} '
+                      f'{float(os.path.getsize(builder.CW_RAW_CONFIG))}', body)
+        self.assertIn('logzio_config_builder_phase_duration_seconds_count{phase="cloudwatch_configuration"}', body)
+        telemetry.record_build(exporters, [])
+        self.assertIn('logzio_config_builder_estimated_api_calls{exporter="cloudwatch-exporter:9106",tier="standard"} '
+                      '48.0', telemetry.exposition()[0].decode())
+
+    def test_build_metrics_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        metrics_path = os.path.join(tmp_dir, 'builder.prom')
+        telemetry.record_build([], [builder.CW_RAW_CONFIG])
+        telemetry.write_build_metrics(metrics_path)
+        with open(metrics_path, 'rb') as metrics_file:
+            build_metrics = metrics_file.read()
+        # Equal
+        self.assertIn(b'logzio_config_builder_config_size_bytes{config="cloudwatch_raw.yml"}', build_metrics)
+        # Equal - another process exposes the build metrics file and its own request metrics
+        with mock.patch.object(telemetry, '_build_pid', None):
+            body = telemetry.exposition(metrics_path)[0]
+            self.assertTrue(body.startswith(build_metrics))
+            self.assertIn(b'logzio_config_builder_request_duration_seconds', body)
+            self.assertIn(b'logzio_config_builder_last_generation_timestamp_seconds',
+                          telemetry.exposition(os.path.join(tmp_dir, 'nosuch.prom'))[0])
+        shutil.rmtree(tmp_dir)
+
+
 class TestInput(unittest.TestCase):
 
     def test_is_valid_logzio_token(self):
@@ -143,6 +1509,84 @@ class TestInput(unittest.TestCase):
         except (TypeError, ValueError) as e:
             self.fail(f'Unexpected error {e}')
 
+    def test_is_valid_exporter_replicas(self):
+        # Fail Type
+        non_valid_types = ['2', None, 4j, 2.5]
+        for t in non_valid_types:
+            self.assertRaises(TypeError, iv.is_valid_exporter_replicas, t)
+        # Fail Value
+        for v in [0, -1]:
+            self.assertRaises(ValueError, iv.is_valid_exporter_replicas, v)
+        # Success
+        try:
+            iv.is_valid_exporter_replicas(3)
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
+    def test_is_valid_otel_tuning_preset(self):
+        # Fail Type
+        for t in [None, 4, ['low-memory']]:
+            self.assertRaises(TypeError, iv.is_valid_otel_tuning_preset, t)
+        # Fail Value
+        self.assertRaises(ValueError, iv.is_valid_otel_tuning_preset, 'fastest')
+        # Success
+        try:
+            iv.is_valid_otel_tuning_preset('low-latency')
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
+    def test_is_valid_statistics_profile(self):
+        # Fail Type
+        for t in [None, 4, ['minimal']]:
+            self.assertRaises(TypeError, iv.is_valid_statistics_profile, t)
+        # Fail Value
+        self.assertRaises(ValueError, iv.is_valid_statistics_profile, 'cheap')
+        # Success
+        try:
+            iv.is_valid_statistics_profile('minimal')
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
+    def test_is_valid_get_metric_data_exporter_version(self):
+        # Fail Type
+        for t in [None, 11, (0, 11, 0)]:
+            self.assertRaises(TypeError, iv.is_valid_get_metric_data_exporter_version, t)
+        # Fail Value
+        for v in ['latest', '0.9.0', 'cloudwatch_exporter-0.10.1']:
+            self.assertRaises(ValueError, iv.is_valid_get_metric_data_exporter_version, v)
+        # Success
+        try:
+            for v in ['0.11.0', 'v0.15.5', '1.0.0']:
+                iv.is_valid_get_metric_data_exporter_version(v)
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
+    def test_is_valid_otel_send_queue(self):
+        # Fail Type
+        for t in [None, 4, ['file']]:
+            self.assertRaises(TypeError, iv.is_valid_otel_send_queue, t)
+        # Fail Value
+        self.assertRaises(ValueError, iv.is_valid_otel_send_queue, 'disk')
+        # Success
+        try:
+            iv.is_valid_otel_send_queue('memory')
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
+    def test_is_valid_file_queue_collector_version(self):
+        # Fail Type
+        for t in [None, 60, (0, 60, 0)]:
+            self.assertRaises(TypeError, iv.is_valid_file_queue_collector_version, t)
+        # Fail Value
+        for v in ['latest', '0.18.0', '0.59.1']:
+            self.assertRaises(ValueError, iv.is_valid_file_queue_collector_version, v)
+        # Success
+        try:
+            for v in ['0.60.0', 'v0.88.0', '1.2.3']:
+                iv.is_valid_file_queue_collector_version(v)
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
     def test_is_valid_aws_namespaces(self):
         # Fail Type
         non_valid_types = [-2, None, 4j, ['string', 'string']]
@@ -1,24 +1,260 @@
-from flask import Flask
+from datetime import datetime, timezone
+from flask import Flask, Response, abort, g, jsonify, request
+import gzip
+import hashlib
+import html
+import json
+import math
+import os
+import threading
+import time
 import yaml
+from util import documents, planner, telemetry
 
 app = Flask(__name__)
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+
+CONFIG_FILES = {
+    'otel': '../configuration/otel.yml',
+    'cloudwatch': '../configuration/cloudwatch.yml'
+}
+CONTENT_TYPES = {
+    'html': 'text/html; charset=utf-8',
+    'yaml': 'application/yaml',
+    'json': 'application/json'
+}
+INVENTORY_PATH = os.environ.get('INVENTORY_PATH', '')
+# Build metrics written by the config builder, exposed when the builder runs in another process
+BUILD_METRICS_PATH = '../configuration/.builder_metrics.prom'
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 512
+# Longest wait of a document request for a new version, in seconds
+WATCH_MAX_SECONDS = 300
+# Seconds between keepalive comments of an idle document event stream
+EVENTS_KEEPALIVE_SECONDS = 15
+
+# Cached config files by path, invalidated by the file mtime, size and inode
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+# Paths of the configuration documents by name: the configurations of CONFIG_FILES and the sharded and tiered
+# exporter configurations next to the cloudwatch configuration, e.g. cloudwatch-us-east-1-fast
+def _document_paths():
+    paths = dict(CONFIG_FILES)
+    config_dir = os.path.dirname(CONFIG_FILES['cloudwatch'])
+    try:
+        file_names = sorted(os.listdir(config_dir or '.'))
+    except FileNotFoundError:
+        return paths
+    for file_name in file_names:
+        name, extension = os.path.splitext(file_name)
+        if name.startswith('cloudwatch-') and extension == '.yml':
+            paths[name] = os.path.join(config_dir, file_name)
+    return paths
+
+
+_documents = documents.DocumentStore(_document_paths)
+
+
+# The cloudwatch configuration is only linked when it is written: sharded builds and tiered builds without a
+# standard tier only write the exporter configurations listed in documents
 @app.route('/')
 def home():
-    return '<p><a href=config/otel>Opentelemtry configuration</a></p>' \
-           '<p><a href=config/cloudwatch>Cloudwatch configuration</a></p>'
+    cloudwatch = '<p><a href=config/cloudwatch>Cloudwatch configuration</a> ' \
+                 '(<a href=config/cloudwatch.yaml>yaml</a>, <a href=config/cloudwatch.json>json</a>)</p>' \
+        if os.path.isfile(CONFIG_FILES['cloudwatch']) else ''
+    return '<p><a href=config/otel>Opentelemtry configuration</a> ' \
+           '(<a href=config/otel.yaml>yaml</a>, <a href=config/otel.json>json</a>)</p>' + cloudwatch + \
+           '<p><a href=documents>Configuration document versions</a></p>' \
+           '<p><a href=plan>Cloudwatch api calls plan</a></p>' \
+           '<p><a href=metrics>Config builder metrics</a></p>'
+
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+# Record the latency of every request by its route, so unknown paths do not add label values
+@app.after_request
+def _observe_request(response):
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        telemetry.observe_request(endpoint, request.method, response.status_code,
+                                  time.perf_counter() - g.request_start)
+    return response
+
+
+def _render(raw, fmt):
+    if fmt == 'yaml':
+        return raw
+    if fmt == 'json':
+        return json.dumps(yaml.safe_load(raw), indent=2).encode()
+    return f'<pre style="word-wrap: break-word; white-space: pre-wrap;">{html.escape(raw.decode())}</pre> '.encode()
+
+
+# Get a config file from the cache, reading it again only if it changed on disk
+def _get_cached_config(path):
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    entry = _cache.get(path)
+    if entry is None or entry['key'] != key:
+        with open(path, 'rb') as config_file:
+            raw = config_file.read()
+        entry = {
+            'key': key,
+            'etag': hashlib.sha1(raw).hexdigest(),
+            'last_modified': datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+            'bodies': {('yaml', False): raw}
+        }
+        with _cache_lock:
+            _cache[path] = entry
+    return entry
+
+
+# Get a rendered (and optionally compressed) body of a cached config, rendering it once per file version
+def _get_body(entry, fmt, use_gzip):
+    body_key = (fmt, use_gzip)
+    if body_key not in entry['bodies']:
+        with _cache_lock:
+            if body_key not in entry['bodies']:
+                body = entry['bodies'].get((fmt, False)) or _render(entry['bodies'][('yaml', False)], fmt)
+                entry['bodies'][(fmt, False)] = body
+                if use_gzip:
+                    entry['bodies'][body_key] = gzip.compress(body)
+    return entry['bodies'][body_key]
+
+
+def _config_response(name, fmt):
+    if name not in CONFIG_FILES or fmt not in CONTENT_TYPES:
+        abort(404)
+    try:
+        entry = _get_cached_config(CONFIG_FILES[name])
+    except FileNotFoundError:
+        # Sharded builds and tiered builds without a standard tier do not write cloudwatch.yml
+        abort(404)
+    use_gzip = request.accept_encodings['gzip'] > 0 and entry['key'][1] >= GZIP_MIN_SIZE
+    response = Response(_get_body(entry, fmt, use_gzip), content_type=CONTENT_TYPES[fmt])
+    response.set_etag(f'{entry["etag"]}-{fmt}{"-gzip" if use_gzip else ""}')
+    response.last_modified = entry['last_modified']
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    if use_gzip:
+        response.content_encoding = 'gzip'
+    return response.make_conditional(request)
 
 
 # expose opentelemtry configuration
 @app.route('/config/otel')
 def get_otel_config():
-    with open('../configuration/otel.yml', 'r') as otel_file:
-        otel_yaml = yaml.safe_load(otel_file)
-        return f'<pre style="word-wrap: break-word; white-space: pre-wrap;">{yaml.dump(otel_yaml)}</pre> '
+    return _config_response('otel', 'html')
+
 
 # expose cloudwatch exporter configuration
 @app.route('/config/cloudwatch')
 def get_cw_config():
-    with open('../configuration/cloudwatch.yml',
-              'r') as cloudwatch_file:
-        cloudwatch_yaml = yaml.safe_load(cloudwatch_file)
-        return f'<pre style="word-wrap: break-word; white-space: pre-wrap;">{yaml.dump(cloudwatch_yaml)}</pre> '
+    return _config_response('cloudwatch', 'html')
+
+
+# expose raw yaml and json variants of the configurations
+@app.route('/config/<name>.<fmt>')
+def get_config_variant(name, fmt):
+    if fmt == 'html':
+        abort(404)
+    return _config_response(name, fmt)
+
+
+def _document_response(version, raw, immutable=False):
+    response = Response(raw, content_type=CONTENT_TYPES['yaml'])
+    response.set_etag(version)
+    response.headers['X-Config-Version'] = version
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# expose the current version of every configuration document
+@app.route('/documents')
+def get_documents():
+    _documents.refresh()
+    return jsonify({'documents': _documents.versions()})
+
+
+# expose a configuration document with its version as the ETag. With the wait query parameter, a request whose
+# If-None-Match holds the current version waits up to that many seconds for a new version, and answers 304 if
+# there is none
+@app.route('/documents/<name>')
+def get_document(name):
+    wait = request.args.get('wait', 0, type=float)
+    if not math.isfinite(wait):
+        abort(400, 'wait should be a number of seconds')
+    wait = min(max(wait, 0), WATCH_MAX_SECONDS)
+    _documents.refresh()
+    current = _documents.versions().get(name)
+    if wait and current and request.if_none_match.contains(current):
+        with telemetry.document_watchers.labels('long_poll').track_inprogress():
+            _documents.wait(name, request.if_none_match.as_set(), wait)
+    document = _documents.get(name)
+    if document is None:
+        abort(404)
+    return _document_response(*document)
+
+
+# expose a version of a configuration document, while it is current or one of the last documents.HISTORY_SIZE
+# versions. Versions are content addressed, so they can be cached forever
+@app.route('/documents/<name>/<version>')
+def get_document_version(name, version):
+    _documents.refresh()
+    document = _documents.get(name, version)
+    if document is None:
+        abort(404)
+    return _document_response(*document, immutable=True)
+
+
+# stream the versions of the configuration documents as server-sent events: the current versions when the stream
+# starts, then every new version. A removed document has a null version
+@app.route('/documents/events')
+def get_document_events():
+    _documents.refresh()
+
+    def events():
+        with telemetry.document_watchers.labels('events').track_inprogress():
+            for changes in _documents.watch(EVENTS_KEEPALIVE_SECONDS):
+                if not changes:
+                    yield ': keepalive\n\n'
+                for name, version in sorted(changes.items()):
+                    yield f'event: version\ndata: {json.dumps({"name": name, "version": version})}\n\n'
+
+    return Response(events(), content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+# expose the estimated api calls, series and scrape duration of the cloudwatch exporter configuration,
+# or of the built-in namespaces given in the namespaces query parameter, optionally collected with GetMetricData
+@app.route('/plan')
+def get_plan():
+    inventory = planner.load_inventory(INVENTORY_PATH)
+    scrape_interval = request.args.get('scrape_interval', type=int)
+    namespaces = request.args.get('namespaces', '').replace(' ', '')
+    use_get_metric_data = request.args.get('get_metric_data', '').lower() == 'true'
+    try:
+        if namespaces:
+            plan = planner.plan_namespaces(namespaces.split(','), inventory, scrape_interval,
+                                           use_get_metric_data=use_get_metric_data)
+        else:
+            plan = planner.plan_config(CONFIG_FILES['cloudwatch'], inventory, scrape_interval)
+    except ValueError as e:
+        abort(400, str(e))
+    except FileNotFoundError:
+        abort(404, 'The cloudwatch configuration is not written, plan the namespaces or a cloudwatch-<shard>-<tier> '
+                   'document instead')
+    return jsonify(plan)
+
+
+# expose the config builder metrics in the prometheus text format
+@app.route('/metrics')
+def get_metrics():
+    body, content_type = telemetry.exposition(BUILD_METRICS_PATH)
+    return Response(body, content_type=content_type)
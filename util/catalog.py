@@ -0,0 +1,169 @@
+"""
+This module compiles the cw_namespaces definitions into a single indexed catalog
+"""
+import copy
+import glob
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import sys
+import yaml
+from util import files
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+NAMESPACES_DIR = './cw_namespaces'
+CATALOG_PATH = './cw_namespaces/catalog.json'
+CATALOG_VERSION = 1
+
+# Loaded catalogs by catalog path, with the stat signature of their sources
+_catalogs = {}
+# Catalog paths whose sources are not checked again until the snapshot ends, see snapshot
+_snapshots = {}
+
+
+def _source_files(namespaces_dir):
+    return sorted(glob.glob(os.path.join(namespaces_dir, '*.yml')))
+
+
+def _source_signature(namespaces_dir):
+    signature = []
+    for path in _source_files(namespaces_dir):
+        stat = os.stat(path)
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _namespace_name(path):
+    return 'AWS/{}'.format(os.path.splitext(os.path.basename(path))[0])
+
+
+# Content hash of the namespace definitions, used to invalidate a compiled catalog
+def source_hash(namespaces_dir=NAMESPACES_DIR):
+    digest = hashlib.sha256()
+    for path in _source_files(namespaces_dir):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def _add_to_index(index, key, value):
+    entries = index.setdefault(key, [])
+    if value not in entries:
+        entries.append(value)
+
+
+# Parse every namespace definition and build lookup indexes over them
+def compile_catalog(namespaces_dir=NAMESPACES_DIR):
+    namespaces = {}
+    index = {'metric': {}, 'dimension': {}, 'statistic': {}}
+    for path in _source_files(namespaces_dir):
+        namespace = _namespace_name(path)
+        with open(path, 'r') as namespace_file:
+            metrics = yaml.load(namespace_file, Loader=SafeLoader) or []
+        namespaces[namespace] = metrics
+        for metric in metrics:
+            metric_name = metric['aws_metric_name']
+            _add_to_index(index['metric'], metric_name, namespace)
+            for dimension in metric.get('aws_dimensions') or []:
+                _add_to_index(index['dimension'], dimension, [namespace, metric_name])
+            for statistic in metric.get('aws_statistics') or []:
+                _add_to_index(index['statistic'], statistic, [namespace, metric_name])
+    return {
+        'version': CATALOG_VERSION,
+        'source_hash': source_hash(namespaces_dir),
+        'namespaces': namespaces,
+        'index': index
+    }
+
+
+# Compile the catalog and write it as json
+def build_catalog(namespaces_dir=NAMESPACES_DIR, catalog_path=CATALOG_PATH):
+    catalog = compile_catalog(namespaces_dir)
+    with files.atomic_write(catalog_path) as catalog_file:
+        json.dump(catalog, catalog_file, separators=(',', ':'))
+    return catalog
+
+
+def _read_catalog(catalog_path):
+    try:
+        with open(catalog_path, 'r') as catalog_file:
+            return json.load(catalog_file)
+    except (OSError, ValueError):
+        return None
+
+
+# Load the compiled catalog, recompiling it when the namespace definitions changed
+def load_catalog(namespaces_dir=NAMESPACES_DIR, catalog_path=CATALOG_PATH):
+    if _snapshots.get(catalog_path) and catalog_path in _catalogs:
+        return _catalogs[catalog_path][1]
+    signature = _source_signature(namespaces_dir)
+    if catalog_path in _catalogs and _catalogs[catalog_path][0] == signature:
+        return _catalogs[catalog_path][1]
+    current_hash = source_hash(namespaces_dir)
+    catalog = _read_catalog(catalog_path)
+    if catalog is None or catalog.get('version') != CATALOG_VERSION or catalog['source_hash'] != current_hash:
+        try:
+            catalog = build_catalog(namespaces_dir, catalog_path)
+        except OSError:
+            # Read only file system, keep the compiled catalog in memory only
+            catalog = compile_catalog(namespaces_dir)
+    _catalogs[catalog_path] = (signature, catalog)
+    return catalog
+
+
+# Check the namespace definitions once and reuse the loaded catalog until the block ends, instead of listing and
+# stating the definitions on every lookup. Snapshots can be nested
+@contextmanager
+def snapshot(namespaces_dir=NAMESPACES_DIR, catalog_path=CATALOG_PATH):
+    load_catalog(namespaces_dir, catalog_path)
+    _snapshots[catalog_path] = _snapshots.get(catalog_path, 0) + 1
+    try:
+        yield
+    finally:
+        _snapshots[catalog_path] -= 1
+
+
+def _normalize_namespace(namespace):
+    return 'AWS/{}'.format(namespace.strip().split('AWS/')[-1])
+
+
+# Supported namespaces, sorted
+def get_namespaces():
+    return sorted(load_catalog()['namespaces'])
+
+
+# Metric entries of a namespace
+def get_namespace_metrics(namespace):
+    namespace = _normalize_namespace(namespace)
+    try:
+        return copy.deepcopy(load_catalog()['namespaces'][namespace])
+    except KeyError:
+        raise ValueError(f'{namespace} is not in the namespaces catalog')
+
+
+# Namespaces that expose a metric
+def namespaces_with_metric(metric_name):
+    return list(load_catalog()['index']['metric'].get(metric_name, []))
+
+
+# (namespace, metric name) pairs that use a dimension
+def metrics_with_dimension(dimension):
+    return [tuple(entry) for entry in load_catalog()['index']['dimension'].get(dimension, [])]
+
+
+# (namespace, metric name) pairs that request a statistic
+def metrics_with_statistic(statistic):
+    return [tuple(entry) for entry in load_catalog()['index']['statistic'].get(statistic, [])]
+
+
+if __name__ == '__main__':
+    namespaces_dir = sys.argv[1] if len(sys.argv) > 1 else NAMESPACES_DIR
+    catalog_path = sys.argv[2] if len(sys.argv) > 2 else CATALOG_PATH
+    compiled = build_catalog(namespaces_dir, catalog_path)
+    print(f'Compiled {len(compiled["namespaces"])} namespaces into {catalog_path}')
@@ -0,0 +1,188 @@
+"""
+This module validates custom cloudwatch exporter configurations, flags patterns that make scrapes expensive and
+optionally rewrites them into cheaper equivalents
+"""
+import argparse
+import copy
+import json
+import sys
+import yaml
+from util import metric_merge, planner, resource_select
+from util.data import cloudwatch_statistics, extended_statistic
+
+SETTINGS_SCHEMA = {
+    'period_seconds': int,
+    'range_seconds': int,
+    'delay_seconds': int,
+    'set_timestamp': bool,
+    'list_metrics_cache_ttl': int,
+    'warn_on_empty_list_dimensions': bool,
+    'use_get_metric_data': bool
+}
+CONFIG_SCHEMA = dict(SETTINGS_SCHEMA, region=str, role_arn=str, metrics=list)
+METRIC_SCHEMA = dict(SETTINGS_SCHEMA, aws_namespace=str, aws_metric_name=str, aws_dimensions=list,
+                     aws_dimension_select=dict, aws_dimension_select_regex=dict, aws_tag_select=dict,
+                     aws_statistics=list, aws_extended_statistics=list, tier=str)
+REQUIRED_METRIC_FIELDS = ('aws_namespace', 'aws_metric_name')
+
+RULES = {
+    'no_dimension_selection': 'dimensions without aws_dimension_select, aws_dimension_select_regex or aws_tag_select '
+                              'collect every resource found by ListMetrics',
+    'short_period': 'period_seconds is shorter than the scrape interval',
+    'extended_percentiles': 'extended percentiles add a series per percentile and resource',
+    'all_statistics': 'an entry without statistics requests all five statistics',
+    'duplicate': 'entry can be served by the requests of an earlier entry'
+}
+
+
+def _is_type(value, expected):
+    # bool is a subclass of int, but not a valid int setting
+    if expected is int:
+        return type(value) is int
+    return isinstance(value, expected)
+
+
+def _check_fields(fields, schema, where):
+    errors = []
+    for key, value in fields.items():
+        if key not in schema:
+            errors.append(f'{where}: unknown field {key}')
+        elif not _is_type(value, schema[key]):
+            errors.append(f'{where}: {key} should be {schema[key].__name__}')
+    return errors
+
+
+# Schema errors of a custom configuration, an empty list if it is valid
+def check_schema(config_yaml):
+    if not isinstance(config_yaml, dict):
+        return ['configuration should be a mapping']
+    errors = _check_fields(config_yaml, CONFIG_SCHEMA, 'configuration')
+    for index, metric in enumerate(config_yaml.get('metrics') or []):
+        where = f'metrics[{index}]'
+        if not isinstance(metric, dict):
+            errors.append(f'{where}: should be a mapping')
+            continue
+        errors.extend(_check_fields(metric, METRIC_SCHEMA, where))
+        errors.extend(f'{where}: {field} is required' for field in REQUIRED_METRIC_FIELDS if not metric.get(field))
+        if isinstance(metric.get('aws_statistics'), list):
+            errors.extend(f'{where}: invalid statistic {statistic}' for statistic in metric['aws_statistics']
+                          if statistic not in cloudwatch_statistics)
+        if isinstance(metric.get('aws_extended_statistics'), list):
+            errors.extend(f'{where}: invalid extended statistic {statistic}'
+                          for statistic in metric['aws_extended_statistics']
+                          if not extended_statistic.match(str(statistic)))
+    return errors
+
+
+def _finding(rule, index, metric):
+    return {'rule': rule, 'index': index, 'metric': f'{metric.get("aws_namespace")}/{metric.get("aws_metric_name")}'
+            if metric else None, 'message': RULES[rule]}
+
+
+# Expensive patterns of a valid custom configuration
+def find_expensive_patterns(config_yaml, scrape_interval):
+    findings = []
+    global_period = config_yaml.get('period_seconds')
+    if global_period and global_period < int(scrape_interval):
+        findings.append(_finding('short_period', None, None))
+    merge_keys = set()
+    for index, metric in enumerate(config_yaml.get('metrics') or []):
+        if metric.get('aws_dimensions') and not any(setting in metric
+                                                    for setting in resource_select.SELECT_SETTINGS.values()):
+            findings.append(_finding('no_dimension_selection', index, metric))
+        if 'period_seconds' in metric and metric['period_seconds'] < int(scrape_interval):
+            findings.append(_finding('short_period', index, metric))
+        if metric.get('aws_extended_statistics'):
+            findings.append(_finding('extended_percentiles', index, metric))
+        if not metric.get('aws_statistics') and not metric.get('aws_extended_statistics'):
+            findings.append(_finding('all_statistics', index, metric))
+        key = metric_merge.merge_key(metric)
+        if key in merge_keys:
+            findings.append(_finding('duplicate', index, metric))
+        merge_keys.add(key)
+    return findings
+
+
+def _rewrite(rule, index, metric, change):
+    return dict(_finding(rule, index, metric), change=change)
+
+
+# Rewrite the expensive patterns of a valid custom configuration into cheaper equivalents. Extended percentiles
+# and entries without statistics have none: a regular statistic measures something else, and fewer statistics drop
+# series without saving api calls. Returns the rewritten configuration and the rewrites made
+def rewrite_config(config_yaml, scrape_interval, inventory=None):
+    config_yaml = copy.deepcopy(config_yaml)
+    scrape_interval = int(scrape_interval)
+    rewrites = []
+    if config_yaml.get('period_seconds') and config_yaml['period_seconds'] < scrape_interval:
+        rewrites.append(_rewrite('short_period', None, None, f'period_seconds {config_yaml["period_seconds"]} -> '
+                                                             f'{scrape_interval}'))
+        config_yaml['period_seconds'] = scrape_interval
+    metrics = config_yaml.get('metrics') or []
+    for index, metric in enumerate(metrics):
+        if 'period_seconds' in metric and metric['period_seconds'] < scrape_interval:
+            rewrites.append(_rewrite('short_period', index, metric, f'period_seconds {metric["period_seconds"]} -> '
+                                                                    f'{scrape_interval}'))
+            metric['period_seconds'] = scrape_interval
+        if metric.get('aws_dimensions') and not any(setting in metric
+                                                    for setting in resource_select.SELECT_SETTINGS.values()):
+            selection = resource_select.get_selection(inventory or {}, metric['aws_namespace'])
+            resource_select.select_metric(metric, selection)
+            added = [setting for setting in resource_select.SELECT_SETTINGS.values() if setting in metric]
+            if added:
+                rewrites.append(_rewrite('no_dimension_selection', index, metric, f'added {", ".join(added)} '
+                                                                                  f'from the inventory'))
+    if metrics:
+        config_yaml['metrics'], report = metric_merge.merge_metrics(metrics, inventory)
+        if report['entries_before'] != report['entries_after']:
+            rewrites.append(_rewrite('duplicate', None, None, f'{report["entries_before"]} entries merged into '
+                                                              f'{report["entries_after"]}'))
+    return config_yaml, rewrites
+
+
+def _estimate(config_yaml, inventory):
+    plan = planner.plan_metrics(config_yaml.get('metrics') or [], inventory)
+    return {'api_calls': plan['api_calls'], 'series': plan['series']}
+
+
+# Lint a custom configuration and optionally rewrite it. Returns the configuration to use and a report of the
+# schema errors, expensive patterns, rewrites and the estimated requests before and after
+def lint_config(config_yaml, scrape_interval, inventory=None, rewrite=False):
+    inventory = inventory or {}
+    report = {'errors': check_schema(config_yaml), 'findings': [], 'rewrites': []}
+    if report['errors']:
+        return config_yaml, report
+    report['findings'] = find_expensive_patterns(config_yaml, scrape_interval)
+    report['before'] = _estimate(config_yaml, inventory)
+    if rewrite:
+        config_yaml, report['rewrites'] = rewrite_config(config_yaml, scrape_interval, inventory)
+    report['after'] = _estimate(config_yaml, inventory)
+    return config_yaml, report
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(description='Lint a custom cloudwatch exporter configuration')
+    parser.add_argument('config', help='Path to a cloudwatch exporter configuration file')
+    parser.add_argument('--scrape-interval', type=int, default=300, help='Scrape interval in seconds')
+    parser.add_argument('--inventory', default='', help='Path to an inventory file of resource counts and filters')
+    parser.add_argument('--rewrite', help='Write the configuration with expensive patterns rewritten to this path')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = _parse_args(args)
+    with open(args.config, 'r') as config_file:
+        config_yaml = yaml.safe_load(config_file)
+    config_yaml, report = lint_config(config_yaml, args.scrape_interval, planner.load_inventory(args.inventory),
+                                      bool(args.rewrite))
+    print(json.dumps(report, indent=2))
+    if report['errors']:
+        return 1
+    if args.rewrite:
+        with open(args.rewrite, 'w') as rewrite_file:
+            yaml.dump(config_yaml, rewrite_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
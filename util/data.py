@@ -1,5 +1,26 @@
+import re
+
 aws_regions = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'af-south-1', 'ap-east-1', 'ap-south-1',
                     'ap-northeast-2', 'ap-southeast-1', 'ap-southeast-2', 'ap-northeast-1', 'eu-central-1', 'eu-west-1', 'eu-west-2', 'eu-south-1', 'eu-west-3', 'eu-north-1', 'me-south-1', 'sa-east-1', 'ca-central-1', 'us-gov-west-1', 'us-gov-east-1']
 
-aws_namespaces = ['AWS/ApplicationELB','AWS/NetworkELB', 'AWS/ELB', 'AWS/EC2', 'AWS/AutoScaling', 'AWS/S3', 'AWS/ECS', 'AWS/RDS',
-                                'AWS/EBS', 'AWS/CloudFront', 'AWS/SQS', 'AWS/EFS', 'AWS/Kinesis', 'AWS/Lambda', 'AWS/Route53', 'AWS/DynamoDB', 'AWS/ElastiCache', 'AWS/SNS', 'AWS/Redshift', 'AWS/Fargate', 'AWS/Athena', 'AWS/ApiGateway', 'AWS/AmazonMQ', 'AWS/AppRunner', 'AWS/Firehose', 'AWS/VPN', 'AWS/WAF', 'AWS/WAFV2', 'AWS/NATGateway', 'AWS/DDoSProtection']
+# Scrape tiers, each scraped by its own exporter with its own interval and cloudwatch periods.
+# The standard tier uses SCRAPE_INTERVAL and the exporter defaults
+scrape_tiers = {
+    'fast': {'scrape_interval': 60, 'period_seconds': 60, 'range_seconds': 120, 'delay_seconds': 60},
+    'standard': {},
+    'daily': {'scrape_interval': 3600, 'period_seconds': 86400, 'range_seconds': 172800, 'delay_seconds': 0,
+              'set_timestamp': False}
+}
+
+# Oldest prom/cloudwatch-exporter version that supports the use_get_metric_data setting
+get_metric_data_exporter_version = (0, 11, 0)
+
+# Oldest otel/opentelemetry-collector-contrib version whose prometheusremotewrite exporter queues requests with
+# remote_write_queue instead of sending_queue, and can keep them in a write-ahead log
+file_queue_collector_version = (0, 60, 0)
+
+# Statistics the exporter requests for an entry that sets neither statistics nor extended statistics, which are
+# also all the statistics cloudwatch accepts in aws_statistics
+cloudwatch_statistics = ('Sum', 'SampleCount', 'Minimum', 'Maximum', 'Average')
+# Percentile statistics accepted in aws_extended_statistics, for example p99 or p99.9
+extended_statistic = re.compile(r'^p\d{1,2}(\.\d+)?$')
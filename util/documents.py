@@ -0,0 +1,131 @@
+"""
+This module versions the generated configuration files as content-addressed documents. The version of a document is
+the sha256 of its content, so every config api process gives the same content the same version. A poller thread
+checks the files for changes and wakes the requests waiting for a new version, which cost a blocked thread each
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+
+POLL_INTERVAL_SECONDS = 1
+# Versions kept per document, so an agent can still fetch a version it was notified of after it was replaced
+HISTORY_SIZE = 5
+
+logger = logging.getLogger(__name__)
+
+
+# Version of document content
+def content_version(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+
+class DocumentStore:
+    def __init__(self, get_paths, poll_interval=POLL_INTERVAL_SECONDS, history_size=HISTORY_SIZE):
+        # get_paths returns the document paths by name, so documents can appear and disappear
+        self.get_paths = get_paths
+        self.poll_interval = poll_interval
+        self.history_size = history_size
+        self.changed = threading.Condition()
+        self._versions = {}
+        self._history = {}
+        self._signatures = {}
+        self._poller = None
+
+    # Read the documents whose file changed on disk and wake the waiting requests if a version changed.
+    # Returns whether a version changed
+    def refresh(self):
+        with self.changed:
+            before = dict(self._versions)
+            paths = self.get_paths()
+            for name, path in paths.items():
+                try:
+                    stat = os.stat(path)
+                    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                    if self._signatures.get(name) == signature:
+                        continue
+                    with open(path, 'rb') as document_file:
+                        raw = document_file.read()
+                except FileNotFoundError:
+                    self._forget(name)
+                    continue
+                self._signatures[name] = signature
+                self._add_version(name, raw)
+            for name in set(self._versions) - set(paths):
+                self._forget(name)
+            if self._versions == before:
+                return False
+            self.changed.notify_all()
+            return True
+
+    def _add_version(self, name, raw):
+        version = content_version(raw)
+        history = self._history.setdefault(name, collections.OrderedDict())
+        history[version] = raw
+        history.move_to_end(version)
+        while len(history) > self.history_size:
+            history.popitem(last=False)
+        self._versions[name] = version
+
+    def _forget(self, name):
+        self._versions.pop(name, None)
+        self._signatures.pop(name, None)
+
+    # Current version of every document
+    def versions(self):
+        with self.changed:
+            return dict(self._versions)
+
+    # (version, content) of a document, the current version by default. None if the document or the version is
+    # not known
+    def get(self, name, version=None):
+        with self.changed:
+            version = version or self._versions.get(name)
+            raw = self._history.get(name, {}).get(version)
+        return None if raw is None else (version, raw)
+
+    # Wait up to timeout seconds until the version of a document is not one of the known versions. Returns the
+    # current version, None if the document does not exist
+    def wait(self, name, known, timeout):
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self._versions.get(name) in known:
+                remaining = deadline - time.monotonic()
+                # not remaining > 0 also stops on a nan timeout
+                if not remaining > 0:
+                    break
+                self.changed.wait(remaining)
+            return self._versions.get(name)
+
+    # Yield the versions of the changed documents, starting with every current document. Removed documents have a
+    # None version. Yields an empty dict after keepalive seconds without a change
+    def watch(self, keepalive):
+        self.start()
+        sent = {}
+        while True:
+            with self.changed:
+                if self._versions == sent:
+                    self.changed.wait(keepalive)
+                versions = dict(self._versions)
+            changes = {name: version for name, version in versions.items() if sent.get(name) != version}
+            changes.update({name: None for name in sent if name not in versions})
+            sent = versions
+            yield changes
+
+    # Start the poller thread of this process, if it is not running
+    def start(self):
+        with self.changed:
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+
+    def _poll(self):
+        while True:
+            try:
+                self.refresh()
+            except OSError as e:
+                logger.warning(f'Reading the configuration documents failed: {e}')
+            time.sleep(self.poll_interval)
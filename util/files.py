@@ -0,0 +1,21 @@
+"""
+This module writes files atomically, so readers of a file never see it half written
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+# Open a temporary file next to path for writing and rename it over path once the block exits without an error.
+# The temporary file is removed if the block fails, leaving path untouched
+@contextmanager
+def atomic_write(path, mode='w'):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as tmp_file:
+            yield tmp_file
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -2,7 +2,8 @@
 This module is for validating user's input
 """
 import re
-from util.data import aws_namespaces, aws_regions
+from util.data import aws_regions, get_metric_data_exporter_version, file_queue_collector_version
+from util import catalog, otel_tuning, profiles
 
 
 # is_valid_logzio_token checks if a given token is a valid logz.io token
@@ -46,6 +47,62 @@ def is_valid_scrape_interval(interval):
         raise ValueError('Scrape interval should be in multiplies of 60')
 
 
+def is_valid_exporter_replicas(replicas):
+    if replicas is None or type(replicas) is not int:
+        raise TypeError("Exporter replicas parameter should be a integer")
+    if replicas < 1:
+        raise ValueError('Exporter replicas should be at least 1')
+
+
+def is_valid_otel_tuning_preset(preset):
+    if type(preset) is not str:
+        raise TypeError("Opentelemetry tuning preset should be a string")
+    if preset not in otel_tuning.presets:
+        raise ValueError(f'{preset} tuning preset is not supported, presets are {", ".join(otel_tuning.presets)}')
+
+
+def is_valid_statistics_profile(profile):
+    if type(profile) is not str:
+        raise TypeError("Statistics profile should be a string")
+    if profile not in profiles.PROFILES:
+        raise ValueError(f'{profile} statistics profile is not supported, profiles are {", ".join(profiles.PROFILES)}')
+
+
+# Version tuple of an image version string, e.g. cloudwatch_exporter-0.11.0 -> (0, 11, 0)
+def parse_version(version):
+    match = re.search(r'(\d+)\.(\d+)\.(\d+)', version)
+    if match is None:
+        raise ValueError(f'Invalid version: {version}')
+    return tuple(int(part) for part in match.groups())
+
+
+def is_valid_get_metric_data_exporter_version(version):
+    if type(version) is not str:
+        raise TypeError("Cloudwatch exporter version should be a string")
+    if parse_version(version) < get_metric_data_exporter_version:
+        minimum = '.'.join(str(part) for part in get_metric_data_exporter_version)
+        raise ValueError(f'GetMetricData requires prom/cloudwatch-exporter {minimum} or later, but '
+                         f'CLOUDWATCH_EXPORTER_VERSION is {version}. Upgrade the cloudwatch-exporter image and set '
+                         f'CLOUDWATCH_EXPORTER_VERSION to its version, or disable use_get_metric_data')
+
+
+def is_valid_otel_send_queue(queue):
+    if type(queue) is not str:
+        raise TypeError("Opentelemetry send queue should be a string")
+    if queue not in otel_tuning.SEND_QUEUES:
+        raise ValueError(f'{queue} send queue is not supported, queues are {", ".join(otel_tuning.SEND_QUEUES)}')
+
+
+def is_valid_file_queue_collector_version(version):
+    if type(version) is not str:
+        raise TypeError("Opentelemetry collector version should be a string")
+    if parse_version(version) < file_queue_collector_version:
+        minimum = '.'.join(str(part) for part in file_queue_collector_version)
+        raise ValueError(f'A file send queue requires otel/opentelemetry-collector-contrib {minimum} or later, but '
+                         f'OTEL_COLLECTOR_VERSION is {version}. Upgrade the collector image and set '
+                         f'OTEL_COLLECTOR_VERSION to its version, or use the memory send queue')
+
+
 def is_valid_aws_region(aws_region):
     if aws_region is None or type(aws_region) is not str:
         raise TypeError("AWS region parameter should be a string")
@@ -59,6 +116,7 @@ def is_valid_aws_namespaces(namespaces):
     aws_namespaces_list = namespaces.replace(' ', '').split(',')
     if aws_namespaces_list == ['']:
         raise ValueError('Cant find aws namespaces')
+    aws_namespaces = set(catalog.get_namespaces())
     to_remove = []
     for n in aws_namespaces_list:
         if n not in aws_namespaces:
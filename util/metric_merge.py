@@ -0,0 +1,61 @@
+"""
+This module merges cloudwatch exporter metric entries that can be served by the same cloudwatch requests
+"""
+import json
+from util import planner
+from util.data import cloudwatch_statistics
+
+STATISTICS_FIELDS = ('aws_statistics', 'aws_extended_statistics')
+
+
+# Entries with the same merge key differ only in their statistics, so a single request can serve all of them
+def merge_key(metric):
+    settings = {k: v for k, v in metric.items()
+                if k not in STATISTICS_FIELDS + ('aws_namespace', 'aws_metric_name', 'aws_dimensions')}
+    return (metric.get('aws_namespace', '').strip(),
+            metric.get('aws_metric_name'),
+            tuple(sorted(metric.get('aws_dimensions') or ())),
+            json.dumps(settings, sort_keys=True))
+
+
+# Statistics of an entry. The exporter requests all five statistics for an entry without statistics
+def _statistics(metric, field):
+    if not any(metric.get(f) for f in STATISTICS_FIELDS):
+        return list(cloudwatch_statistics) if field == 'aws_statistics' else []
+    return metric.get(field) or []
+
+
+def _union(first, second):
+    return list(dict.fromkeys(list(first or []) + list(second or [])))
+
+
+# Merge entries with the same namespace, metric, dimensions and settings into one entry requesting the union of
+# their statistics. With GetMetricData this packs the statistics of a metric into the same batched requests.
+# Returns the merged entries, in the order they first appeared, and a report of what was saved
+def merge_metrics(metrics, inventory=None, use_get_metric_data=False):
+    merged = {}
+    report = {'entries_before': len(metrics), 'exact_duplicates': 0, 'subsumed': 0, 'merged': 0}
+    for metric in metrics:
+        key = merge_key(metric)
+        if key not in merged:
+            merged[key] = dict(metric)
+            continue
+        entry = merged[key]
+        if all(set(_statistics(metric, f)) == set(_statistics(entry, f)) for f in STATISTICS_FIELDS):
+            report['exact_duplicates'] += 1
+        elif all(set(_statistics(metric, f)) <= set(_statistics(entry, f)) for f in STATISTICS_FIELDS):
+            report['subsumed'] += 1
+        else:
+            report['merged'] += 1
+            for field in STATISTICS_FIELDS:
+                statistics = _union(_statistics(entry, field), _statistics(metric, field))
+                if statistics:
+                    entry[field] = statistics
+    merged_metrics = list(merged.values())
+    report['entries_after'] = len(merged_metrics)
+    report['api_calls_before'] = planner.plan_metrics(metrics, inventory or {},
+                                                      use_get_metric_data=use_get_metric_data)['api_calls']
+    report['api_calls_after'] = planner.plan_metrics(merged_metrics, inventory or {},
+                                                     use_get_metric_data=use_get_metric_data)['api_calls']
+    report['api_calls_saved'] = report['api_calls_before'] - report['api_calls_after']
+    return merged_metrics, report
@@ -0,0 +1,178 @@
+"""
+This module sizes the opentelemetry collector batch processor, memory limiter and remote write queue from the
+expected number of series per scrape, and the remote write retries and send queue that absorb a listener outage
+"""
+import math
+from util.data import file_queue_collector_version
+
+# Rough collector memory held per buffered series, in bytes
+BYTES_PER_SERIES = 2048
+# Memory the collector needs regardless of the data it buffers, in MiB
+BASE_MEMORY_MIB = 64
+MIB = 1024 * 1024
+# A memory send queue holds the queued requests in memory, a file send queue keeps them in a write-ahead log
+SEND_QUEUES = ('memory', 'file')
+# Write-ahead log directory of a file send queue, on the config_files volume
+DEFAULT_QUEUE_DIRECTORY = '/configuration/otel-queue'
+DEFAULT_OUTAGE_SECONDS = 900
+DEFAULT_QUEUE_MEMORY_MIB = 256
+# Series per remote write request when the batch processor is not tuned, the batch processor default
+DEFAULT_BATCH_SIZE = 8192
+RETRY_INITIAL_INTERVAL_SECONDS = 5
+RETRY_MAX_INTERVAL_SECONDS = 30
+MAX_QUEUE_CONSUMERS = 20
+
+# min_limit_mib and min_queue_size are the static values of a preset, used when the series are not estimated and
+# as a floor of the estimated values, since the estimate misses the resources that are not in the inventory
+presets = {
+    # Small batches sent as soon as possible, a short queue drained by many consumers
+    'low-latency': {
+        'batches_per_scrape': 20, 'min_batch_size': 256, 'max_batch_size': 2048, 'batch_timeout': '1s',
+        'buffered_scrapes': 2, 'num_consumers': 10, 'memory_factor': 2, 'min_limit_mib': 512, 'min_queue_size': 20
+    },
+    # Large batches and a deep queue, for many series per scrape
+    'high-throughput': {
+        'batches_per_scrape': 4, 'min_batch_size': 1024, 'max_batch_size': 16384, 'batch_timeout': '10s',
+        'buffered_scrapes': 5, 'num_consumers': 20, 'memory_factor': 3, 'min_limit_mib': 1024, 'min_queue_size': 20
+    },
+    # Medium batches, a queue of a single scrape and few consumers, to keep the collector small
+    'low-memory': {
+        'batches_per_scrape': 10, 'min_batch_size': 256, 'max_batch_size': 4096, 'batch_timeout': '5s',
+        'buffered_scrapes': 1, 'num_consumers': 2, 'memory_factor': 1.5, 'min_limit_mib': 256, 'min_queue_size': 10
+    }
+}
+
+
+# Collector settings of a preset for the expected number of series per scrape. Without an estimate, None, the
+# preset's static values are used
+def get_tuning(preset, series=None):
+    if preset not in presets:
+        raise ValueError(f'Invalid otel tuning preset {preset}, presets are {", ".join(presets)}')
+    settings = presets[preset]
+    if series is None:
+        batch_size = min(DEFAULT_BATCH_SIZE, settings['max_batch_size'])
+        batches_per_scrape = 0
+        limit_mib = settings['min_limit_mib']
+    else:
+        series = max(int(series), 1)
+        batch_size = min(max(math.ceil(series / settings['batches_per_scrape']), settings['min_batch_size']),
+                         settings['max_batch_size'])
+        batches_per_scrape = math.ceil(series / batch_size)
+        limit_mib = max(BASE_MEMORY_MIB + math.ceil(
+            series * settings['buffered_scrapes'] * BYTES_PER_SERIES * settings['memory_factor'] / MIB),
+            settings['min_limit_mib'])
+    return {
+        'batch': {
+            'send_batch_size': batch_size,
+            'timeout': settings['batch_timeout']
+        },
+        'memory_limiter': {
+            'check_interval': '1s',
+            'limit_mib': limit_mib,
+            'spike_limit_mib': max(math.ceil(limit_mib / 5), 1)
+        },
+        'sending_queue': {
+            'enabled': True,
+            'num_consumers': settings['num_consumers'],
+            'queue_size': max(batches_per_scrape * settings['buffered_scrapes'], settings['num_consumers'],
+                              settings['min_queue_size'])
+        }
+    }
+
+
+# Set the queue of the remote write exporter. Collectors older than file_queue_collector_version configure it with
+# sending_queue, newer ones with remote_write_queue
+def _set_queue(exporter, queue, collector_version):
+    if collector_version < file_queue_collector_version:
+        exporter['sending_queue'] = queue
+    else:
+        exporter.pop('sending_queue', None)
+        exporter['remote_write_queue'] = queue
+
+
+# Apply collector settings to an opentelemetry collector configuration of a collector version
+def apply_tuning(otel_yaml, tuning, collector_version):
+    otel_yaml['processors'] = otel_yaml.get('processors') or {}
+    otel_yaml['processors']['memory_limiter'] = tuning['memory_limiter']
+    otel_yaml['processors']['batch'] = tuning['batch']
+    _set_queue(otel_yaml['exporters']['prometheusremotewrite'], tuning['sending_queue'], collector_version)
+    pipeline = otel_yaml['service']['pipelines']['metrics']
+    # The memory limiter has to be the first processor of the pipeline
+    pipeline['processors'] = ['memory_limiter'] + [p for p in pipeline.get('processors') or []
+                                                   if p != 'memory_limiter']
+    return otel_yaml
+
+
+# Memory the memory limiter of collector settings leaves for queued requests, in MiB: its soft limit,
+# limit_mib - spike_limit_mib, less the memory the collector needs regardless of the data it buffers
+def get_queue_headroom_mib(tuning):
+    memory_limiter = tuning['memory_limiter']
+    return max(memory_limiter['limit_mib'] - memory_limiter['spike_limit_mib'] - BASE_MEMORY_MIB, 1)
+
+
+# Remote write settings of a send queue for the expected number of series per scrape interval: retries back off up
+# to a fraction of the scrape interval and give up after outage_seconds, and the queue holds the requests of the
+# outage, bounded by memory_mib for a memory queue. A file queue holds two scrapes in memory and the rest in its
+# write-ahead log. The queue is drained by num_consumers, by default a consumer per request of a scrape, so it
+# empties quickly after an outage
+def get_send_queue(queue, series, scrape_interval, batch_size=DEFAULT_BATCH_SIZE,
+                   outage_seconds=DEFAULT_OUTAGE_SECONDS, memory_mib=DEFAULT_QUEUE_MEMORY_MIB,
+                   directory=DEFAULT_QUEUE_DIRECTORY, num_consumers=None):
+    if queue not in SEND_QUEUES:
+        raise ValueError(f'Invalid send queue {queue}, queues are {", ".join(SEND_QUEUES)}')
+    scrape_interval = int(scrape_interval)
+    series = max(int(series), 1)
+    batches_per_scrape = math.ceil(series / batch_size)
+    request_bytes = min(series, batch_size) * BYTES_PER_SERIES
+    outage_scrapes = max(math.ceil(outage_seconds / scrape_interval), 1)
+    if num_consumers is None:
+        num_consumers = min(max(batches_per_scrape, 2), MAX_QUEUE_CONSUMERS)
+    max_interval = min(max(scrape_interval // 4, RETRY_INITIAL_INTERVAL_SECONDS), RETRY_MAX_INTERVAL_SECONDS)
+    if queue == 'memory':
+        memory_batches = max(int(memory_mib * MIB / request_bytes), 1)
+        queue_size = min(batches_per_scrape * outage_scrapes, memory_batches)
+        absorbed_seconds = min(queue_size // batches_per_scrape * scrape_interval, outage_seconds)
+    else:
+        queue_size = max(batches_per_scrape * 2, num_consumers)
+        absorbed_seconds = outage_seconds
+    send_queue = {
+        'retry_on_failure': {
+            'enabled': True,
+            'initial_interval': f'{RETRY_INITIAL_INTERVAL_SECONDS}s',
+            'max_interval': f'{max_interval}s',
+            'max_elapsed_time': f'{outage_seconds}s'
+        },
+        'queue': {
+            'enabled': True,
+            'num_consumers': num_consumers,
+            'queue_size': queue_size
+        },
+        'wal': None,
+        'absorbed_seconds': absorbed_seconds,
+        'memory_mib': math.ceil(queue_size * request_bytes / MIB)
+    }
+    if queue == 'file':
+        send_queue['wal'] = {
+            'directory': directory,
+            'buffer_size': queue_size,
+            'truncate_frequency': f'{scrape_interval}s'
+        }
+    return send_queue
+
+
+# Apply a send queue to an opentelemetry collector configuration of a collector version
+def apply_send_queue(otel_yaml, send_queue, collector_version):
+    exporter = otel_yaml['exporters']['prometheusremotewrite']
+    exporter['retry_on_failure'] = send_queue['retry_on_failure']
+    _set_queue(exporter, send_queue['queue'], collector_version)
+    if send_queue['wal']:
+        exporter['wal'] = send_queue['wal']
+    return otel_yaml
+
+
+# Remove the logging exporter from an opentelemetry collector configuration
+def drop_logging_exporter(otel_yaml):
+    otel_yaml['exporters'].pop('logging', None)
+    pipeline = otel_yaml['service']['pipelines']['metrics']
+    pipeline['exporters'] = [e for e in pipeline.get('exporters') or [] if e != 'logging']
+    return otel_yaml
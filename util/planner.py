@@ -0,0 +1,182 @@
+"""
+This module estimates the cloudwatch api calls, output series and scrape duration of a cloudwatch exporter
+configuration, based on an offline inventory of resource counts
+"""
+import argparse
+import json
+import math
+import sys
+import yaml
+from util import profiles, resource_select
+from util.data import cloudwatch_statistics
+
+# Metrics returned by a single ListMetrics page
+LIST_METRICS_PAGE_SIZE = 500
+# Resources returned by a single resource groups tagging GetResources page
+GET_RESOURCES_PAGE_SIZE = 100
+# Metric data queries served by a single GetMetricData call. The exporter makes a query per resource and statistic
+# of a metric entry and batches the queries of each entry separately
+GET_METRIC_DATA_QUERIES = 500
+# Average duration of a single cloudwatch api call, in seconds
+DEFAULT_CALL_LATENCY = 0.1
+# Resources assumed for a dimension that is missing from the inventory
+DEFAULT_RESOURCES = 1
+
+
+# Load an inventory file. The inventory maps namespaces to resource counts per dimension, for example:
+#   AWS/EC2:
+#     dimensions:
+#       InstanceId: 120
+#     dimension_sets:
+#       InstanceId,AutoScalingGroupName: 40
+# Namespaces may also have resource filters, see util.resource_select
+def load_inventory(inventory_path):
+    if not inventory_path:
+        return {}
+    with open(inventory_path, 'r') as inventory_file:
+        inventory = yaml.safe_load(inventory_file) or {}
+    if type(inventory) is not dict:
+        raise ValueError(f'Inventory {inventory_path} should be a mapping of namespaces')
+    return inventory
+
+
+# Estimated number of resources (dimension value combinations) a metric entry is collected for.
+# Dimensions with explicitly selected values count their values, regex and tag selections are not estimated
+def count_resources(metric, inventory):
+    dimensions = metric.get('aws_dimensions') or []
+    if not dimensions:
+        return 1
+    namespace_inventory = inventory.get(metric.get('aws_namespace', '').strip()) or {}
+    selected = metric.get('aws_dimension_select') or {}
+    dimension_sets = namespace_inventory.get('dimension_sets') or {}
+    dimension_set = ','.join(dimensions)
+    if dimension_set in dimension_sets and not selected:
+        return int(dimension_sets[dimension_set])
+    dimension_counts = namespace_inventory.get('dimensions') or {}
+    resources = 1
+    for dimension in dimensions:
+        if dimension in selected:
+            resources *= len(selected[dimension])
+        else:
+            resources *= int(dimension_counts.get(dimension, DEFAULT_RESOURCES))
+    return resources
+
+
+# The exporter skips ListMetrics when the values of every dimension are selected explicitly
+def _lists_metrics(metric):
+    dimensions = metric.get('aws_dimensions') or []
+    if not dimensions:
+        return False
+    selected = metric.get('aws_dimension_select') or {}
+    return not all(dimension in selected for dimension in dimensions) or bool(
+        metric.get('aws_dimension_select_regex') or metric.get('aws_tag_select'))
+
+
+# Tag selection pages through the tagged resources identified by the resource id dimension
+def _get_resources_calls(metric, inventory):
+    tag_select = metric.get('aws_tag_select')
+    if not tag_select:
+        return 0
+    tagged = count_resources(dict(metric, aws_dimensions=[tag_select['resource_id_dimension']]), inventory)
+    return max(1, math.ceil(tagged / GET_RESOURCES_PAGE_SIZE))
+
+
+# Estimated api calls and series of a single metric entry. The entry's use_get_metric_data setting overrides the
+# configuration's
+def plan_metric(metric, inventory, use_get_metric_data=False):
+    resources = count_resources(metric, inventory)
+    statistics = len(metric.get('aws_statistics') or []) + len(metric.get('aws_extended_statistics') or []) or len(
+        cloudwatch_statistics)
+    get_metric_data = metric.get('use_get_metric_data', use_get_metric_data)
+    return {
+        'resources': resources,
+        'list_metrics_calls': max(1, math.ceil(resources / LIST_METRICS_PAGE_SIZE)) if _lists_metrics(metric) else 0,
+        'get_resources_calls': _get_resources_calls(metric, inventory),
+        'get_metric_statistics_calls': 0 if get_metric_data else resources,
+        'get_metric_data_calls': math.ceil(resources * statistics / GET_METRIC_DATA_QUERIES) if get_metric_data else 0,
+        'series': resources * statistics
+    }
+
+
+def _add_plan(total, plan):
+    for key in ('list_metrics_calls', 'get_resources_calls', 'get_metric_statistics_calls', 'get_metric_data_calls',
+                'series'):
+        total[key] = total.get(key, 0) + plan[key]
+
+
+# Estimated api calls, series and scrape duration of a list of metric entries
+def plan_metrics(metrics, inventory, scrape_interval=None, call_latency=DEFAULT_CALL_LATENCY,
+                 use_get_metric_data=False):
+    namespaces = {}
+    total = {'metrics': len(metrics), 'list_metrics_calls': 0, 'get_resources_calls': 0,
+             'get_metric_statistics_calls': 0, 'get_metric_data_calls': 0, 'series': 0}
+    for metric in metrics:
+        metric_plan = plan_metric(metric, inventory, use_get_metric_data)
+        namespace_plan = namespaces.setdefault(metric.get('aws_namespace', '').strip(), {'metrics': 0})
+        namespace_plan['metrics'] += 1
+        _add_plan(namespace_plan, metric_plan)
+        _add_plan(total, metric_plan)
+    total['api_calls'] = total['list_metrics_calls'] + total['get_resources_calls'] + \
+        total['get_metric_statistics_calls'] + total['get_metric_data_calls']
+    total['scrape_duration_seconds'] = round(total['api_calls'] * call_latency, 2)
+    total['namespaces'] = namespaces
+    if scrape_interval:
+        total['scrape_interval'] = int(scrape_interval)
+        total['fits_scrape_interval'] = total['scrape_duration_seconds'] <= int(scrape_interval)
+    return total
+
+
+# Plan the built-in definitions of a list of namespaces in a statistics profile, with the resource filters of
+# the inventory
+def plan_namespaces(namespaces, inventory, scrape_interval=None, call_latency=DEFAULT_CALL_LATENCY,
+                    profile=profiles.DEFAULT_PROFILE, use_get_metric_data=False):
+    metrics = []
+    for namespace in namespaces:
+        metrics.extend(profiles.get_namespace_metrics(namespace, profile))
+    resource_select.select_metrics(metrics, inventory)
+    return plan_metrics(metrics, inventory, scrape_interval, call_latency, use_get_metric_data)
+
+
+# Plan a cloudwatch exporter configuration file
+def plan_config(config_path, inventory, scrape_interval=None, call_latency=DEFAULT_CALL_LATENCY):
+    with open(config_path, 'r') as config_file:
+        config_yaml = yaml.safe_load(config_file) or {}
+    return plan_metrics(config_yaml.get('metrics') or [], inventory, scrape_interval or config_yaml.get(
+        'period_seconds'), call_latency, config_yaml.get('use_get_metric_data', False))
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(description='Estimate the cost of a cloudwatch exporter configuration')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--namespaces', help='Comma-separated list of built-in namespaces, e.g. AWS/EC2,AWS/S3')
+    source.add_argument('--config', help='Path to a cloudwatch exporter configuration file')
+    parser.add_argument('--inventory', default='', help='Path to an inventory file of resource counts')
+    parser.add_argument('--profile', choices=profiles.PROFILES, default=profiles.DEFAULT_PROFILE,
+                        help='Statistics profile of the built-in namespaces')
+    parser.add_argument('--scrape-interval', type=int, default=None, help='Scrape interval in seconds')
+    parser.add_argument('--call-latency', type=float, default=DEFAULT_CALL_LATENCY,
+                        help='Average duration of a cloudwatch api call in seconds')
+    parser.add_argument('--get-metric-data', action='store_true',
+                        help='Estimate built-in namespaces collected with GetMetricData instead of GetMetricStatistics')
+    parser.add_argument('--strict', action='store_true',
+                        help='Exit with an error if the scrape cannot complete within the scrape interval')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = _parse_args(args)
+    inventory = load_inventory(args.inventory)
+    if args.namespaces:
+        namespaces = [ns for ns in args.namespaces.replace(' ', '').split(',') if ns]
+        plan = plan_namespaces(namespaces, inventory, args.scrape_interval, args.call_latency, args.profile,
+                               args.get_metric_data)
+    else:
+        plan = plan_config(args.config, inventory, args.scrape_interval, args.call_latency)
+    print(json.dumps(plan, indent=2))
+    if args.strict and not plan.get('fits_scrape_interval', True):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+This module selects the metrics of built-in namespaces by statistics profile. The minimal profile keeps the metrics
+and statistics of the namespace allowlist, see util.relabel, or the first statistic of each metric and dimension
+set of a namespace without one. The standard profile keeps the namespace definitions and the full profile requests
+every statistic
+"""
+from util import catalog, relabel
+from util.data import cloudwatch_statistics
+
+PROFILES = ('minimal', 'standard', 'full')
+DEFAULT_PROFILE = 'standard'
+
+
+# Parse namespace profile assignments, for example "AWS/EC2:minimal,AWS/S3:full"
+def parse_namespace_profiles(value):
+    namespace_profiles = {}
+    for assignment in value.replace(' ', '').split(','):
+        if not assignment:
+            continue
+        namespace, _, profile = assignment.rpartition(':')
+        if not namespace or profile.lower() not in PROFILES:
+            raise ValueError(f'Invalid namespace profile {assignment}, profiles are {", ".join(PROFILES)}')
+        namespace_profiles[namespace] = profile.lower()
+    return namespace_profiles
+
+
+def _minimal_metrics(namespace, metrics):
+    allowlist = relabel.load_allowlist(namespace)
+    minimal = []
+    if allowlist is None:
+        # An entry per dimension set, so minimal only narrows the statistics and keeps every series
+        metric_keys = set()
+        for metric in metrics:
+            metric_key = (metric['aws_metric_name'], tuple(sorted(metric.get('aws_dimensions') or [])))
+            if metric_key not in metric_keys:
+                metric_keys.add(metric_key)
+                minimal.append(dict(metric, aws_statistics=list(metric.get('aws_statistics') or ['Average'])[:1]))
+        return minimal
+    for metric in metrics:
+        allowed = allowlist['metrics'].get(metric['aws_metric_name']) or []
+        statistics = [statistic for statistic in metric.get('aws_statistics') or [] if statistic in allowed]
+        if statistics:
+            minimal.append(dict(metric, aws_statistics=statistics))
+    return minimal
+
+
+# Metric entries of a built-in namespace in a profile
+def get_namespace_metrics(namespace, profile=DEFAULT_PROFILE):
+    if profile not in PROFILES:
+        raise ValueError(f'{profile} statistics profile is not supported, profiles are {", ".join(PROFILES)}')
+    metrics = catalog.get_namespace_metrics(namespace)
+    if profile == 'minimal':
+        return _minimal_metrics(f'AWS/{namespace.strip().split("AWS/")[-1]}', metrics)
+    if profile == 'full':
+        return [dict(metric, aws_statistics=list(cloudwatch_statistics)) for metric in metrics]
+    return metrics
@@ -0,0 +1,103 @@
+"""
+This module compiles the per namespace allowlists of cw_namespaces/allowlists into prometheus metric_relabel_configs
+of the aws scrape jobs, so only the allowed series are sent over remote write. An allowlist maps the metrics of a
+namespace to the statistics to keep, for example cw_namespaces/allowlists/EC2.yml:
+  metrics:
+    CPUUtilization: [Average, Maximum]
+    StatusCheckFailed: [Sum]
+"""
+import os
+import re
+import yaml
+from util.data import extended_statistic
+
+ALLOWLISTS_DIR = './cw_namespaces/allowlists'
+# Exporter series that are kept together with the allowed series, everything else the exporter emits is dropped
+EXPORTER_SERIES = ('cloudwatch_requests_total', 'cloudwatch_exporter_scrape_duration_seconds',
+                   'cloudwatch_exporter_scrape_error', 'tagging_api_requests_total', 'aws_resource_info')
+ALLOWLIST_FIELDS = ('metrics',)
+# Series name suffix of each cloudwatch statistic
+STATISTIC_SUFFIXES = {
+    'Sum': 'sum',
+    'SampleCount': 'sample_count',
+    'Minimum': 'minimum',
+    'Maximum': 'maximum',
+    'Average': 'average'
+}
+
+
+# Same as the cloudwatch exporter: invalid characters are replaced and repeated underscores are merged
+def _safe_name(name):
+    return re.sub(r'__+', '_', re.sub(r'[^a-zA-Z0-9:_]', '_', name))
+
+
+def _snake_case(name):
+    return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+
+# Series name prefix of a namespace, e.g. AWS/EC2 -> aws_ec2
+def namespace_prefix(namespace):
+    return _safe_name(namespace.strip().lower())
+
+
+# Series name the exporter gives a statistic of a metric, e.g. AWS/EC2 CPUUtilization Average ->
+# aws_ec2_cpuutilization_average
+def series_name(namespace, metric_name, statistic):
+    base_name = _safe_name(f'{namespace_prefix(namespace)}_{_snake_case(metric_name)}')
+    return f'{base_name}_{STATISTIC_SUFFIXES.get(statistic) or _safe_name(_snake_case(statistic))}'
+
+
+def _allowlist_path(namespace, allowlists_dir):
+    return os.path.join(allowlists_dir, f'{namespace.strip().split("AWS/")[-1]}.yml')
+
+
+# Allowlist of a namespace, None if the namespace has none
+def load_allowlist(namespace, allowlists_dir=ALLOWLISTS_DIR):
+    namespace = namespace.strip()
+    path = _allowlist_path(namespace, allowlists_dir)
+    if not namespace.startswith('AWS/') or not os.path.isfile(path):
+        return None
+    with open(path, 'r') as allowlist_file:
+        allowlist = yaml.safe_load(allowlist_file) or {}
+    # Dimension labels tell the series of different resources apart, removing them would make series collide
+    if type(allowlist) is dict and 'drop_labels' in allowlist:
+        raise ValueError(f'drop_labels of allowlist {path} is not supported, dimension labels identify series')
+    if type(allowlist) is not dict or set(allowlist) - set(ALLOWLIST_FIELDS):
+        raise ValueError(f'Allowlist {path} should be a mapping with {", ".join(ALLOWLIST_FIELDS)}')
+    metrics = allowlist.get('metrics') or {}
+    if type(metrics) is not dict or not all(type(statistics) is list for statistics in metrics.values()):
+        raise ValueError(f'metrics of allowlist {path} should map metric names to lists of statistics')
+    for metric_name, statistics in metrics.items():
+        for statistic in statistics:
+            if statistic not in STATISTIC_SUFFIXES and not extended_statistic.match(str(statistic)):
+                raise ValueError(f'Invalid statistic {statistic} of {metric_name} in allowlist {path}')
+    return {'metrics': metrics}
+
+
+# Allowlists of the namespaces that have one
+def load_allowlists(namespaces, allowlists_dir=ALLOWLISTS_DIR):
+    allowlists = {}
+    for namespace in namespaces:
+        allowlist = load_allowlist(namespace, allowlists_dir)
+        if allowlist is not None:
+            allowlists[namespace.strip()] = allowlist
+    return allowlists
+
+
+# Allowed series names of an allowlist
+def allowed_series(namespace, allowlist):
+    return [series_name(namespace, metric_name, statistic)
+            for metric_name, statistics in allowlist['metrics'].items() for statistic in statistics]
+
+
+# metric_relabel_configs of a scrape job collecting namespaces: a keep rule for the exporter series, the allowed
+# series of namespaces with an allowlist and every series of the other namespaces
+def metric_relabel_configs(namespaces, allowlists):
+    patterns = list(EXPORTER_SERIES)
+    for namespace in sorted({namespace.strip() for namespace in namespaces}):
+        allowlist = allowlists.get(namespace)
+        if allowlist is None:
+            patterns.append(f'{namespace_prefix(namespace)}_.+')
+            continue
+        patterns.extend(allowed_series(namespace, allowlist))
+    return [{'source_labels': ['__name__'], 'regex': '|'.join(patterns), 'action': 'keep'}]
@@ -0,0 +1,76 @@
+"""
+This module compiles per namespace resource filters of the inventory into the cloudwatch exporter
+aws_dimension_select, aws_dimension_select_regex and aws_tag_select metric settings, for example:
+  AWS/EC2:
+    dimension_select:
+      InstanceId: [i-0123456789abcdef0]
+    dimension_select_regex:
+      AutoScalingGroupName: ['prod-.*']
+    tag_select:
+      resource_type_selection: ec2:instance
+      resource_id_dimension: InstanceId
+      tag_selections:
+        Environment: [production]
+"""
+import re
+
+SELECT_SETTINGS = {
+    'dimension_select': 'aws_dimension_select',
+    'dimension_select_regex': 'aws_dimension_select_regex',
+    'tag_select': 'aws_tag_select'
+}
+TAG_SELECT_FIELDS = ('resource_type_selection', 'resource_id_dimension', 'tag_selections')
+
+
+def _is_values_map(value):
+    return type(value) is dict and all(type(values) is list and all(type(v) is str for v in values)
+                                       for values in value.values())
+
+
+# Resource filters of a namespace in the inventory
+def get_selection(inventory, namespace):
+    namespace_inventory = inventory.get(namespace.strip()) or {}
+    selection = {key: namespace_inventory[key] for key in SELECT_SETTINGS if namespace_inventory.get(key)}
+    for key in ('dimension_select', 'dimension_select_regex'):
+        if key in selection and not _is_values_map(selection[key]):
+            raise ValueError(f'{key} of {namespace} should map dimensions to lists of values')
+    for dimension, patterns in (selection.get('dimension_select_regex') or {}).items():
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f'Invalid {dimension} regex {pattern} of {namespace}: {e}')
+    tag_select = selection.get('tag_select')
+    if tag_select is not None:
+        missing = [field for field in TAG_SELECT_FIELDS if not (type(tag_select) is dict and tag_select.get(field))]
+        if missing or not _is_values_map(tag_select['tag_selections']):
+            raise ValueError(f'tag_select of {namespace} should have {", ".join(TAG_SELECT_FIELDS)}, '
+                             f'with tag_selections mapping tags to lists of values')
+    return selection
+
+
+# Add the resource filters of a selection to a metric entry. Only filters of dimensions the metric has are added,
+# and settings already set on the metric entry are kept
+def select_metric(metric, selection):
+    dimensions = metric.get('aws_dimensions') or []
+    for key in ('dimension_select', 'dimension_select_regex'):
+        select = {dimension: list(values) for dimension, values in (selection.get(key) or {}).items()
+                  if dimension in dimensions}
+        if select and SELECT_SETTINGS[key] not in metric:
+            metric[SELECT_SETTINGS[key]] = select
+    tag_select = selection.get('tag_select')
+    if tag_select and tag_select['resource_id_dimension'] in dimensions and 'aws_tag_select' not in metric:
+        metric['aws_tag_select'] = dict(tag_select)
+    return metric
+
+
+# Add the resource filters of the inventory to metric entries of every namespace
+def select_metrics(metrics, inventory):
+    selections = {}
+    for metric in metrics:
+        namespace = metric.get('aws_namespace', '').strip()
+        if namespace not in selections:
+            selections[namespace] = get_selection(inventory, namespace)
+        if selections[namespace]:
+            select_metric(metric, selections[namespace])
+    return metrics
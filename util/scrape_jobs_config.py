@@ -1,4 +1,5 @@
 import os
+from util import relabel, tiers
 
 SCRAPE_INTERVAL = f'{os.environ["SCRAPE_INTERVAL"]}s'
 aws = {
@@ -10,3 +11,40 @@ aws = {
         'labels': {'p8s_logzio_name': os.environ['P8S_LOGZIO_NAME']}
     }]
 }
+# The config builder's own metrics, exposed by the config api
+builder = {
+    'job_name': 'logzio-config-builder',
+    'scrape_interval': SCRAPE_INTERVAL,
+    'scrape_timeout': SCRAPE_INTERVAL,
+    'metrics_path': '/metrics',
+    'static_configs': [{
+        'targets': ['logzio-config-builder:5001'],
+        'labels': {'p8s_logzio_name': os.environ['P8S_LOGZIO_NAME']}
+    }]
+}
+
+
+# aws scrape jobs, one per tier, with a target per exporter. Targets of sharded exporters are labeled with
+# the region and account of their shard. With allowlists, each job only keeps the allowed series of its namespaces
+def aws_jobs(exporters, allowlists=None):
+    jobs = {}
+    namespaces = {}
+    for exporter in exporters:
+        tier = exporter['tier']
+        if tier not in jobs:
+            jobs[tier] = dict(aws, static_configs=[])
+            if tiers.get_suffix(tier):
+                jobs[tier]['job_name'] = f'{aws["job_name"]}-{tier}'
+                jobs[tier]['scrape_interval'] = f'{exporter["scrape_interval"]}s'
+                jobs[tier]['scrape_timeout'] = f'{exporter["scrape_interval"]}s'
+        labels = {'p8s_logzio_name': os.environ['P8S_LOGZIO_NAME']}
+        shard = exporter.get('shard')
+        if shard and shard['id']:
+            labels.update({'aws_region': shard['region'], 'aws_account': shard['account'],
+                           'exporter_shard': shard['id']})
+        jobs[tier]['static_configs'].append({'targets': [exporter['target']], 'labels': labels})
+        namespaces.setdefault(tier, set()).update(exporter.get('namespaces') or {})
+    if allowlists is not None:
+        for tier, job in jobs.items():
+            job['metric_relabel_configs'] = relabel.metric_relabel_configs(namespaces[tier], allowlists)
+    return list(jobs.values())
@@ -0,0 +1,35 @@
+"""
+This module serves the config api with gunicorn threaded workers. The config builder uses it to serve the api after
+a build, and it is also a gunicorn configuration, to start the api as a separate component:
+  gunicorn -c python:util.server util.api:app
+"""
+import os
+from gunicorn.app.base import BaseApplication
+
+bind = f'0.0.0.0:{os.environ.get("API_PORT") or 5001}'
+worker_class = 'gthread'
+# Requests of a worker are served by its threads. Each worker process keeps its own request metrics.
+# Threads are started on demand, and every request waiting for a new document version holds one
+workers = int(os.environ.get('API_WORKERS') or 1)
+threads = int(os.environ.get('API_THREADS') or 256)
+accesslog = None
+SETTINGS = {'bind': bind, 'worker_class': worker_class, 'workers': workers, 'threads': threads, 'accesslog': accesslog}
+
+
+class _Server(BaseApplication):
+    def __init__(self, app, settings):
+        self.application = app
+        self.settings = settings
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+# Serve a wsgi app until the server is stopped
+def run(app, settings=None):
+    _Server(app, dict(SETTINGS, **(settings or {}))).run()
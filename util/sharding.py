@@ -0,0 +1,73 @@
+"""
+This module splits the cloudwatch exporter configuration into (region, account, replica) shards
+"""
+import os
+import re
+
+DEFAULT_ACCOUNT = 'default'
+EXPORTER_HOST = 'cloudwatch-exporter'
+EXPORTER_PORT = 9106
+
+
+# Account id of an IAM role arn, used to label and name the shards of that account
+def get_account(role_arn):
+    if not role_arn:
+        return DEFAULT_ACCOUNT
+    match = re.match(r'^arn:aws[a-z-]*:iam::(\d{12}):', role_arn)
+    if match:
+        return match.group(1)
+    return re.sub(r'[^a-zA-Z0-9]+', '-', role_arn).strip('-').lower()
+
+
+# Name of an IAM role arn, unique within its account, used to tell apart the shards of roles of the same account
+def get_role_name(role_arn):
+    role_name = role_arn.rsplit('/', 1)[-1] if ':role/' in role_arn else role_arn
+    return re.sub(r'[^a-zA-Z0-9]+', '-', role_name).strip('-').lower()
+
+
+# Split namespaces between replicas so that each replica gets about the same estimated cost.
+# Namespaces are assigned from the most expensive to the cheapest, each to the cheapest replica so far
+def split_namespaces(namespaces, replicas, cost):
+    buckets = [{'namespaces': [], 'cost': 0} for _ in range(max(1, min(replicas, len(namespaces))))]
+    for namespace in sorted(namespaces, key=lambda ns: (-cost(ns), ns)):
+        bucket = min(buckets, key=lambda b: b['cost'])
+        bucket['namespaces'].append(namespace)
+        bucket['cost'] += cost(namespace)
+    for bucket in buckets:
+        bucket['namespaces'].sort()
+    return buckets
+
+
+# One shard per region, role and replica. Shards are named after the account of their role, and after the role name
+# too when the account has more than one role. A single shard keeps the unsharded names
+def plan_shards(regions, role_arns, namespaces, replicas, cost):
+    role_arns = list(dict.fromkeys(role_arns or ['']))
+    sharded = len(regions) * len(role_arns) * min(replicas, max(1, len(namespaces))) > 1
+    accounts = [get_account(role_arn) for role_arn in role_arns]
+    shards = []
+    for region in regions:
+        for role_arn, account in zip(role_arns, accounts):
+            shard_name = f'{account}-{get_role_name(role_arn)}' if accounts.count(account) > 1 else account
+            for replica, bucket in enumerate(split_namespaces(namespaces, replicas, cost)):
+                shard_id = f'{region}-{shard_name}-{replica}' if sharded else ''
+                shards.append({
+                    'id': shard_id,
+                    'region': region,
+                    'role_arn': role_arn,
+                    'account': account,
+                    'replica': replica,
+                    'namespaces': bucket['namespaces'],
+                    'cost': bucket['cost']
+                })
+    return shards
+
+
+# Path of an exporter configuration, the unsharded configuration path with the non empty suffixes added
+def get_config_path(cw_config, *suffixes):
+    base, extension = os.path.splitext(cw_config)
+    return ''.join([base] + [f'-{suffix}' for suffix in suffixes if suffix] + [extension])
+
+
+# Scrape target of an exporter, the unsharded exporter host with the non empty suffixes added
+def get_target(*suffixes):
+    return '{}:{}'.format('-'.join([EXPORTER_HOST] + [suffix for suffix in suffixes if suffix]), EXPORTER_PORT)
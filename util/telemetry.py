@@ -0,0 +1,106 @@
+"""
+This module holds the prometheus metrics of the config builder and the config api, exposed on /metrics.
+The builder also writes its build metrics to a file, so a config api running in another process can expose them
+"""
+import os
+import time
+from prometheus_client import CollectorRegistry, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from util import files
+
+PREFIX = 'logzio_config_builder'
+PHASE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+REQUEST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+registry = CollectorRegistry()
+request_registry = CollectorRegistry()
+# Process that recorded the last build, other processes expose the build metrics file instead
+_build_pid = None
+
+phase_duration = Histogram(f'{PREFIX}_phase_duration_seconds', 'Duration of a configuration build phase',
+                           ['phase'], buckets=PHASE_BUCKETS, registry=registry)
+namespace_metrics = Gauge(f'{PREFIX}_namespace_metrics', 'Metric entries of a namespace in the exporter configuration',
+                          ['namespace'], registry=registry)
+namespace_statistics = Gauge(f'{PREFIX}_namespace_statistics',
+                             'Statistics requested for the metrics of a namespace in the exporter configuration',
+                             ['namespace'], registry=registry)
+estimated_api_calls = Gauge(f'{PREFIX}_estimated_api_calls', 'Estimated cloudwatch api calls per scrape of an exporter',
+                            ['exporter', 'tier'], registry=registry)
+estimated_series = Gauge(f'{PREFIX}_estimated_series', 'Estimated series per scrape of an exporter',
+                         ['exporter', 'tier'], registry=registry)
+config_size = Gauge(f'{PREFIX}_config_size_bytes', 'Size of a generated configuration file', ['config'],
+                    registry=registry)
+last_generation = Gauge(f'{PREFIX}_last_generation_timestamp_seconds',
+                        'Time the configuration was last generated successfully', registry=registry)
+request_duration = Histogram(f'{PREFIX}_request_duration_seconds', 'Latency of config api requests',
+                             ['endpoint', 'method', 'code'], buckets=REQUEST_BUCKETS, registry=request_registry)
+document_watchers = Gauge(f'{PREFIX}_document_watchers', 'Config api requests waiting for a new document version',
+                          ['mode'], registry=request_registry)
+
+
+# Label value of a build phase, e.g. 'Cloudwatch configuration' -> 'cloudwatch_configuration'
+def phase_label(phase):
+    return phase.strip().lower().replace(' ', '_')
+
+
+def observe_phase(phase, seconds):
+    phase_duration.labels(phase_label(phase)).observe(seconds)
+
+
+# Metric and statistic counts per namespace of metric entries
+def count_namespaces(metrics):
+    counts = {}
+    for metric in metrics:
+        namespace = counts.setdefault(metric.get('aws_namespace', '').strip(), {'metrics': 0, 'statistics': 0})
+        namespace['metrics'] += 1
+        namespace['statistics'] += len(metric.get('aws_statistics') or []) + len(
+            metric.get('aws_extended_statistics') or [])
+    return counts
+
+
+# Replace the build metrics with the ones of a successful build
+def record_build(exporters, config_paths):
+    global _build_pid
+    namespaces = {}
+    for exporter in exporters:
+        for namespace, counts in exporter.get('namespaces', {}).items():
+            total = namespaces.setdefault(namespace, {'metrics': 0, 'statistics': 0})
+            total['metrics'] += counts['metrics']
+            total['statistics'] += counts['statistics']
+    for gauge in (namespace_metrics, namespace_statistics, estimated_api_calls, estimated_series, config_size):
+        gauge.clear()
+    for namespace, counts in namespaces.items():
+        namespace_metrics.labels(namespace).set(counts['metrics'])
+        namespace_statistics.labels(namespace).set(counts['statistics'])
+    for exporter in exporters:
+        estimated_api_calls.labels(exporter['target'], exporter['tier']).set(exporter['api_calls'])
+        estimated_series.labels(exporter['target'], exporter['tier']).set(exporter['series'])
+    for path in config_paths:
+        if os.path.isfile(path):
+            config_size.labels(os.path.basename(path)).set(os.path.getsize(path))
+    last_generation.set(time.time())
+    _build_pid = os.getpid()
+
+
+# Write the build metrics in the prometheus text format, replacing the file at once
+def write_build_metrics(path):
+    with files.atomic_write(path, 'wb') as metrics_file:
+        metrics_file.write(generate_latest(registry))
+
+
+def observe_request(endpoint, method, code, seconds):
+    request_duration.labels(endpoint, method, str(code)).observe(seconds)
+
+
+# Metrics in the prometheus text format. Build metrics come from the build metrics file when the build ran in
+# another process
+def exposition(build_metrics_path=None):
+    build_metrics = None
+    if _build_pid != os.getpid() and build_metrics_path:
+        try:
+            with open(build_metrics_path, 'rb') as metrics_file:
+                build_metrics = metrics_file.read()
+        except OSError:
+            pass
+    if build_metrics is None:
+        build_metrics = generate_latest(registry)
+    return build_metrics + generate_latest(request_registry), CONTENT_TYPE_LATEST
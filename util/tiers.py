@@ -0,0 +1,63 @@
+"""
+This module assigns metrics to scrape tiers
+"""
+from util.data import scrape_tiers
+
+DEFAULT_TIER = 'standard'
+# Metrics with a period of a day or more are only published once a day
+DAILY_PERIOD_SECONDS = 86400
+
+
+# Parse namespace tier assignments, for example "AWS/ELB:fast,AWS/S3:daily"
+def parse_namespace_tiers(value):
+    namespace_tiers = {}
+    for assignment in value.replace(' ', '').split(','):
+        if not assignment:
+            continue
+        namespace, _, tier = assignment.rpartition(':')
+        if not namespace or tier not in scrape_tiers:
+            raise ValueError(f'Invalid namespace tier {assignment}, tiers are {", ".join(scrape_tiers)}')
+        namespace_tiers[namespace] = tier
+    return namespace_tiers
+
+
+# The tier of a metric: the tier tagged on the metric, then the tier of its namespace, then a tier inferred
+# from its period
+def get_metric_tier(metric, namespace_tiers):
+    if metric.get('tier'):
+        return metric['tier']
+    namespace = metric.get('aws_namespace', '').strip()
+    if namespace in namespace_tiers:
+        return namespace_tiers[namespace]
+    if int(metric.get('period_seconds') or 0) >= DAILY_PERIOD_SECONDS:
+        return 'daily'
+    return DEFAULT_TIER
+
+
+# Split metrics by tier, in tiers order. The tier tag is removed from the metrics.
+# When tiers are not enabled all metrics are in the default tier
+def split_by_tier(metrics, namespace_tiers, enabled=True):
+    tier_metrics = {}
+    for metric in metrics:
+        tier = get_metric_tier(metric, namespace_tiers) if enabled else DEFAULT_TIER
+        if tier not in scrape_tiers:
+            raise ValueError(f'Invalid tier {tier} of {metric.get("aws_metric_name")}, '
+                             f'tiers are {", ".join(scrape_tiers)}')
+        tier_metrics.setdefault(tier, []).append({k: v for k, v in metric.items() if k != 'tier'})
+    if not tier_metrics:
+        return {DEFAULT_TIER: []}
+    return {tier: tier_metrics[tier] for tier in scrape_tiers if tier in tier_metrics}
+
+
+# Scrape interval and exporter global settings of a tier
+def get_tier_settings(tier, scrape_interval):
+    settings = dict(scrape_tiers[tier])
+    return {
+        'scrape_interval': int(settings.pop('scrape_interval', scrape_interval)),
+        'exporter': settings
+    }
+
+
+# Suffix of the exporter configuration and target names of a tier, the default tier keeps the plain names
+def get_suffix(tier):
+    return '' if tier == DEFAULT_TIER else tier
@@ -0,0 +1,81 @@
+"""
+This module watches files for changes, publishes staged configuration files whose content changed and triggers
+the reload endpoints of the services that read them
+"""
+import hashlib
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+
+RELOAD_TIMEOUT_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+# Signature of files that changes when one of them is created, removed or modified
+def files_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+# sha256 of a file content, None if the file does not exist
+def file_hash(path):
+    try:
+        with open(path, 'rb') as hashed_file:
+            return hashlib.sha256(hashed_file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+# Move every file of staging_dir whose content differs from its namesake in target_dir over it.
+# Files with the same content are left untouched, so their readers do not see a change.
+# staging_dir has to be on the same filesystem as target_dir for the rename to be atomic.
+# Returns the changed paths in target_dir
+def publish_changed(staging_dir, target_dir):
+    changed = []
+    for file_name in sorted(os.listdir(staging_dir)):
+        staged = os.path.join(staging_dir, file_name)
+        target = os.path.join(target_dir, file_name)
+        if not os.path.isfile(staged) or file_hash(staged) == file_hash(target):
+            continue
+        os.replace(staged, target)
+        changed.append(target)
+    return changed
+
+
+# POST to a reload endpoint. Returns whether the service accepted the reload
+def post_reload(url, timeout=RELOAD_TIMEOUT_SECONDS):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=b'', method='POST'), timeout=timeout) as res:
+            logger.info(f'Reloaded {url} ({res.status})')
+            return True
+    except (urllib.error.URLError, OSError) as e:
+        logger.warning(f'Reloading {url} failed: {e}')
+        return False
+
+
+# Call on_change whenever the signature of the watched paths changes, until stop_event is set.
+# Errors raised by on_change are logged and watching goes on
+def watch(paths, interval, on_change, stop_event=None):
+    signature = files_signature(paths)
+    while True:
+        if stop_event is None:
+            time.sleep(interval)
+        elif stop_event.wait(interval):
+            return
+        current = files_signature(paths)
+        if current == signature:
+            continue
+        signature = current
+        try:
+            on_change()
+        except Exception:
+            logger.exception('Handling a change of the watched files failed')